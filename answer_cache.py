@@ -0,0 +1,257 @@
+"""
+回答キャッシュ（検索アプリ用）
+生成した回答を、質問のベクトルと回答生成に使った検索結果のチャンク id と一緒にメモリに保存する。
+新しい質問について、次の両方を満たすキャッシュ済みの回答があれば回答生成（LLM）を行わずにそれを返す。
+- 質問のベクトルのコサイン類似度が ANSWER_CACHE_MIN_SIMILARITY 以上
+- 検索結果のチャンク id の重なり（Jaccard 係数）が ANSWER_CACHE_MIN_OVERLAP 以上
+類似度はキャッシュ全体の行列との内積でまとめて計算する。
+取り込みスクリプトがチャンクを更新・削除した場合（index_events）は、そのチャンクを使った回答を破棄する。
+件数の上限を超えた場合は最も長く使われていないものから削除する。
+"""
+import os
+import time
+import threading
+import logging
+import numpy as np
+from dotenv import load_dotenv
+from index_events import current_index_generation, read_index_events, index_events_end
+from metrics import increment
+from logging_config import configure_logging
+
+# ロギング初期化
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# 保持する回答の最大件数（0 で回答キャッシュを使わない）
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+# キャッシュ済みの回答を使う質問ベクトルのコサイン類似度の下限
+ANSWER_CACHE_MIN_SIMILARITY = float(os.getenv("ANSWER_CACHE_MIN_SIMILARITY", "0.95"))
+# キャッシュ済みの回答を使う検索結果のチャンク id の重なり（Jaccard 係数）の下限
+ANSWER_CACHE_MIN_OVERLAP = float(os.getenv("ANSWER_CACHE_MIN_OVERLAP", "0.8"))
+# 有効期限（秒）。0 以下の場合は期限なし
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+
+
+class CachedAnswer:
+    """キャッシュ済みの回答と、新しい質問との類似度・チャンク id の重なり"""
+
+    def __init__(self, query, answer, similarity, overlap):
+        self.query = query
+        self.answer = answer
+        self.similarity = similarity
+        self.overlap = overlap
+
+
+class _Entry:
+    """キャッシュしている回答と、その質問・チャンク id・名前空間（回答生成に使ったモデルなど）"""
+
+    def __init__(self, query, answer, doc_ids, namespace):
+        self.query = query
+        self.answer = answer
+        self.doc_ids = doc_ids
+        self.namespace = namespace
+
+
+def _overlap(a, b):
+    """チャンク id の集合の重なり（Jaccard 係数）"""
+    union = len(a | b)
+    return len(a & b) / union if union else 0.0
+
+
+class AnswerCache:
+    """
+    質問の類似度と検索結果の重なりで引く回答キャッシュ（複数スレッドから同時に使ってよい）
+    :param maxsize: 保持する最大件数
+    :param min_similarity: 質問ベクトルのコサイン類似度の下限
+    :param min_overlap: 検索結果のチャンク id の重なりの下限
+    :param ttl: 有効期限（秒）。0 以下の場合は期限なし
+    """
+
+    def __init__(self, maxsize=ANSWER_CACHE_SIZE, min_similarity=ANSWER_CACHE_MIN_SIMILARITY,
+                 min_overlap=ANSWER_CACHE_MIN_OVERLAP, ttl=ANSWER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.min_similarity = min_similarity
+        self.min_overlap = min_overlap
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self._lock = threading.Lock()
+        self._reset(0)
+        # 作成前に記録された更新イベントは対象外にする
+        self._index_generation = current_index_generation()
+        self._events_position = index_events_end()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    def _reset(self, dim):
+        """すべての回答を削除し、dim 次元のベクトルを保持できるようにする。"""
+        # 正規化した質問ベクトル（1行1件）。空き行は valid が False
+        self._vectors = np.zeros((self.maxsize, dim), dtype=np.float32)
+        self._valid = np.zeros(self.maxsize, dtype=bool)
+        self._last_used = np.zeros(self.maxsize, dtype=np.float64)
+        self._expires_at = np.full(self.maxsize, np.inf, dtype=np.float64)
+        self._entries = [None] * self.maxsize
+        # チャンク id -> その id を使った回答の行番号
+        self._slots_by_id = {}
+
+    def _remove(self, slot):
+        entry = self._entries[slot]
+        if entry is None:
+            return
+        for doc_id in entry.doc_ids:
+            slots = self._slots_by_id.get(doc_id)
+            if slots is not None:
+                slots.discard(slot)
+                if not slots:
+                    del self._slots_by_id[doc_id]
+        self._entries[slot] = None
+        self._valid[slot] = False
+
+    def _sync_index_events(self):
+        """前回以降にインデックスで更新・削除されたチャンクを使った回答を破棄する。"""
+        generation = current_index_generation()
+        if generation == self._index_generation:
+            return
+        self._index_generation = generation
+        old_id, old_offset = self._events_position
+        events, position = read_index_events(self._events_position)
+        # ファイルが作り直された（識別子が変わった・小さくなった）場合は、
+        # どのチャンクが更新されたか分からないためすべて破棄する
+        recreated = old_id is not None and (position[0] != old_id or position[1] < old_offset)
+        self._events_position = position
+        slots = set()
+        for event in events:
+            ids = event.get("ids") or []
+            if not ids:
+                # インデックスの作り直し（id のないイベント）
+                recreated = True
+                break
+            for doc_id in ids:
+                slots |= self._slots_by_id.get(doc_id, set())
+        if recreated:
+            slots = set(np.flatnonzero(self._valid).tolist())
+        for slot in slots:
+            self._remove(slot)
+        if slots:
+            self.invalidated += len(slots)
+            logger.info("インデックスが更新されたため %d 件の回答キャッシュを破棄しました", len(slots))
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def lookup(self, vector, doc_ids, namespace=""):
+        """
+        質問のベクトルと検索結果のチャンク id に合うキャッシュ済みの回答を探す。
+        :param vector: 質問のベクトル
+        :param doc_ids: 検索結果のチャンク id
+        :param namespace: 回答生成の条件（モデル名など）。同じ名前空間の回答だけを使う
+        :return: CachedAnswer（見つからない場合は None）
+        """
+        if not self.enabled:
+            return None
+        query = self._normalize(vector)
+        doc_ids = frozenset(doc_ids)
+        with self._lock:
+            self._sync_index_events()
+            found = None
+            if query is not None and doc_ids and len(query) == self._vectors.shape[1]:
+                now = time.monotonic()
+                # すべての回答との類似度をまとめて計算し、下限以上のものを類似度の高い順に調べる
+                scores = self._vectors @ query
+                scores[~self._valid | (self._expires_at <= now)] = -np.inf
+                candidates = np.flatnonzero(scores >= self.min_similarity)
+                for slot in candidates[np.argsort(-scores[candidates])]:
+                    entry = self._entries[slot]
+                    if entry.namespace != namespace:
+                        continue
+                    overlap = _overlap(entry.doc_ids, doc_ids)
+                    if overlap >= self.min_overlap:
+                        self._last_used[slot] = now
+                        found = CachedAnswer(entry.query, entry.answer, float(scores[slot]), overlap)
+                        break
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        increment("answer.cache", result="miss" if found is None else "hit")
+        if found is not None:
+            # 元の質問は他のユーザーの入力のため記録しない
+            logger.info("回答キャッシュを使います: 類似度 %.3f, チャンクの重なり %.2f", found.similarity, found.overlap)
+        return found
+
+    def put(self, query, vector, doc_ids, answer, namespace=""):
+        """
+        生成した回答を保存する（上限を超える場合は最も長く使われていない回答を削除する）。
+        :param query: 質問
+        :param vector: 質問のベクトル
+        :param doc_ids: 回答生成に使った検索結果のチャンク id
+        :param answer: 生成した回答
+        :param namespace: 回答生成の条件（モデル名など）
+        """
+        normalized = self._normalize(vector)
+        doc_ids = frozenset(doc_ids)
+        if not self.enabled or normalized is None or not doc_ids or not answer:
+            return
+        with self._lock:
+            self._sync_index_events()
+            if len(normalized) != self._vectors.shape[1]:
+                # 埋め込みの次元数が変わった場合は以前の回答と比較できないため作り直す
+                if self._valid.any():
+                    logger.info("質問ベクトルの次元数が変わったため回答キャッシュを破棄します")
+                self._reset(len(normalized))
+            now = time.monotonic()
+            free = np.flatnonzero(~self._valid | (self._expires_at <= now))
+            if len(free):
+                slot = int(free[0])
+            else:
+                slot = int(np.argmin(self._last_used))
+            self._remove(slot)
+            self._vectors[slot] = normalized
+            self._valid[slot] = True
+            self._last_used[slot] = now
+            self._expires_at[slot] = now + self.ttl if self.ttl > 0 else np.inf
+            self._entries[slot] = _Entry(query, answer, doc_ids, namespace)
+            for doc_id in doc_ids:
+                self._slots_by_id.setdefault(doc_id, set()).add(slot)
+
+    def clear(self):
+        """すべての回答を削除する。"""
+        with self._lock:
+            self._reset(self._vectors.shape[1])
+
+    def __len__(self):
+        with self._lock:
+            return int(self._valid.sum())
+
+    def stats(self):
+        """件数・ヒット数・ミス数・ヒット率・インデックスの更新で破棄した件数を返す。"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": int(self._valid.sum()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "invalidated": self.invalidated,
+            }
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """プロセス共通の AnswerCache を返す（Streamlit の再実行・セッションをまたいで共有する）。"""
+    global _answer_cache
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                _answer_cache = AnswerCache()
+    return _answer_cache
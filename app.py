@@ -1,17 +1,13 @@
 import streamlit as st
-from retriever import AzureAISearchRetriever
 from dotenv import load_dotenv
 import os
 import re
-from blobstorage import download_file_from_blob_storage_via_restapi
-from langchain_openai import ChatOpenAI
-import base64
-import filetype
-from PIL import Image
+import time
 from io import BytesIO
-from langchain_core.output_parsers import StrOutputParser
-from prompt import create_prompt_with_images
-from markdown_utils import split_by_image_links, extract_image_links
+from image_cache import get_image_cache
+from image_prep import prepare_image
+from markdown_utils import split_by_image_links, extract_image_links, find_image_link, find_unfinished_image_link
+import metrics
 import logging
 from logging_config import configure_logging
 
@@ -20,19 +16,38 @@ from logging_config import configure_logging
 configure_logging()
 logger = logging.getLogger(__name__)
 
+# langchain・PIL などの重い import は初回に必要になった時点で行い、
+# Retriever・LLM の構築と設定の読み込みは st.cache_resource でプロセス内に1度だけ行う。
+# （Streamlit はウィジェット操作のたびにこのスクリプトを再実行するため）
 
+
+@st.cache_resource
 def load_settings():
-    """環境変数から設定を読み込む。"""
+    """環境変数から設定を読み込む（プロセス内で1度だけ）。"""
     load_dotenv()
     return {
         "AZURE_SEARCH_ENDPOINT": os.getenv("AZURE_SEARCH_ENDPOINT"),
         "AZURE_SEARCH_INDEX": os.getenv("AZURE_SEARCH_INDEX"),
         "AZURE_SEARCH_API_KEY": os.getenv("AZURE_SEARCH_API_KEY"),
+        "QUERY_VECTOR_MODE": os.getenv("QUERY_VECTOR_MODE", "text"),
+        # 検索で取得するチャンク数（参考情報はトークン数の上限まで詰めるため、増やしても送信量は増えすぎない）
+        "QA_TOP": int(os.getenv("QA_TOP", "3")),
+        "STREAM_ANSWER": os.getenv("STREAM_ANSWER", "true").lower() == "true",
+        "SHOW_DIAGNOSTICS": os.getenv("SHOW_DIAGNOSTICS", "false").lower() == "true",
     }
 
 
+@st.cache_resource
 def init_services(settings):
-    """Retriever と LLM を初期化して返す。"""
+    """Retriever と LLM を初期化して返す（同じ設定ではプロセス内で1度だけ構築する）。"""
+    from retriever import AzureAISearchRetriever
+    from langchain_openai import ChatOpenAI
+    from rate_limiter import create_httpx_client, OPENAI_MAX_RETRIES
+    import http_client
+
+    # 接続プールも最初のリクエストより前に作っておく
+    http_client.get_session()
+
     # ... 簡易的に None チェックを行う
     if not settings.get("AZURE_SEARCH_ENDPOINT") or not settings.get("AZURE_SEARCH_API_KEY"):
         logger.warning("Azure Search のエンドポイントまたは API キーが見つかりません。環境変数を確認してください。")
@@ -42,14 +57,32 @@ def init_services(settings):
         api_key=settings.get("AZURE_SEARCH_API_KEY"),
         index_name=settings.get("AZURE_SEARCH_INDEX"),
         qa_content_key="text",
-        qa_top=3,
+        qa_top=settings.get("QA_TOP", 3),
         qa_scoring_profile="",
+        query_vector_mode=settings.get("QUERY_VECTOR_MODE"),
     )
 
-    llm = ChatOpenAI(temperature=0, model_name="gpt-4.1")
+    # 回答生成の送信は rate_limiter の "chat" の上限を全セッションで共有する
+    llm = ChatOpenAI(
+        temperature=0,
+        model_name="gpt-4.1",
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=create_httpx_client("chat"),
+        http_async_client=create_httpx_client("chat", asynchronous=True),
+    )
     return retriever, llm
 
 
+def get_prepared_image(blob_url):
+    """Blob Storage から画像を取得し、縮小・再圧縮済みの PreparedImage を返す（取得できない場合は None）。"""
+    # 先読み済みであればキャッシュから取得される
+    img, etag = get_image_cache().get_with_etag(blob_url)
+    if img is None:
+        return None
+    # 前処理結果は Blob パスと ETag をキーにキャッシュされる
+    return prepare_image(blob_url, img, etag)
+
+
 def download_image_and_prepare_template(img_filename, blob_url):
     """Blob Storage から画像を取得し、Streamlit 表示と LLM に渡すための image_template を作る。
 
@@ -57,28 +90,22 @@ def download_image_and_prepare_template(img_filename, blob_url):
     """
     try:
         logger.info("Downloading image: %s", img_filename)
-        img = download_file_from_blob_storage_via_restapi(blob_url, save_path=None)
+        prepared = get_prepared_image(blob_url)
     except Exception as e:
         logger.exception("画像のダウンロードに失敗しました: %s", e)
         return None, None
+    if prepared is None:
+        return None, None
+
+    return prepared.display_bytes, prepared.image_template()
 
-    # MIMEタイプ判定
-    kind = filetype.guess(img)
-    mime_type = kind.mime if kind is not None else "application/octet-stream"
 
-    # AIに渡すためのBase64エンコード
+def show_image(image_bytes, caption=None):
+    """前処理済み（PIL で再エンコード済み）の画像を表示する。失敗した場合は streamlit_safe_image で再試行する。"""
     try:
-        base64_string = base64.b64encode(img).decode("utf-8")
+        st.image(image_bytes, caption=caption)
     except Exception:
-        logger.exception("画像の Base64 エンコードに失敗しました")
-        return img, None
-
-    image_template = {
-        "type": "image_url",
-        "image_url": {"url": f"data:{mime_type};base64,{base64_string}"},
-    }
-
-    return img, image_template
+        streamlit_safe_image(image_bytes, caption=caption)
 
 
 def streamlit_safe_image(image_data, caption=None):
@@ -92,6 +119,7 @@ def streamlit_safe_image(image_data, caption=None):
     画像が壊れている、または PIL が format を検出できない場合でも
     st.image が AttributeError を出さないように保護する。
     """
+    from PIL import Image
     try:
         # bytes の場合は PIL Image を作る
         if isinstance(image_data, (bytes, bytearray)):
@@ -142,59 +170,277 @@ def streamlit_safe_image(image_data, caption=None):
             logger.exception("画像表示中に予期せぬエラーが発生しました: %s", e)
 
 
+@metrics.span("answer.references")
 def process_search_results(results, tabs):
     """検索結果を Streamlit に表示しつつ、references と image_templates を組み立てる。
 
+    参考情報は context_builder で同じ文書の重なったチャンクの結合・重複の除去をしたうえで、
+    トークン数の上限まで関連度順に詰める（上限を超えたものは表示のみ行う）。
+
     戻り値: (references_str, image_templates, imagedict_all)
     """
-    references = ""
+    from context_builder import build_context
+
+    context = build_context(results)
+    st.session_state["last_context_stats"] = context.stats
     image_templates = []
     imagedict_all = {}
-
     for result in results:
-        title = result.metadata.get("title", "(無題)")
-        image_filenames = result.metadata.get("image_filenames", [])
-        imagebloburls = result.metadata.get("imagebloburls", [])
-        imagedict = dict(zip(image_filenames, imagebloburls))
-        imagedict_all.update(imagedict)
-        logger.debug("imagedict: %s", imagedict)
-
-        content = result.page_content
-        with tabs[1], st.expander(f"{title}"):
-            parts_content = split_by_image_links(content)
-            for part in parts_content:
-                references += part + "\n"
+        imagedict_all.update(
+            zip(result.metadata.get("image_filenames", []), result.metadata.get("imagebloburls", []))
+        )
+
+    # LLM に渡す画像を表示より先にまとめて並行に取得しておく
+    get_image_cache().prefetch(blob_url for _, blob_url in context.images)
+    prompt_images = {blob_url for _, blob_url in context.images}
+
+    for block in context.blocks:
+        logger.debug("imagedict: %s", block.images)
+        with tabs[1], st.expander(f"{block.title}"):
+            for part in split_by_image_links(block.text):
                 if re.match(r'!\[.*?\]\(.*?\)', part):
                     img_filename = extract_image_links(part)[0] if extract_image_links(part) else None
-                    if img_filename and img_filename in imagedict:
-                        blob_url = imagedict[img_filename]
+                    if img_filename and img_filename in block.images:
+                        blob_url = block.images[img_filename]
                         img, template = download_image_and_prepare_template(img_filename, blob_url)
                         if img is not None:
-                            # バイト列や PIL Image に対応して安全に表示するヘルパーを使う
-                            streamlit_safe_image(img, caption=img_filename)
-                        if template is not None:
+                            show_image(img, caption=img_filename)
+                        # 同じ画像は1度だけ、上限数までを LLM に渡す
+                        if template is not None and blob_url in prompt_images:
                             image_templates.append(template)
+                            prompt_images.discard(blob_url)
                 else:
                     st.markdown(part)
 
-    return references, image_templates, imagedict_all
+    for block in context.dropped_blocks:
+        with tabs[1], st.expander(f"{block.title}（回答生成には未使用）"):
+            st.caption("参考情報のトークン数の上限を超えたため、回答生成には使用していません。")
+            st.markdown(block.text)
 
+    return context.references, image_templates, imagedict_all
+
+
+@metrics.span("answer.prompt")
+def build_rag_chain(image_templates, llm):
+    """プロンプト・LLM・出力パーサーをつないだチェーンを返す。"""
+    from langchain_core.output_parsers import StrOutputParser
+    from prompt import create_prompt_with_images
 
-def generate_answer(user_input, references, image_templates, llm):
-    """プロンプトを作成して LLM に問い合わせ、結果を返す。"""
     prompt = create_prompt_with_images(image_templates)
 
     # パイプラインを組み立てる
-    rag_chain = (
+    return (
         prompt
         | llm
         | StrOutputParser()
     )
 
+
+@metrics.span("answer.generate", stream=False)
+def generate_answer(user_input, references, image_templates, llm):
+    """プロンプトを作成して LLM に問い合わせ、結果を返す。"""
+    rag_chain = build_rag_chain(image_templates, llm)
+
     result = rag_chain.invoke({"question": user_input, "references": references})
     return result
 
 
+def render_answer_image(part, imagedict_all):
+    """回答中の画像リンクに対応する画像を表示する。"""
+    img_filename = extract_image_links(part)[0] if extract_image_links(part) else None
+    if img_filename and img_filename in imagedict_all:
+        blob_url = imagedict_all[img_filename]
+        # 参考情報の表示で取得・前処理済みの画像はキャッシュから返る
+        prepared = get_prepared_image(blob_url)
+        if prepared is not None:
+            show_image(prepared.display_bytes, caption=img_filename)
+
+
+def render_answer(answer, imagedict_all):
+    """生成済みの回答を表示する（画像リンクを含む可能性があるため分割して処理）。"""
+    parts_result = split_by_image_links(answer)
+    for part in parts_result:
+        if re.match(r'!\[.*?\]\(.*?\)', part):
+            render_answer_image(part, imagedict_all)
+        else:
+            st.markdown(part)
+
+
+@metrics.span("answer.generate", stream=True)
+def stream_answer(user_input, references, image_templates, llm, imagedict_all):
+    """
+    LLM の回答をストリーミングで受け取りながら表示する。
+    トークンが届くたびに Markdown を更新し、画像リンクが閉じた時点でその位置に画像を表示する。
+
+    戻り値: (answer, ttft) -- answer は回答全文、ttft は最初のトークンが届くまでの秒数
+    """
+    rag_chain = build_rag_chain(image_templates, llm)
+
+    start = time.perf_counter()
+    ttft = None
+    answer = ""
+    # 表示中のテキスト領域とその内容、まだ表示していない（画像リンクの途中かもしれない）テキスト
+    placeholder = st.empty()
+    segment = ""
+    pending = ""
+    for token in rag_chain.stream({"question": user_input, "references": references}):
+        if ttft is None:
+            ttft = time.perf_counter() - start
+            metrics.observe("answer.ttft", ttft)
+            logger.info("最初のトークンまで: %.2f 秒", ttft)
+        answer += token
+        pending += token
+
+        # 閉じた画像リンクがあれば、その手前までのテキストを確定して画像を表示する
+        match = find_image_link(pending)
+        while match:
+            segment += pending[:match.start()]
+            placeholder.markdown(segment)
+            render_answer_image(match.group(0), imagedict_all)
+            placeholder = st.empty()
+            segment = ""
+            pending = pending[match.end():]
+            match = find_image_link(pending)
+
+        # 未完成の画像リンクは表示せずに残しておく
+        visible = find_unfinished_image_link(pending)
+        if visible:
+            segment += pending[:visible]
+            pending = pending[visible:]
+            placeholder.markdown(segment)
+
+    segment += pending
+    if segment:
+        placeholder.markdown(segment)
+    logger.info("回答生成: %.2f 秒（最初のトークンまで %s 秒）", time.perf_counter() - start,
+                "-" if ttft is None else f"{ttft:.2f}")
+    return answer, ttft
+
+
+def find_cached_answer(user_input, results, retriever, llm):
+    """
+    回答キャッシュから、似た質問・ほぼ同じ検索結果に対して生成済みの回答を探す。
+
+    戻り値: (query_vector, doc_ids, cached) -- cached は見つからない場合 None。
+    回答キャッシュを使わない場合・質問をベクトル化できない場合は query_vector が None
+    """
+    from answer_cache import get_answer_cache
+
+    answer_cache = get_answer_cache()
+    doc_ids = [doc.metadata.get("id") for doc in results if doc.metadata.get("id")]
+    if not answer_cache.enabled or not doc_ids:
+        return None, doc_ids, None
+    try:
+        with metrics.span("answer.cache_lookup"):
+            query_vector = retriever.embed_query(user_input)
+            cached = answer_cache.lookup(query_vector, doc_ids, namespace=llm.model_name)
+    except Exception as e:
+        logger.warning("回答キャッシュを検索できませんでした: %s", e)
+        return None, doc_ids, None
+    return query_vector, doc_ids, cached
+
+
+def answer_query(user_input, settings, retriever, llm):
+    """質問に対して検索・参考情報の表示・回答生成を行う。"""
+    from answer_cache import get_answer_cache
+
+    # Azure Searchで情報を検索
+    with st.spinner("情報を検索中..."):
+        try:
+            with metrics.span("answer.retrieve"):
+                results = retriever.invoke(user_input)
+        except Exception as e:
+            logger.exception("検索中にエラーが発生しました: %s", e)
+            st.error(f"検索中にエラーが発生しました: {e}")
+            return
+
+    tabs = st.tabs(["回答", "参考情報"])
+    with tabs[0]:
+        st.subheader("AIの回答")
+    with tabs[1]:
+        st.subheader("参考情報")
+    with st.spinner("AIが回答を生成中..."):
+        if results:
+            references, image_templates, imagedict_all = process_search_results(results, tabs)
+
+            # 似た質問に同じ参考情報で回答済みであれば、回答生成を行わずにその回答を表示する
+            query_vector, doc_ids, cached = find_cached_answer(user_input, results, retriever, llm)
+            if cached is not None:
+                with tabs[0]:
+                    # 回答キャッシュは全セッションで共有するため、元の質問（他のユーザーの入力）は表示しない
+                    st.caption("以前に生成した回答を表示しています。")
+                    render_answer(cached.answer, imagedict_all)
+                return
+
+            # LLM に渡して回答生成
+            if settings.get("STREAM_ANSWER"):
+                with tabs[0]:
+                    answer, ttft = stream_answer(user_input, references, image_templates, llm, imagedict_all)
+                    st.session_state["last_ttft"] = ttft
+            else:
+                answer = generate_answer(user_input, references, image_templates, llm)
+                with tabs[0]:
+                    render_answer(answer, imagedict_all)
+            if query_vector is not None:
+                get_answer_cache().put(user_input, query_vector, doc_ids, answer, namespace=llm.model_name)
+        else:
+            with tabs[0]:
+                st.markdown("参考になる情報が見つかりませんでした。")
+            with tabs[1]:
+                st.markdown("参考になる情報が見つかりませんでした。")
+
+
+def show_diagnostics():
+    """サイドバーに直近の質問の処理時間の内訳と、プロセス内の計測値・キャッシュの状況を表示する。"""
+    from retriever import get_cache_stats
+    from answer_cache import get_answer_cache
+
+    registry = metrics.get_registry()
+    with st.sidebar.expander("診断情報", expanded=False):
+        trace_id = st.session_state.get("last_trace_id")
+        if trace_id:
+            st.markdown(f"**直近の質問の処理時間**（trace: `{trace_id}`）")
+            st.table([
+                {
+                    "処理": record["name"],
+                    "ラベル": ", ".join(f"{k}={v}" for k, v in record["labels"].items()),
+                    "ms": round(record["duration_ms"], 1),
+                }
+                for record in registry.recent_spans(trace_id)
+            ])
+        context_stats = st.session_state.get("last_context_stats")
+        if context_stats:
+            st.markdown("**直近の参考情報**")
+            st.json(context_stats)
+        ttft = st.session_state.get("last_ttft")
+        if ttft is not None:
+            st.markdown(f"最初のトークンまで: {ttft:.2f} 秒")
+
+        snapshot = registry.snapshot()
+        st.markdown("**処理時間の集計**")
+        st.table([
+            {
+                "処理": item["name"],
+                "ラベル": ", ".join(f"{k}={v}" for k, v in item["labels"].items()),
+                "回数": item["count"],
+                "平均 ms": round(item["mean_ms"], 1),
+                "最大 ms": round(item["max_ms"], 1),
+            }
+            for item in snapshot["spans"]
+        ])
+        st.markdown("**カウンタ**")
+        st.table([
+            {
+                "名前": item["name"],
+                "ラベル": ", ".join(f"{k}={v}" for k, v in item["labels"].items()),
+                "値": item["value"],
+            }
+            for item in snapshot["counters"]
+        ])
+        st.markdown("**キャッシュ**")
+        st.json({**get_cache_stats(), "image": get_image_cache().stats(), "answer": get_answer_cache().stats()})
+
+
 def main():
     """Streamlit アプリのエントリポイント。"""
     st.title("Azure AI Search チャットアプリ")
@@ -209,45 +455,14 @@ def main():
     user_input = st.text_input("質問を入力してください：")
 
     if st.button("送信") and user_input:
-        # Azure Searchで情報を検索
-        with st.spinner("情報を検索中..."):
-            try:
-                results = retriever.invoke(user_input)
-            except Exception as e:
-                logger.exception("検索中にエラーが発生しました: %s", e)
-                st.error("検索中にエラーが発生しました。ログを確認してください。")
-                return
-
-        tabs = st.tabs(["回答", "参考情報"])
-        with tabs[0]:
-            st.subheader("AIの回答")
-        with tabs[1]:
-            st.subheader("参考情報")
-        with st.spinner("AIが回答を生成中..."):
-            if results:
-                references, image_templates, imagedict_all = process_search_results(results, tabs)
-
-                # LLM に渡して回答生成
-                answer = generate_answer(user_input, references, image_templates, llm)
-
-                # 回答の表示（画像リンクを含む可能性があるため分割して処理）
-                with tabs[0]:
-                    parts_result = split_by_image_links(answer)
-                    for part in parts_result:
-                        if re.match(r'!\[.*?\]\(.*?\)', part):
-                            img_filename = extract_image_links(part)[0] if extract_image_links(part) else None
-                            if img_filename and img_filename in imagedict_all:
-                                blob_url = imagedict_all[img_filename]
-                                img = download_file_from_blob_storage_via_restapi(blob_url, save_path=None)
-                                # バイト列や PIL Image に対応して安全に表示するヘルパーを使う
-                                streamlit_safe_image(img, caption=img_filename)
-                        else:
-                            st.markdown(part)
-            else:
-                with tabs[0]:
-                    st.markdown("参考になる情報が見つかりませんでした。")
-                with tabs[1]:
-                    st.markdown("参考になる情報が見つかりませんでした。")
+        # 1回の質問の処理（検索・参考情報・回答生成）を1つのトレースとして記録する
+        with metrics.trace("answer.query") as query_trace:
+            st.session_state["last_trace_id"] = query_trace.trace_id
+            answer_query(user_input, settings, retriever, llm)
+        metrics.flush()
+
+    if settings.get("SHOW_DIAGNOSTICS"):
+        show_diagnostics()
 
 
 if __name__ == "__main__":
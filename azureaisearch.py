@@ -1,69 +1,108 @@
-import requests
-import os
-from dotenv import load_dotenv
+import hashlib
 import re
 import logging
+from index_events import record_index_update
+from search_backend import get_search_backend
+from metrics import increment
 from logging_config import configure_logging
 
 # ロギングを初期化（既に設定済みなら再設定しない）
 configure_logging()
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
-AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX")
-AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
 
-def upload_to_azure_search(docs):
+def assign_document_ids(docs):
     """
-    Azure AI Searchにドキュメントをアップロードする関数
+    parent_filename とチャンクのテキストから、内容に基づく安定した id を各ドキュメントに付与する関数
+    同じファイル内に同一テキストのチャンクが複数ある場合は出現順の連番を付ける。
+    """
+    seen = {}
+    for doc in docs:
+        # parent_filenameからidに使えない文字（英字・数字・_・-・=以外）を_に置換する
+        safe_parent_filename = re.sub(r'[^A-Za-z0-9_\-=]', '_', doc["parent_filename"])
+        digest = hashlib.sha1(doc["text"].encode("utf-8")).hexdigest()[:16]
+        base_id = "doc_" + safe_parent_filename + "_" + digest
+        count = seen.get(base_id, 0)
+        seen[base_id] = count + 1
+        doc["id"] = base_id if count == 0 else f"{base_id}_{count + 1}"
+    return docs
+
+
+def find_document_ids(parent_filename):
+    """
+    parent_filename が一致するドキュメントの id 一覧を、設定された検索バックエンドから取得する関数
+    :return: id のリスト（検索に失敗した場合は None）
     """
-    url = f"{AZURE_SEARCH_ENDPOINT}/indexes/{AZURE_SEARCH_INDEX}/docs/search.index?api-version=2024-07-01"
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": AZURE_SEARCH_API_KEY
+    return get_search_backend().find_ids(parent_filename)
+
+
+def _to_index_action(doc, action):
+    """ドキュメントを search.index のアクションに変換する。"""
+    item = {
+        "@search.action": action,
+        "text": doc["text"],
+        "id": doc["id"],
+        "parent_filename": doc["parent_filename"],
+        # 見出しの階層が分かる場合はタイトルに含める（例: "spec.md > 概要 > インストール"）
+        "title": " > ".join([doc["parent_filename"]] + list(doc.get("heading_path") or [])),
+        "imagebloburls": doc["imagebloburls"],
+        "image_filenames": doc["image_filenames"]
     }
+    # ベクトル埋め込みをtext_vectorに格納（空テキストのチャンクにはベクトルがない）
+    if "text_vector" in doc:
+        item["text_vector"] = doc["text_vector"]
+    return item
+
+
+def _post_index_actions(actions):
+    """
+    アクションを設定された検索バックエンドに送信し、すべて成功したかどうかを返す。
+    Azure AI Search の場合はバッチに分割して search.index に送信する。
+    """
+    failed_keys = get_search_backend().index_actions(actions)
+    if failed_keys:
+        increment("search.index_failed_items", len(failed_keys))
+        logger.error("インデックス登録に失敗したアイテム: %d 件", len(failed_keys))
+    return not failed_keys
+
+
+def sync_document_chunks(upsert_docs, delete_ids):
+    """
+    追加・変更されたチャンクを mergeOrUpload、削除されたチャンクを delete で送信する関数
+    :param upsert_docs: id 付きのドキュメントのリスト
+    :param delete_ids: 削除するドキュメント id のリスト
+    :return: すべて成功した場合 True
+    """
+    ok = _post_index_actions([_to_index_action(doc, "mergeOrUpload") for doc in upsert_docs])
+    if ok and delete_ids:
+        delete_docs = [{"@search.action": "delete", "id": id} for id in delete_ids]
+        ok = _post_index_actions(delete_docs)
+    # 検索結果などのキャッシュを無効化できるよう、更新した id を記録する（一部失敗でも更新はされうる）
+    changed_ids = [doc["id"] for doc in upsert_docs] + list(delete_ids or [])
+    if changed_ids:
+        record_index_update(changed_ids)
+    return ok
+
+
+def upload_to_azure_search(docs, parent_filename=None):
+    """
+    Azure AI Searchにドキュメントをアップロードする関数
+    新しいチャンクを登録した後で、同じ parent_filename の古いチャンクを削除するため、
+    アップロード中にドキュメントのチャンクが一時的に消えることはない。
+    :param parent_filename: ドキュメントのファイル名（省略時は docs から取得する）。
+        チャンクが1つもなくなったファイルでも、既存のチャンクを削除できるよう指定する
+    :return: すべて成功した場合 True
+    """
+    if parent_filename is None:
+        if not docs:
+            return True
+        parent_filename = docs[0]["parent_filename"]
+    if any("id" not in doc for doc in docs):
+        assign_document_ids(docs)
 
-    # --- 追加: parent_filename一致データの削除 ---
-    parent_filename = docs[0]["parent_filename"] if docs else None
-    if parent_filename:
-        # 検索APIでparent_filename一致のドキュメントIDを取得
-        search_url = f"{AZURE_SEARCH_ENDPOINT}/indexes/{AZURE_SEARCH_INDEX}/docs/search?api-version=2024-07-01"
-        search_body = {
-            "search": "*",
-            "filter": f"parent_filename eq '{parent_filename}'",
-            "select": "id"
-        }
-        search_resp = requests.post(search_url, headers=headers, json=search_body)
-        if search_resp.status_code == 200:
-            results = search_resp.json()
-            delete_ids = [doc["id"] for doc in results.get("value", [])]
-            if delete_ids:
-                # 削除リクエストを送信
-                delete_docs = [{"@search.action": "delete", "id": id} for id in delete_ids]
-                delete_data = {"value": delete_docs}
-                delete_resp = requests.post(url, headers=headers, json=delete_data)
-                logger.info(f"削除レスポンス: {delete_resp.status_code} {delete_resp.text}")
-        else:
-            logger.error(f"検索API失敗: {search_resp.status_code} {search_resp.text}")
+    existing_ids = find_document_ids(parent_filename)
 
-    # --- 通常のアップロード処理 ---
-    # parent_filenameからidに使えない文字（英字・数字・_・-・=以外）を_に置換する
-    safe_parent_filename = re.sub(r'[^A-Za-z0-9_\-=]', '_', parent_filename)
-    id_prefix = "doc_" + safe_parent_filename + "_"
-    list_docs = []
-    for i, doc in enumerate(docs):
-        list_docs.append({
-            "@search.action": "upload",
-            "text": doc["text"],
-            "id": id_prefix + str(i + 1),
-            "parent_filename": doc["parent_filename"],
-            "title": doc["parent_filename"],
-            # ベクトル埋め込みをtext_vectorに格納
-            "text_vector": doc["text_vector"],
-            "imagebloburls": doc["imagebloburls"],
-            "image_filenames": doc["image_filenames"]
-        })
-    data = {"value": list_docs}
-    resp = requests.post(url, headers=headers, json=data)
-    logger.info(f"Azure Searchレスポンス: {resp.status_code} {resp.text}")
+    new_ids = {doc["id"] for doc in docs}
+    # 新しいチャンクに含まれない既存チャンクを削除対象にする
+    stale_ids = [id for id in (existing_ids or []) if id not in new_ids]
+    return sync_document_chunks(docs, stale_ids) and existing_ids is not None
@@ -0,0 +1,150 @@
+"""
+Blob 転送ベンチマーク
+大きなファイルを Blob Storage のモックサーバー（mock_services.py、別プロセスで起動）にアップロード・ダウンロードし、
+転送方式ごとの所要時間と Python のメモリ使用量のピーク（tracemalloc）を計測する。
+- upload_single: 1回の PUT（ファイル全体をメモリに読み込む）
+- upload_blocks: Put Block を並行に送って Put Block List で確定する
+- download_memory: 1回の GET でレスポンス全体をメモリに読み込む
+- download_stream: 1回の GET でディスクに少しずつ書き込む
+- download_ranged: Range 指定で並行にダウンロードしてディスクに書き込む
+モックサーバーの1接続あたりの転送速度（--bandwidth-mbps）を指定すると、並行転送の効果を確認できる。
+
+使い方:
+    python benchmarks/blob_benchmark.py --size-mb 64 --bandwidth-mbps 200
+    python benchmarks/blob_benchmark.py --output bench_results/blob.json
+    python benchmarks/blob_benchmark.py --baseline bench_results/blob.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import multiprocessing
+
+# リポジトリのルート（各モジュールはここから import する）
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve(conn, index_dir, latency_ms, bandwidth_mbps):
+    """モックサーバーを起動し、環境変数を親プロセスに渡して停止の指示を待つ（別プロセスで実行する）。"""
+    from mock_services import MockState, MockServices, ServiceProfile
+
+    state = MockState(index_dir, profiles={"blob": ServiceProfile(latency_ms, bandwidth_mbps=bandwidth_mbps)})
+    with MockServices(state) as services:
+        conn.send(services.env())
+        conn.recv()
+
+
+def measure(func):
+    """関数を実行し、(所要時間, メモリ使用量のピーク, 戻り値) を返す。"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func()
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Blob の転送方式ごとの所要時間とメモリ使用量を計測する")
+    parser.add_argument("--size-mb", type=int, default=64, help="転送するファイルの大きさ（MB）")
+    parser.add_argument("--block-mb", type=int, default=4, help="ブロックの大きさ（MB）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に転送するブロック数")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="モックサーバーの応答遅延（ミリ秒）")
+    parser.add_argument("--bandwidth-mbps", type=float, default=200.0, help="モックサーバーの1接続あたりの転送速度（Mbps）")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    parser.add_argument("--baseline", help="比較対象とする以前の結果の JSON ファイル")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+
+    size = args.size_mb * 1024 * 1024
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        # ログ・計測結果は作業ディレクトリに出力する
+        os.chdir(workdir)
+        source = os.path.join(workdir, "attachment.bin")
+        with open(source, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        parent, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(
+            target=serve, args=(child, os.path.join(workdir, "mock_index"), args.latency_ms, args.bandwidth_mbps)
+        )
+        server.start()
+        try:
+            os.environ.update(parent.recv())
+            os.environ.setdefault("LOG_LEVEL", "WARNING")
+            import blobstorage
+
+            blobstorage.BLOB_BLOCK_SIZE = args.block_mb * 1024 * 1024
+            blobstorage.BLOB_TRANSFER_CONCURRENCY = args.concurrency
+            target = os.path.join(workdir, "download.bin")
+
+            def upload(single):
+                blobstorage.BLOB_SINGLE_UPLOAD_MAX_BYTES = size if single else args.block_mb * 1024 * 1024
+                return blobstorage.upload_image_to_blob_storage_via_restapi("/bench/attachment.bin", source)
+
+            def download(ranged):
+                blobstorage.BLOB_RANGED_DOWNLOAD_MIN_BYTES = 1 if ranged else 0
+                return blobstorage.download_blob_to_file("/bench/attachment.bin", target)
+
+            cases = {
+                "upload_single": lambda: upload(True).status_code == 201,
+                "upload_blocks": lambda: upload(False).status_code == 201,
+                "download_memory": lambda: len(
+                    blobstorage.download_file_from_blob_storage_via_restapi("/bench/attachment.bin") or b""
+                ) == size,
+                "download_stream": lambda: download(False) == size,
+                "download_ranged": lambda: download(True) == size,
+            }
+            for name, func in cases.items():
+                elapsed, peak, ok = measure(func)
+                results[name] = {
+                    "ok": bool(ok),
+                    "seconds": elapsed,
+                    "mb_per_s": args.size_mb / elapsed if elapsed else 0.0,
+                    "peak_mb": peak / 1024 / 1024,
+                }
+        finally:
+            parent.send("stop")
+            server.join()
+
+    print(f"{'case':18} {'ok':>4} {'seconds':>9} {'MB/s':>8} {'peak MB':>9} {'vs baseline':>12}")
+    for name, r in results.items():
+        diff = ""
+        if name in baseline:
+            base = baseline[name]["seconds"]
+            diff = f"{(r['seconds'] - base) / base * 100:+.1f}%" if base else ""
+        print(f"{name:18} {str(r['ok']):>4} {r['seconds']:9.2f} {r['mb_per_s']:8.1f} {r['peak_mb']:9.1f} {diff:>12}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "config": vars(args),
+                    "results": results,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
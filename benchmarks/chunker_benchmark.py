@@ -0,0 +1,213 @@
+"""
+チャンク分割ベンチマーク
+従来の RecursiveCharacterTextSplitter（split_markdown_by_recursive_splitter）と
+構造を考慮した分割（markdown_chunker.MarkdownChunker）の処理速度と分割結果を比較する。
+分割結果は、チャンク数・平均/最大文字数・埋め込みトークン数（概算）と、
+途中で切れた画像リンク・コードブロック・表ヘッダーのないチャンクの数を出力する。
+
+入力を指定しない場合は、見出し・表・コードブロック・画像リンクを含む大きな仕様書を生成して使う。
+
+使い方:
+    python benchmarks/chunker_benchmark.py --sections 400 --repeat 5
+    python benchmarks/chunker_benchmark.py --input markdown/ --output bench_results/chunker.json
+    python benchmarks/chunker_benchmark.py --baseline bench_results/chunker.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+
+# リポジトリのルート（各モジュールはここから import する）
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+_IMAGE_LINK = re.compile(r"!\[.*?\]\((.*?)\)")
+_FENCE_LINE = re.compile(r"^ {0,3}(`{3,}|~{3,})", re.MULTILINE)
+_TABLE_SEPARATOR = re.compile(r"^[ \t]*\|?[ \t]*:?-+:?[ \t]*(\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$")
+
+_WORDS = ["設定", "画面", "入力", "項目", "処理", "結果", "登録", "検索", "条件", "表示", "更新", "削除", "確認", "利用者", "管理者"]
+
+
+def make_spec(sections, seed=0):
+    """見出し・段落・表・コードブロック・画像リンクを含む仕様書の Markdown を生成する。"""
+    rng = random.Random(seed)
+
+    def sentence():
+        words = rng.choices(_WORDS, k=rng.randint(4, 10))
+        return "の".join(words[:2]) + "を" + "し、".join(words[2:]) + "します。"
+
+    lines = ["# 製品仕様書", ""]
+    for i in range(sections):
+        lines += [f"## {i + 1}. 機能{i + 1}", ""]
+        for j in range(rng.randint(1, 3)):
+            lines += [f"### {i + 1}.{j + 1} 詳細{j + 1}", ""]
+            for _ in range(rng.randint(1, 3)):
+                lines += ["".join(sentence() for _ in range(rng.randint(2, 12))), ""]
+            if rng.random() < 0.4:
+                lines += [
+                    f"設定画面は次のとおりです。![機能{i + 1}の画面{j + 1}](images/feature_{i + 1}_{j + 1}_screen.png) "
+                    + sentence(),
+                    "",
+                ]
+            if rng.random() < 0.3:
+                lines += ["| 項目 | 型 | 説明 |", "|---|---|---|"]
+                lines += [f"| field_{k} | string | {sentence()} |" for k in range(rng.randint(3, 30))]
+                lines.append("")
+            if rng.random() < 0.2:
+                lines += ["```json", "{"]
+                lines += [f'  "key_{k}": "{rng.choice(_WORDS)}",' for k in range(rng.randint(3, 40))]
+                lines += ["}", "```", ""]
+    return "\n".join(lines)
+
+
+def load_inputs(args):
+    """ベンチマークに使う (名前, Markdown) のリストを返す。"""
+    if args.input:
+        paths = [args.input] if os.path.isfile(args.input) else [
+            os.path.join(args.input, name) for name in sorted(os.listdir(args.input)) if name.endswith(".md")
+        ]
+        documents = []
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                documents.append((os.path.basename(path), f.read()))
+        return documents
+    return [(f"spec_{i}.md", make_spec(args.sections, seed=i)) for i in range(args.files)]
+
+
+def analyze(documents, chunk_lists):
+    """分割結果の品質（チャンク数・切れた構造の数）を集計する。"""
+    from embedding_stage import estimate_tokens
+
+    texts = [text for chunks in chunk_lists for text in chunks]
+    source_images = len({link for _, markdown in documents for link in _IMAGE_LINK.findall(markdown)})
+    found_images = set()
+    broken_images = 0
+    broken_code = 0
+    headless_tables = 0
+    for text in texts:
+        complete = _IMAGE_LINK.findall(text)
+        found_images.update(complete)
+        # "![" が残っているのに完成した画像リンクとして取り出せないもの
+        broken_images += max(0, text.count("![") - len(complete))
+        if len(_FENCE_LINE.findall(text)) % 2:
+            broken_code += 1
+        table_lines = [line for line in text.split("\n") if line.lstrip().startswith("|")]
+        if table_lines and not any(_TABLE_SEPARATOR.match(line) for line in table_lines):
+            headless_tables += 1
+    lengths = [len(text) for text in texts] or [0]
+    return {
+        "chunks": len(texts),
+        "mean_chars": statistics.mean(lengths),
+        "max_chars": max(lengths),
+        "embedding_tokens": sum(estimate_tokens(text) for text in texts),
+        "source_images": source_images,
+        "images_found": len(found_images),
+        "broken_image_links": broken_images,
+        "broken_code_blocks": broken_code,
+        "table_chunks_without_header": headless_tables,
+    }
+
+
+def run_splitter(split, documents, repeat):
+    """1つの分割方法の処理時間と分割結果を計測する。"""
+    total_bytes = sum(len(markdown.encode("utf-8")) for _, markdown in documents)
+    samples = []
+    chunk_lists = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunk_lists = [split(markdown) for _, markdown in documents]
+        samples.append(time.perf_counter() - start)
+    median = statistics.median(samples)
+    return {
+        "median_s": median,
+        "min_s": min(samples),
+        "mb_per_s": total_bytes / 1024 / 1024 / median if median else 0.0,
+        **analyze(documents, chunk_lists),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="チャンク分割の処理速度と分割結果を比較する")
+    parser.add_argument("--input", help="Markdown ファイルまたはディレクトリ（省略時は仕様書を生成する）")
+    parser.add_argument("--files", type=int, default=4, help="生成する仕様書の数")
+    parser.add_argument("--sections", type=int, default=300, help="生成する仕様書の章の数")
+    parser.add_argument("--chunk-size", type=int, default=500, help="1チャンクの最大文字数")
+    parser.add_argument("--chunk-overlap", type=int, default=50, help="チャンク間の重複文字数")
+    parser.add_argument("--repeat", type=int, default=5, help="各計測の繰り返し回数")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    parser.add_argument("--baseline", help="比較対象とする以前の結果の JSON ファイル")
+    args = parser.parse_args(argv)
+
+    from markdown_chunker import MarkdownChunker
+
+    documents = load_inputs(args)
+    total_bytes = sum(len(markdown.encode("utf-8")) for _, markdown in documents)
+    print(f"入力: {len(documents)} ファイル, {total_bytes / 1024 / 1024:.2f} MB")
+
+    chunker = MarkdownChunker(args.chunk_size, args.chunk_overlap)
+    splitters = {
+        "markdown_chunker": lambda markdown: [chunk.text for chunk in chunker.split_text(markdown)],
+    }
+    try:
+        from upload_to_azure_search import split_markdown_by_recursive_splitter
+        splitters = {
+            "recursive_splitter": lambda markdown: split_markdown_by_recursive_splitter(
+                markdown, args.chunk_size, args.chunk_overlap
+            ),
+            **splitters,
+        }
+    except ImportError as e:
+        print(f"recursive_splitter: 比較対象を読み込めないためスキップします ({e})")
+
+    results = {}
+    for name, split in splitters.items():
+        try:
+            results[name] = run_splitter(split, documents, args.repeat)
+        except ImportError as e:
+            print(f"{name}: 失敗 ({e})")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+
+    print(
+        f"{'splitter':20} {'median':>9} {'MB/s':>8} {'chunks':>7} {'mean':>7} {'max':>6} "
+        f"{'tokens':>9} {'img':>9} {'broken(img/code/table)':>23} {'vs baseline':>12}"
+    )
+    for name, r in results.items():
+        diff = ""
+        if name in baseline:
+            base = baseline[name]["median_s"]
+            diff = f"{(r['median_s'] - base) / base * 100:+.1f}%" if base else ""
+        broken = f"{r['broken_image_links']}/{r['broken_code_blocks']}/{r['table_chunks_without_header']}"
+        images = f"{r['images_found']}/{r['source_images']}"
+        print(
+            f"{name:20} {r['median_s']:9.3f} {r['mb_per_s']:8.2f} {r['chunks']:7d} {r['mean_chars']:7.0f} "
+            f"{r['max_chars']:6d} {r['embedding_tokens']:9d} {images:>9} {broken:>23} {diff:>12}"
+        )
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "repeat": args.repeat,
+                    "input_bytes": total_bytes,
+                    "results": results,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
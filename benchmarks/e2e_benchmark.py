@@ -0,0 +1,443 @@
+"""
+エンドツーエンドベンチマーク
+Azure AI Search・Blob Storage・OpenAI をローカルのモックサーバー（mock_services.py）に置き換え、
+合成した Markdown + 画像のコーパスで次の処理を計測する。
+
+- 取り込み: upload_to_azure_search.main() をフル登録と、一部のファイルを変更した後の差分登録で実行
+- 検索: retriever（AzureAISearchRetriever.invoke）をクエリセットで並行実行
+- 回答: app の回答パイプライン（検索 → 参考情報・画像の準備 → 回答のストリーミング）
+
+ステージごとの件数・スループットと p50/p95/p99 レイテンシ、モックサーバー側で計測した
+エンドポイントごとのリクエスト統計を出力し、JSON に保存して以前の結果と比較できる。
+各モジュールは import 時に環境変数を読むため、モックサーバーを起動して環境変数を設定した後で import する。
+
+使い方:
+    python benchmarks/e2e_benchmark.py --files 20 --output bench_results/e2e.json
+    python benchmarks/e2e_benchmark.py --latency-ms openai=80 --error-rate search=0.05 --baseline bench_results/e2e.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# リポジトリのルート（各モジュールはここから import する）
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_services import SERVICES, MockServices, MockState, ServiceProfile  # noqa: E402
+
+# 合成コーパスの語彙
+VOCABULARY = [
+    "パスワード", "暗号化", "認証", "ログイン", "セッション", "権限", "ロール", "監査ログ",
+    "バックアップ", "リストア", "帳票", "出力", "画面", "入力チェック", "エラーメッセージ", "バッチ処理",
+    "夜間", "ジョブ", "スケジュール", "データベース", "テーブル", "インデックス", "トランザクション", "排他制御",
+    "API", "リクエスト", "レスポンス", "タイムアウト", "リトライ", "キャッシュ", "通知", "メール",
+    "ファイル", "アップロード", "ダウンロード", "CSV", "検索条件", "一覧", "詳細", "更新履歴",
+]
+SENTENCE_ENDINGS = ["を行う。", "について記載する。", "は必須とする。", "の仕様は以下のとおり。", "を設定する。"]
+
+
+# --- 計測 ---
+def percentile(samples, p):
+    """サンプルの p パーセンタイル（最近接順位法）を返す。"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, int(np.ceil(p / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def summarize(samples, wall=None):
+    """レイテンシ（秒）のリストから件数・スループット・パーセンタイル（ミリ秒）をまとめる。"""
+    if not samples:
+        return {"count": 0}
+    summary = {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+    if wall:
+        summary["wall_s"] = wall
+        summary["throughput_per_s"] = len(samples) / wall
+    return summary
+
+
+class StageRecorder:
+    """ステージごとの所要時間と、最初の開始から最後の終了までの時間を記録する。"""
+
+    def __init__(self):
+        # wrap した関数の記録先ステージ名に付ける接頭辞（取り込みの実行ごとに切り替える）
+        self.prefix = ""
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._spans = {}
+
+    def record(self, stage, start, end):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(end - start)
+            first, last = self._spans.get(stage, (start, end))
+            self._spans[stage] = (min(first, start), max(last, end))
+
+    def wrap(self, module, attr, stage):
+        """module.attr の関数を、呼び出しごとの所要時間を記録する関数に置き換える。"""
+        func = getattr(module, attr)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(self.prefix + stage, start, time.perf_counter())
+
+        setattr(module, attr, timed)
+
+    def summary(self):
+        with self._lock:
+            return {
+                stage: summarize(samples, self._spans[stage][1] - self._spans[stage][0])
+                for stage, samples in self._samples.items()
+            }
+
+
+# --- 合成コーパス ---
+def write_png(path, size, rng):
+    """ランダムなノイズ画像（圧縮が効きにくい）を PNG で保存する。"""
+    from PIL import Image
+
+    width, height = size, size * 3 // 4
+    pixels = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+    Image.fromarray(pixels).resize((width, height)).save(path, format="PNG")
+
+
+def make_sentence(rng):
+    words = rng.choice(VOCABULARY, size=int(rng.integers(3, 7)))
+    return "の".join(words) + str(rng.choice(SENTENCE_ENDINGS))
+
+
+def write_markdown(path, name, args, rng):
+    """見出し・段落・表・画像リンクを含む Markdown ファイルを作成する。"""
+    lines = [f"# {name} 設計書", ""]
+    image_slots = set(rng.choice(args.paragraphs, size=min(args.images_per_file, args.paragraphs), replace=False))
+    for i in range(args.paragraphs):
+        if i % 5 == 0:
+            lines += [f"## {i // 5 + 1}. {rng.choice(VOCABULARY)}", ""]
+        lines.append("".join(make_sentence(rng) for _ in range(int(rng.integers(2, 6)))))
+        lines.append("")
+        if i % 7 == 3:
+            lines += ["| 項目 | 内容 |", "| --- | --- |"]
+            lines += [f"| {rng.choice(VOCABULARY)} | {make_sentence(rng)} |" for _ in range(3)]
+            lines.append("")
+        if i in image_slots:
+            image_name = f"images/{name}_{i}.png"
+            write_png(os.path.join(os.path.dirname(path), image_name), args.image_size, rng)
+            lines += [f"![{image_name}]({image_name})", ""]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def generate_corpus(directory, args):
+    """合成コーパスを作成し、Markdown ファイルのパスのリストを返す。"""
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(os.path.join(directory, "images"), exist_ok=True)
+    paths = []
+    for i in range(args.files):
+        name = f"doc{i:04d}"
+        path = os.path.join(directory, f"{name}.md")
+        write_markdown(path, name, args, rng)
+        paths.append(path)
+    return paths
+
+
+def modify_corpus(paths, ratio, rng):
+    """一部のファイルの末尾に段落を追記する（差分登録の計測用）。"""
+    count = max(1, int(len(paths) * ratio)) if ratio > 0 else 0
+    for path in rng.choice(paths, size=min(count, len(paths)), replace=False):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("\n## 追記\n\n" + make_sentence(rng) + "\n")
+    return count
+
+
+def load_queries(args):
+    """クエリセットを読み込む（指定がなければ語彙から生成する）。"""
+    if args.query_file:
+        with open(args.query_file, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+    rng = random.Random(args.seed)
+    return [" ".join(rng.sample(VOCABULARY, rng.randint(1, 3))) + "は？" for _ in range(args.queries)]
+
+
+# --- 各ベンチマーク ---
+def run_ingest(recorder, label, args):
+    """upload_to_azure_search.main() を実行し、所要時間と取り込み件数を返す。"""
+    import upload_to_azure_search
+
+    stage_args = [
+        "--parse-workers", str(args.parse_workers),
+        "--image-workers", str(args.image_workers),
+        "--embed-workers", str(args.embed_workers),
+        "--index-workers", str(args.index_workers),
+    ]
+    recorder.prefix = f"ingest_{label}."
+    start = time.perf_counter()
+    failed = upload_to_azure_search.main(stage_args + (["--full"] if label == "full" else []))
+    wall = time.perf_counter() - start
+    recorder.record(f"ingest_{label}.total", start, start + wall)
+    return {"wall_s": wall, "failed_files": len(failed)}
+
+
+def run_queries(recorder, queries, args):
+    """Retriever でクエリセットを並行に実行する。"""
+    import retriever as retriever_module
+    from retriever import AzureAISearchRetriever
+
+    retriever = AzureAISearchRetriever(
+        service_name=os.environ["AZURE_SEARCH_ENDPOINT"],
+        api_key=os.environ["AZURE_SEARCH_API_KEY"],
+        index_name=os.environ["AZURE_SEARCH_INDEX"],
+        qa_content_key="text",
+        qa_top=args.top,
+        qa_scoring_profile="",
+        query_vector_mode=args.query_vector_mode,
+    )
+    empty = 0
+    for round_index in range(args.query_rounds):
+        stage = f"query.round{round_index + 1}"
+
+        def run(query):
+            start = time.perf_counter()
+            documents = retriever.invoke(query)
+            recorder.record(stage, start, time.perf_counter())
+            return len(documents)
+
+        with ThreadPoolExecutor(max_workers=args.query_concurrency) as executor:
+            empty += sum(1 for count in executor.map(run, queries) if count == 0)
+    return {"empty_results": empty, "caches": retriever_module.get_cache_stats()}
+
+
+def run_answers(recorder, queries, args):
+    """
+    app の回答パイプライン（検索・参考情報と画像の準備・回答生成）を実行する。
+    2回目以降は回答キャッシュから返るため、回答生成を行わずに返した質問は answer.cached に記録する。
+    """
+    import streamlit as st
+    import app
+    from answer_cache import get_answer_cache
+
+    settings = app.load_settings()
+    retriever, llm = app.init_services(settings)
+    ttfts = []
+    for _ in range(args.answer_rounds):
+        for query in queries[:args.answers]:
+            start = time.perf_counter()
+            results = retriever.invoke(query)
+            retrieved = time.perf_counter()
+            recorder.record("answer.retrieve", start, retrieved)
+
+            tabs = st.tabs(["回答", "参考情報"])
+            references, image_templates, imagedict_all = app.process_search_results(results, tabs)
+            prepared = time.perf_counter()
+            recorder.record("answer.references", retrieved, prepared)
+
+            query_vector, doc_ids, cached = app.find_cached_answer(query, results, retriever, llm)
+            if cached is not None:
+                recorder.record("answer.cached", start, time.perf_counter())
+                continue
+            if settings["STREAM_ANSWER"]:
+                answer, ttft = app.stream_answer(query, references, image_templates, llm, imagedict_all)
+                if ttft is not None:
+                    recorder.record("answer.ttft", prepared, prepared + ttft)
+                    ttfts.append(ttft)
+            else:
+                answer = app.generate_answer(query, references, image_templates, llm)
+            if query_vector is not None:
+                get_answer_cache().put(query, query_vector, doc_ids, answer, namespace=llm.model_name)
+            end = time.perf_counter()
+            recorder.record("answer.generate", prepared, end)
+            recorder.record("answer.total", start, end)
+
+    from image_cache import get_image_cache
+    return {"image_cache": get_image_cache().stats(), "answer_cache": get_answer_cache().stats()}
+
+
+# --- 引数・出力 ---
+def parse_service_values(values, name):
+    """"service=value" 形式の指定を辞書にする。"""
+    result = {}
+    for value in values or []:
+        service, _, number = value.partition("=")
+        if service not in SERVICES or not number:
+            raise SystemExit(f"--{name} は {'/'.join(SERVICES)}=数値 の形式で指定してください: {value}")
+        result[service] = float(number)
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="モックサーバーを使って取り込み・検索・回答の性能を計測する")
+    corpus = parser.add_argument_group("コーパス")
+    corpus.add_argument("--files", type=int, default=20, help="Markdown ファイル数")
+    corpus.add_argument("--paragraphs", type=int, default=40, help="1ファイルあたりの段落数")
+    corpus.add_argument("--images-per-file", type=int, default=3, help="1ファイルあたりの画像数")
+    corpus.add_argument("--image-size", type=int, default=800, help="画像の幅（ピクセル）")
+    corpus.add_argument("--modify-ratio", type=float, default=0.1, help="差分登録の前に変更するファイルの割合")
+    corpus.add_argument("--seed", type=int, default=42)
+
+    services = parser.add_argument_group("モックサーバー")
+    services.add_argument("--latency-ms", action="append", metavar="SERVICE=MS",
+                          help="サービスごとの応答遅延（例: openai=80）。既定: search=20 blob=10 openai=50")
+    services.add_argument("--jitter-ms", action="append", metavar="SERVICE=MS", help="応答遅延の揺らぎの最大値")
+    services.add_argument("--error-rate", action="append", metavar="SERVICE=RATE",
+                          help="リクエストを 429/503 で失敗させる確率（例: search=0.05）")
+    services.add_argument("--partial-failure-rate", type=float, default=0.0,
+                          help="search.index でアイテムを 503 で失敗させる確率（207 応答）")
+    services.add_argument("--dimensions", type=int, default=3072, help="埋め込みベクトルの次元数")
+    services.add_argument("--chat-token-ms", type=float, default=20.0, help="回答のトークンを送る間隔（ミリ秒）")
+
+    workload = parser.add_argument_group("ワークロード")
+    workload.add_argument("--parse-workers", type=int, default=os.cpu_count() or 1)
+    workload.add_argument("--image-workers", type=int, default=4)
+    workload.add_argument("--embed-workers", type=int, default=4)
+    workload.add_argument("--index-workers", type=int, default=2)
+    workload.add_argument("--query-file", help="クエリセット（1行1クエリ）。省略時は語彙から生成する")
+    workload.add_argument("--queries", type=int, default=50, help="生成するクエリ数")
+    workload.add_argument("--query-rounds", type=int, default=2, help="クエリセットを繰り返す回数（2回目以降はキャッシュが効く）")
+    workload.add_argument("--query-concurrency", type=int, default=4)
+    workload.add_argument("--query-vector-mode", choices=["text", "vector"], default="text")
+    workload.add_argument("--top", type=int, default=3)
+    workload.add_argument("--answers", type=int, default=10, help="回答パイプラインを実行するクエリ数")
+    workload.add_argument("--answer-rounds", type=int, default=2,
+                          help="回答パイプラインを繰り返す回数（2回目以降は回答キャッシュが効く）")
+    workload.add_argument("--skip", action="append", choices=["ingest", "query", "answer"], default=[],
+                          help="実行しない計測")
+
+    output = parser.add_argument_group("出力")
+    output.add_argument("--workdir", help="作業ディレクトリ（省略時は一時ディレクトリを作成して最後に削除する）")
+    output.add_argument("--output", help="結果を保存する JSON ファイル")
+    output.add_argument("--baseline", help="比較対象とする以前の結果の JSON ファイル")
+    return parser.parse_args(argv)
+
+
+def print_report(results, baseline):
+    print(f"\n{'stage':28} {'count':>6} {'tput/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'vs base p50':>12}")
+    for stage, s in sorted(results["stages"].items()):
+        diff = ""
+        base = baseline.get("stages", {}).get(stage)
+        if base and base.get("p50_ms"):
+            diff = f"{(s['p50_ms'] - base['p50_ms']) / base['p50_ms'] * 100:+.1f}%"
+        print(
+            f"{stage:28} {s['count']:6d} {s.get('throughput_per_s', 0):9.2f} "
+            f"{s['p50_ms']:9.1f} {s['p95_ms']:9.1f} {s['p99_ms']:9.1f} {diff:>12}"
+        )
+    print(f"\n{'endpoint (server side)':28} {'count':>6} {'errors':>7} {'MB in':>8} {'p50 ms':>9} {'p95 ms':>9}")
+    for endpoint, s in sorted(results["server"].items()):
+        print(
+            f"{endpoint:28} {s['count']:6d} {s['errors']:7d} {s['bytes_in'] / 1e6:8.2f} "
+            f"{s['p50_ms']:9.1f} {s['p95_ms']:9.1f}"
+        )
+    for label, ingest in results.get("ingest", {}).items():
+        print(f"\n取り込み（{label}）: {ingest['wall_s']:.2f} 秒, 失敗 {ingest['failed_files']} ファイル")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    latency = {"search": 20.0, "blob": 10.0, "openai": 50.0}
+    latency.update(parse_service_values(args.latency_ms, "latency-ms"))
+    jitter = parse_service_values(args.jitter_ms, "jitter-ms")
+    error_rate = parse_service_values(args.error_rate, "error-rate")
+    profiles = {
+        service: ServiceProfile(latency.get(service, 0.0), jitter.get(service, 0.0), error_rate.get(service, 0.0))
+        for service in SERVICES
+    }
+
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="aisearch-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    # キャッシュ・ログ・マニフェストはすべて作業ディレクトリに作る
+    # （モックサーバーの検索エンジンの import でもログの出力先が決まるため、その前に移動する）
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    state = MockState(
+        os.path.join(workdir, "mock_index"),
+        profiles=profiles,
+        embedding_dimensions=args.dimensions,
+        partial_failure_rate=args.partial_failure_rate,
+        chat_token_ms=args.chat_token_ms,
+    )
+    recorder = StageRecorder()
+    results = {"ingest": {}}
+    try:
+        with MockServices(state) as services:
+            os.environ.update(services.env())
+            os.environ.update({
+                "MARKDOWN_DIR": os.path.join(workdir, "corpus"),
+                "SEARCH_BACKEND": "azure",
+                "QUERY_VECTOR_MODE": args.query_vector_mode,
+            })
+            paths = generate_corpus(os.environ["MARKDOWN_DIR"], args)
+            queries = load_queries(args)
+
+            if "ingest" not in args.skip:
+                import upload_to_azure_search
+                # ステージの処理関数を計測用にラップする（解析はプロセスプールで動くため全体時間のみ）
+                recorder.wrap(upload_to_azure_search, "build_documents", "image")
+                recorder.wrap(upload_to_azure_search, "embed_texts", "embed")
+                recorder.wrap(upload_to_azure_search, "upload_to_azure_search", "index")
+                recorder.wrap(upload_to_azure_search, "sync_document_chunks", "index")
+                results["ingest"]["full"] = run_ingest(recorder, "full", args)
+                modified = modify_corpus(paths, args.modify_ratio, np.random.default_rng(args.seed + 1))
+                if modified:
+                    results["ingest"]["incremental"] = run_ingest(recorder, "incremental", args)
+                    results["ingest"]["incremental"]["modified_files"] = modified
+                results["indexed_documents"] = len(state.engine.docs)
+            if "query" not in args.skip:
+                results["query"] = run_queries(recorder, queries, args)
+            if "answer" not in args.skip:
+                results["answer"] = run_answers(recorder, queries, args)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results["stages"] = recorder.summary()
+    results["server"] = {}
+    for endpoint, stats in state.stats().items():
+        latencies = stats.pop("latencies")
+        results["server"][endpoint] = {**stats, **summarize(latencies)}
+    print_report(results, baseline)
+
+    if output:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "config": vars(args),
+                    **results,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+ロギングベンチマーク
+logging_config の設定（同期書き込み / キュー経由の非同期書き込み、text / json）ごとに、
+複数スレッドから logger.info を呼んだときの1回あたりの呼び出し時間（p50/p99/最大）を計測する。
+設定は import 時の環境変数で決まるため、設定ごとに新しいプロセスで実行する。
+
+使い方:
+    python benchmarks/logging_benchmark.py --records 20000 --payload-chars 20000
+    python benchmarks/logging_benchmark.py --output bench_results/logging.json
+    python benchmarks/logging_benchmark.py --baseline bench_results/logging.json
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+import subprocess
+
+# リポジトリのルート（各モジュールはここから import する）
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 計測対象: 名前 -> 環境変数
+MODES = {
+    "sync_text": {"LOG_ASYNC": "false", "LOG_FORMAT": "text", "LOG_MAX_FIELD_CHARS": "0"},
+    "sync_text_truncated": {"LOG_ASYNC": "false", "LOG_FORMAT": "text"},
+    "async_text": {"LOG_ASYNC": "true", "LOG_FORMAT": "text"},
+    "async_json": {"LOG_ASYNC": "true", "LOG_FORMAT": "json"},
+}
+
+# 新しいプロセスで実行するコード（ログの呼び出し時間を計測して JSON で出力する）
+_WORKER = """
+import os, sys, json, time, threading
+sys.path.insert(0, {root!r})
+from logging_config import configure_logging, stop_logging
+import logging
+configure_logging(log_file={log_file!r})
+logger = logging.getLogger("bench")
+payload = "あ" * {payload_chars}
+metadata = {{"parent_filename": "spec.md", "imagebloburls": ["https://example/image.png"] * 20}}
+samples = []
+lock = threading.Lock()
+
+def work(count):
+    local = []
+    for i in range(count):
+        start = time.perf_counter()
+        logger.info("Content: %s Metadata: %s (%d)", payload, metadata, i)
+        local.append(time.perf_counter() - start)
+    with lock:
+        samples.extend(local)
+
+threads = [threading.Thread(target=work, args=({records} // {threads},)) for _ in range({threads})]
+start = time.perf_counter()
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+elapsed = time.perf_counter() - start
+stop_logging()
+drained = time.perf_counter() - start
+samples.sort()
+print("RESULT", json.dumps({{
+    "calls": len(samples),
+    "p50_us": samples[len(samples) // 2] * 1e6,
+    "p99_us": samples[int(len(samples) * 0.99)] * 1e6,
+    "max_us": samples[-1] * 1e6,
+    "calls_s": elapsed,
+    "drained_s": drained,
+}}))
+"""
+
+
+def run_mode(env, args, log_dir):
+    """1つの設定で計測する。"""
+    # logging_config は import 時にカレントディレクトリに log/ を作るため、その中に書き込む
+    file_dir = os.path.join(log_dir, "log")
+    os.makedirs(file_dir, exist_ok=True)
+    for name in os.listdir(file_dir):
+        os.remove(os.path.join(file_dir, name))
+    log_file = os.path.join(file_dir, "bench.log")
+    code = _WORKER.format(
+        root=ROOT_DIR, log_file=log_file, payload_chars=args.payload_chars,
+        records=args.records, threads=args.threads,
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=log_dir,
+        env={**os.environ, "LOG_SAMPLE_RATES": "", **env},
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "実行に失敗しました")
+    for line in result.stdout.splitlines():
+        if line.startswith("RESULT "):
+            r = json.loads(line[len("RESULT "):])
+            r["log_bytes"] = sum(os.path.getsize(os.path.join(file_dir, name)) for name in os.listdir(file_dir))
+            return r
+    raise RuntimeError("計測結果を取得できませんでした")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ロギングの設定ごとの呼び出し時間を計測する")
+    parser.add_argument("--records", type=int, default=20000, help="出力するログの件数")
+    parser.add_argument("--threads", type=int, default=4, help="ログを出力するスレッド数")
+    parser.add_argument("--payload-chars", type=int, default=20000, help="ログの引数の文字数（検索結果の本文などを想定）")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    parser.add_argument("--baseline", help="比較対象とする以前の結果の JSON ファイル")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+
+    results = {}
+    with tempfile.TemporaryDirectory() as log_dir:
+        for name, env in MODES.items():
+            try:
+                results[name] = run_mode(env, args, log_dir)
+            except RuntimeError as e:
+                print(f"{name}: 失敗 ({e})")
+
+    print(
+        f"{'mode':22} {'p50 us':>9} {'p99 us':>9} {'max us':>10} {'calls s':>8} "
+        f"{'drained s':>10} {'log MB':>8} {'vs baseline':>12}"
+    )
+    for name, r in results.items():
+        diff = ""
+        if name in baseline:
+            base = baseline[name]["p50_us"]
+            diff = f"{(r['p50_us'] - base) / base * 100:+.1f}%" if base else ""
+        print(
+            f"{name:22} {r['p50_us']:9.1f} {r['p99_us']:9.1f} {r['max_us']:10.1f} {r['calls_s']:8.2f} "
+            f"{r['drained_s']:10.2f} {r['log_bytes'] / 1024 / 1024:8.1f} {diff:>12}"
+        )
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "records": args.records,
+                    "threads": args.threads,
+                    "payload_chars": args.payload_chars,
+                    "results": results,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+"""
+ベンチマーク用のローカルモックサーバー
+Azure AI Search（search.index / search）、Blob Storage（PUT / HEAD / GET）、
+OpenAI（embeddings / chat.completions）の REST API を1つの HTTP サーバーで模擬する。
+サービスごとに応答遅延とエラー（429/503）の発生率を設定でき、search.index では
+一部のアイテムだけが失敗する 207 応答も発生させられる。
+
+パスの割り当て:
+    /search/indexes/{index}/docs/search.index   Azure AI Search のインデックス登録
+    /search/indexes/{index}/docs/search         Azure AI Search の検索
+    /blob/{blob_path}                           Blob Storage
+    /openai/v1/embeddings                       OpenAI の埋め込み
+    /openai/v1/chat/completions                 OpenAI のチャット（stream 対応）
+"""
+import re
+import sys
+import json
+import time
+import zlib
+import base64
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote, parse_qs
+
+import numpy as np
+
+SERVICES = ("search", "blob", "openai")
+
+
+class ServiceProfile:
+    """
+    サービスごとの応答遅延とエラー発生率
+    :param latency_ms: 応答までの遅延（ミリ秒）
+    :param jitter_ms: 遅延に加えるランダムな揺らぎの最大値（ミリ秒）
+    :param error_rate: リクエスト全体を 429/503 で失敗させる確率
+    :param bandwidth_mbps: 1接続あたりの転送速度（Mbps。0 で制限しない）
+    """
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, bandwidth_mbps=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.bandwidth_mbps = bandwidth_mbps
+
+    def transfer(self, nbytes):
+        """1接続あたりの転送速度の分だけ待つ。"""
+        if self.bandwidth_mbps > 0 and nbytes:
+            time.sleep(nbytes * 8 / (self.bandwidth_mbps * 1000 * 1000))
+
+    def delay(self):
+        """設定した遅延だけ待つ。"""
+        seconds = (self.latency_ms + random.random() * self.jitter_ms) / 1000
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class MockState:
+    """
+    モックサーバーの状態（登録済みドキュメント・Blob）とリクエスト統計
+    :param index_dir: 検索インデックス（local_search.LocalSearchEngine）の保存先
+    :param embedding_dimensions: 埋め込みベクトルの次元数
+    :param partial_failure_rate: search.index で各アイテムを 503 で失敗させる確率
+    :param chat_token_ms: チャットのストリーミングでトークンを送る間隔（ミリ秒）
+    """
+
+    def __init__(self, index_dir, profiles=None, embedding_dimensions=3072,
+                 partial_failure_rate=0.0, chat_token_ms=20.0, chat_tokens=60):
+        from local_search import LocalSearchEngine
+
+        self.profiles = {service: ServiceProfile() for service in SERVICES}
+        self.profiles.update(profiles or {})
+        self.engine = LocalSearchEngine(index_dir)
+        self.embedding_dimensions = embedding_dimensions
+        self.partial_failure_rate = partial_failure_rate
+        self.chat_token_ms = chat_token_ms
+        self.chat_tokens = chat_tokens
+        self.blobs = {}
+        # Put Block で受け取った確定前のブロック: (Blob パス, ブロック id) -> データ
+        self.blocks = {}
+        self.blocks_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # エンドポイント -> {"count", "errors", "bytes_in", "bytes_out", "latencies"}
+        self._stats = {}
+
+    def record(self, endpoint, status, bytes_in, bytes_out, elapsed):
+        with self._lock:
+            stats = self._stats.setdefault(
+                endpoint, {"count": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0, "latencies": []}
+            )
+            stats["count"] += 1
+            # 存在確認の 404 は正常な応答として扱い、注入した失敗・サーバーエラー・部分失敗を数える
+            if status in (207, 429) or status >= 500:
+                stats["errors"] += 1
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            stats["latencies"].append(elapsed)
+
+    def stats(self):
+        """エンドポイントごとのリクエスト統計（サーバー側で計測した処理時間のリスト付き）を返す。"""
+        with self._lock:
+            return {
+                endpoint: {**stats, "latencies": list(stats["latencies"])}
+                for endpoint, stats in self._stats.items()
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+    def vector_for(self, value, dimensions=None):
+        """
+        入力（テキストまたはトークン列）から決まる単位ベクトルを返す。
+        dimensions を指定した場合は、text-embedding-3 系と同じく先頭を切り出して正規化し直す。
+        """
+        seed = zlib.crc32(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        vector = np.random.default_rng(seed).standard_normal(self.embedding_dimensions).astype(np.float32)
+        if dimensions:
+            vector = vector[:dimensions]
+        vector /= np.linalg.norm(vector)
+        return vector
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """モックサーバーのリクエストハンドラ"""
+    # Keep-Alive を有効にしてクライアントの接続プールの効果も計測できるようにする
+    protocol_version = "HTTP/1.1"
+    server_version = "MockServices/1.0"
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        # リクエストごとのアクセスログは出さない
+        pass
+
+    # --- 共通処理 ---
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body=b"", headers=None, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        if content_type and status != 304:
+            self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body) if status != 304 else 0))
+        self.end_headers()
+        if status != 304 and self.command != "HEAD":
+            self.wfile.write(body)
+        return len(body)
+
+    def _dispatch(self):
+        start = time.perf_counter()
+        path = urlsplit(self.path).path
+        body = self._read_body()
+        service = path.strip("/").split("/", 1)[0]
+        profile = self.state.profiles.get(service)
+        status, sent, endpoint = 404, 0, f"{self.command} {service}"
+        try:
+            if profile is None:
+                sent = self._send(404, {"error": "not found"})
+                return
+            profile.delay()
+            profile.transfer(len(body))
+            if random.random() < profile.error_rate:
+                # OpenAI はレート制限、それ以外はサービス一時停止として失敗させる
+                status = 429 if service == "openai" else 503
+                sent = self._send(status, {"error": {"message": "injected failure"}},
+                                  headers={"Retry-After": "0", "retry-after-ms": "10"})
+                return
+            handler = getattr(self, f"_handle_{service}")
+            endpoint, status, sent = handler(path, body)
+        except (BrokenPipeError, ConnectionResetError):
+            status = 499
+        except Exception as e:
+            status = 500
+            sent = self._send(500, {"error": {"message": str(e)}})
+        finally:
+            self.state.record(endpoint, status, len(body), sent, time.perf_counter() - start)
+
+    do_GET = _dispatch
+    do_PUT = _dispatch
+    do_POST = _dispatch
+    do_HEAD = _dispatch
+
+    # --- Azure AI Search ---
+    def _handle_search(self, path, body):
+        if path.endswith("/docs/search.index") and self.command == "POST":
+            return self._search_index(json.loads(body or b"{}"))
+        if path.endswith("/docs/search") and self.command == "POST":
+            return self._search_query(json.loads(body or b"{}"))
+        return "search other", 404, self._send(404, {"error": "not found"})
+
+    def _search_index(self, payload):
+        actions = payload.get("value", [])
+        # 部分失敗を発生させるアイテムはインデックスに適用しない
+        failing = {
+            action["id"] for action in actions if random.random() < self.state.partial_failure_rate
+        }
+        failed = set(self.state.engine.index_actions([a for a in actions if a["id"] not in failing]))
+        failed |= failing
+        value = [
+            {
+                "key": action["id"],
+                "status": action["id"] not in failed,
+                "statusCode": 503 if action["id"] in failing else (404 if action["id"] in failed else 200),
+                "errorMessage": None if action["id"] not in failed else "injected failure",
+            }
+            for action in actions
+        ]
+        status = 207 if failed else 200
+        return "POST search.index", status, self._send(status, {"value": value})
+
+    def _search_query(self, payload):
+        vector = None
+        for query in payload.get("vectorQueries") or []:
+            # "kind": "text" はサーバー側でベクトル化する
+            if query.get("kind") == "vector":
+                vector = query.get("vector")
+            elif query.get("kind") == "text":
+                vector = self.state.vector_for(query.get("text", "")).tolist()
+        try:
+            items = self.state.engine.search(
+                text=payload.get("search"),
+                vector=vector,
+                top=payload.get("top", 50),
+                select=payload.get("select"),
+                filter=payload.get("filter"),
+                skip=payload.get("skip", 0),
+                orderby=payload.get("orderby"),
+            )
+        except ValueError as e:
+            return "POST search", 400, self._send(400, {"error": {"message": str(e)}})
+        result = {"value": items}
+        if payload.get("count"):
+            result["@odata.count"] = len(items)
+        return "POST search", 200, self._send(200, result)
+
+    # --- Blob Storage ---
+    def _handle_blob(self, path, body):
+        blob_path = unquote(path[len("/blob"):])
+        query = parse_qs(urlsplit(self.path).query)
+        comp = query.get("comp", [""])[0]
+        if self.command == "PUT" and comp == "block":
+            # Put Block: 確定前のブロックとして保持する
+            with self.state.blocks_lock:
+                self.state.blocks[(blob_path, query["blockid"][0])] = body
+            return "PUT blob block", 201, self._send(201, b"", content_type=None)
+        if self.command == "PUT" and comp == "blocklist":
+            # Put Block List: 指定した順にブロックをつなげて Blob を確定する
+            block_ids = re.findall(r"<(?:Latest|Uncommitted|Committed)>([^<]+)</", body.decode("utf-8"))
+            with self.state.blocks_lock:
+                try:
+                    data = b"".join(self.state.blocks.pop((blob_path, block_id)) for block_id in block_ids)
+                except KeyError:
+                    return "PUT blob blocklist", 400, self._send(400, b"InvalidBlockList", content_type=None)
+            content_type = self.headers.get("x-ms-blob-content-type", "application/octet-stream")
+            return "PUT blob blocklist", 201, self._put_blob(blob_path, data, content_type)
+        if self.command == "PUT":
+            content_type = self.headers.get("Content-Type", "application/octet-stream")
+            return "PUT blob", 201, self._put_blob(blob_path, body, content_type)
+
+        blob = self.state.blobs.get(blob_path)
+        endpoint = f"{self.command} blob"
+        if blob is None:
+            return endpoint, 404, self._send(404, b"", content_type=None)
+        headers = {"ETag": blob["etag"], "Content-MD5": blob["md5"]}
+        if self.command == "HEAD":
+            self.send_response(200)
+            self.send_header("Content-Type", blob["content_type"])
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(blob["data"])))
+            self.end_headers()
+            return endpoint, 200, 0
+        if self.headers.get("If-None-Match") == blob["etag"]:
+            return endpoint, 304, self._send(304, b"", headers=headers)
+        if self.headers.get("If-Match") and self.headers["If-Match"] != blob["etag"]:
+            return endpoint, 412, self._send(412, b"", content_type=None)
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("x-ms-range") or self.headers.get("Range") or "")
+        if match:
+            # Range 指定のダウンロード
+            data = blob["data"]
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            self.state.profiles["blob"].transfer(end + 1 - start)
+            return f"{endpoint} range", 206, self._send(
+                206, data[start:end + 1], headers=headers, content_type=blob["content_type"]
+            )
+        self.state.profiles["blob"].transfer(len(blob["data"]))
+        return endpoint, 200, self._send(200, blob["data"], headers=headers, content_type=blob["content_type"])
+
+    def _put_blob(self, blob_path, data, content_type):
+        """Blob を保存し、レスポンスを返す。"""
+        etag = '"0x%s"' % hashlib.md5(data).hexdigest()[:16].upper()
+        md5 = self.headers.get("x-ms-blob-content-md5") or base64.b64encode(hashlib.md5(data).digest()).decode()
+        self.state.blobs[blob_path] = {
+            "data": data,
+            "etag": etag,
+            "md5": md5,
+            "content_type": content_type,
+        }
+        return self._send(201, b"", headers={"ETag": etag, "Content-MD5": md5})
+
+    # --- OpenAI ---
+    def _handle_openai(self, path, body):
+        payload = json.loads(body or b"{}")
+        if path.endswith("/embeddings"):
+            return self._embeddings(payload)
+        if path.endswith("/chat/completions"):
+            return self._chat(payload)
+        return "openai other", 404, self._send(404, {"error": "not found"})
+
+    def _embeddings(self, payload):
+        inputs = payload.get("input")
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        base64_format = payload.get("encoding_format") == "base64"
+        data = []
+        for i, value in enumerate(inputs or []):
+            vector = self.state.vector_for(value, payload.get("dimensions"))
+            embedding = base64.b64encode(vector.tobytes()).decode() if base64_format else vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        result = {
+            "object": "list",
+            "data": data,
+            "model": payload.get("model", ""),
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+        return "POST embeddings", 200, self._send(200, result)
+
+    def _answer_tokens(self, payload):
+        """リクエストに含まれる画像リンクを1つ引用した回答をトークン単位に分けて返す。"""
+        text = json.dumps(payload.get("messages", []), ensure_ascii=False)
+        link = re.search(r"!\[[^\]\\]*\]\([^)\\]+\)", text)
+        words = ["回答", "の", "例", "です", "。"] * max(1, self.state.chat_tokens // 5)
+        if link:
+            words.insert(len(words) // 2, "\n" + link.group(0) + "\n")
+        return words
+
+    def _chat(self, payload):
+        tokens = self._answer_tokens(payload)
+        model = payload.get("model", "")
+        if not payload.get("stream"):
+            # 非ストリーミングでもトークン生成時間分は待つ
+            time.sleep(self.state.chat_token_ms * len(tokens) / 1000)
+            result = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            }
+            return "POST chat", 200, self._send(200, result)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        sent = 0
+
+        def write_event(data):
+            nonlocal sent
+            line = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+            sent += len(line)
+
+        for i, token in enumerate(tokens + [None]):
+            if i:
+                time.sleep(self.state.chat_token_ms / 1000)
+            delta = {"content": token} if token is not None else {}
+            if i == 0:
+                delta["role"] = "assistant"
+            write_event(json.dumps({
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None if token is not None else "stop"}],
+            }, ensure_ascii=False))
+        write_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+        return "POST chat (stream)", 200, sent
+
+
+class MockServices:
+    """
+    モックサーバーをバックグラウンドのスレッドで起動する。
+    with MockServices(state) as services: で使い、services.base_url を各サービスのエンドポイントに設定する。
+    """
+
+    def __init__(self, state, host="127.0.0.1", port=0):
+        self.state = state
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = state
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self, index_name="bench-index"):
+        """リポジトリの各モジュールをモックサーバーに向けるための環境変数を返す。"""
+        return {
+            "AZURE_SEARCH_ENDPOINT": f"{self.base_url}/search",
+            "AZURE_SEARCH_INDEX": index_name,
+            "AZURE_SEARCH_API_KEY": "mock-key",
+            "BLOB_BASE_URL": f"{self.base_url}/blob",
+            "SAS_TOKEN": "sv=mock",
+            "OPENAI_API_KEY": "mock-key",
+            "OPENAI_BASE_URL": f"{self.base_url}/openai/v1",
+            "OPENAI_API_BASE": f"{self.base_url}/openai/v1",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-services", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    # 単体で起動して手動の動作確認に使う
+    import os
+    import argparse
+    import tempfile
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser = argparse.ArgumentParser(description="ベンチマーク用のモックサーバーを起動する")
+    parser.add_argument("--port", type=int, default=8900)
+    args = parser.parse_args()
+    with MockServices(MockState(tempfile.mkdtemp(prefix="mock-index-")), port=args.port) as services:
+        for name, value in services.env().items():
+            print(f"{name}={value}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
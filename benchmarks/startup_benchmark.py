@@ -0,0 +1,139 @@
+"""
+起動時間ベンチマーク
+新しい Python プロセスで各モジュールの import 時間と、検索アプリのコールドスタート
+（app の import + 設定読み込み + Retriever・LLM の構築）の時間を計測する。
+-X importtime の結果から、時間のかかっている import の上位も出力する。
+
+使い方:
+    python benchmarks/startup_benchmark.py --repeat 5 --output bench_results/startup.json
+    python benchmarks/startup_benchmark.py --baseline bench_results/startup.json
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import platform
+import statistics
+import subprocess
+
+# リポジトリのルート（各モジュールはここから import する）
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 計測対象: 名前 -> 新しいプロセスで実行するコード
+TARGETS = {
+    "import_app": "import app",
+    "import_retriever": "import retriever",
+    "import_upload_to_azure_search": "import upload_to_azure_search",
+    "cold_start_app": (
+        "import app\n"
+        "settings = app.load_settings()\n"
+        "app.init_services(settings)\n"
+    ),
+}
+
+_TIMER = (
+    "import time\n"
+    "_start = time.perf_counter()\n"
+    "{code}\n"
+    "print('ELAPSED', time.perf_counter() - _start)\n"
+)
+
+
+def run_once(code):
+    """新しいプロセスでコードを実行し、経過時間（秒）を返す。"""
+    result = subprocess.run(
+        [sys.executable, "-c", _TIMER.format(code=code)],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "実行に失敗しました")
+    for line in result.stdout.splitlines():
+        if line.startswith("ELAPSED "):
+            return float(line.split()[1])
+    raise RuntimeError("経過時間を取得できませんでした")
+
+
+def top_imports(code, limit=15):
+    """-X importtime で計測した、累積時間の長いトップレベルパッケージを返す。"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+    )
+    totals = {}
+    for line in result.stderr.splitlines():
+        # 形式: "import time:   self [us] | cumulative | imported package"
+        match = re.match(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)", line)
+        if not match:
+            continue
+        # インデントのない行（トップレベルの import）だけを集計する
+        if len(match.group(3)) > 1:
+            continue
+        package = match.group(4).split(".")[0]
+        totals[package] = totals.get(package, 0) + int(match.group(2))
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [{"module": name, "cumulative_ms": us / 1000} for name, us in ranked]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="import 時間・コールドスタート時間を計測する")
+    parser.add_argument("--repeat", type=int, default=5, help="各計測の繰り返し回数")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    parser.add_argument("--baseline", help="比較対象とする以前の結果の JSON ファイル")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, code in TARGETS.items():
+        try:
+            samples = [run_once(code) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{name}: 失敗 ({e})")
+            continue
+        results[name] = {
+            "median_s": statistics.median(samples),
+            "min_s": min(samples),
+            "max_s": max(samples),
+            "samples_s": samples,
+        }
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+
+    print(f"{'target':35} {'median':>10} {'min':>10} {'max':>10} {'vs baseline':>12}")
+    for name, r in results.items():
+        diff = ""
+        if name in baseline:
+            base = baseline[name]["median_s"]
+            diff = f"{(r['median_s'] - base) / base * 100:+.1f}%" if base else ""
+        print(f"{name:35} {r['median_s']:10.3f} {r['min_s']:10.3f} {r['max_s']:10.3f} {diff:>12}")
+
+    imports = top_imports(TARGETS["import_app"])
+    print("\napp の import で時間のかかっているパッケージ:")
+    for item in imports:
+        print(f"  {item['module']:30} {item['cumulative_ms']:10.1f} ms")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "repeat": args.repeat,
+                    "results": results,
+                    "top_imports_app": imports,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
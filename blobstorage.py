@@ -1,9 +1,23 @@
 
-import requests
+"""
+Azure Blob Storage の REST API でファイルをアップロード・ダウンロードする。
+大きなファイルはブロック（BLOB_BLOCK_SIZE）単位に分けて並行に転送し、ファイル全体をメモリに読み込まない。
+- アップロード: BLOB_SINGLE_UPLOAD_MAX_BYTES 以下は1回の PUT、超える場合は Put Block を並行に送って Put Block List で確定する
+- ダウンロード: ファイルに保存する場合はレスポンスを少しずつディスクに書き込む。
+  BLOB_RANGED_DOWNLOAD_MIN_BYTES 以上の Blob は Range 指定で並行にダウンロードする
+同時に転送するブロック数は BLOB_TRANSFER_CONCURRENCY で、1ファイルあたりのメモリ使用量はおおよそ
+BLOB_BLOCK_SIZE × BLOB_TRANSFER_CONCURRENCY に収まる。
+"""
+import http_client
 import mimetypes  # Content-Type自動判定用
 from dotenv import load_dotenv
 import os
+import base64
 import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+from metrics import span, increment
 from logging_config import configure_logging
 
 
@@ -15,6 +29,21 @@ load_dotenv()
 
 BLOB_BASE_URL = os.getenv("BLOB_BASE_URL")
 SAS_TOKEN = os.getenv("SAS_TOKEN")
+# 1回の PUT でアップロードするファイルサイズの上限（超える場合はブロックに分けてアップロードする）
+BLOB_SINGLE_UPLOAD_MAX_BYTES = int(os.getenv("BLOB_SINGLE_UPLOAD_MAX_BYTES", str(8 * 1024 * 1024)))
+# ブロック（Put Block・Range 指定のダウンロード）の大きさ
+BLOB_BLOCK_SIZE = int(os.getenv("BLOB_BLOCK_SIZE", str(4 * 1024 * 1024)))
+# 1ファイルあたり同時に転送するブロック数
+BLOB_TRANSFER_CONCURRENCY = int(os.getenv("BLOB_TRANSFER_CONCURRENCY", "4"))
+# Range 指定で並行にダウンロードする Blob の大きさの下限（0 で並行ダウンロードしない）
+BLOB_RANGED_DOWNLOAD_MIN_BYTES = int(os.getenv("BLOB_RANGED_DOWNLOAD_MIN_BYTES", str(32 * 1024 * 1024)))
+# ダウンロードしたデータをディスクに書き込む単位
+BLOB_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _blob_url(blob_path, query=""):
+    """SASトークン付きの Blob の URL"""
+    return f"{BLOB_BASE_URL}{blob_path}?{query + '&' if query else ''}{SAS_TOKEN}"
 
 # ファイルのContent-Typeを自動判定する関数
 def get_content_type(file_path):
@@ -27,60 +56,234 @@ def get_content_type(file_path):
     return content_type
 
 # requestsを使ってAzure Blob Storageに画像をアップロードする関数
-def upload_image_to_blob_storage_via_restapi(blob_path, image_path):
+def upload_image_to_blob_storage_via_restapi(blob_path, image_path, content_md5=None):
     """
     requestsライブラリでAzure Blob Storageに画像をアップロードする関数
+    BLOB_SINGLE_UPLOAD_MAX_BYTES を超えるファイルはブロックに分けて並行にアップロードする。
     :param blob_path: アップロード先のBlobのPath（例: "/test.md/images/myimage.png"）
     :param image_path: アップロードする画像ファイルのパス
-    :return: レスポンスオブジェクト
+    :param content_md5: ファイル内容の MD5（Base64）。指定時は Blob の Content-MD5 として保存する
+    :return: レスポンスオブジェクト（成功時のステータスコードは 201）
     """
-
-    # 画像ファイルをバイナリで読み込む
-    with open(image_path, "rb") as f:
-        image_data = f.read()
-
+    size = os.path.getsize(image_path)
     # Content-Typeを自動判定
     content_type = get_content_type(image_path)
+    upload_url = _blob_url(blob_path)
 
-    # ヘッダー設定（自動判定したContent-Typeを使用）
-    headers = {
-        "x-ms-blob-type": "BlockBlob",
-        "Content-Type": content_type
-    }
-
-    # SASトークン付きURLを作成
-    upload_url = f"{BLOB_BASE_URL}{blob_path}?{SAS_TOKEN}"
-    # PUTリクエストでアップロード
-    response = requests.put(upload_url, headers=headers, data=image_data)
+    with span("blob.upload", blocks=size > BLOB_SINGLE_UPLOAD_MAX_BYTES):
+        if size > BLOB_SINGLE_UPLOAD_MAX_BYTES:
+            response = _upload_blocks(blob_path, image_path, content_type, content_md5)
+        else:
+            # 画像ファイルをバイナリで読み込む（上限以下の大きさのものだけ）
+            with open(image_path, "rb") as f:
+                image_data = f.read()
+            # ヘッダー設定（自動判定したContent-Typeを使用）
+            headers = {
+                "x-ms-blob-type": "BlockBlob",
+                "Content-Type": content_type
+            }
+            if content_md5:
+                headers["x-ms-blob-content-md5"] = content_md5
+            # PUTリクエストでアップロード
+            response = http_client.put(upload_url, headers=headers, data=image_data)
     # ステータスコードで結果を判定
     if response.status_code == 201:
-        logger.info("アップロード成功: %s", upload_url)
+        increment("blob.upload_bytes", size)
+        logger.info("アップロード成功: %s", blob_path)
     else:
-        logger.error("アップロード失敗: %s %s", response.status_code, response.text)
+        logger.error("アップロード失敗: %s %s %s", blob_path, response.status_code, response.text)
     return response
 
+
+def _block_id(index):
+    """ブロック id（同じ Blob のブロック id はすべて同じ長さにする必要がある）"""
+    return base64.b64encode(f"block-{index:08d}".encode("ascii")).decode("ascii")
+
+
+def _put_block(blob_path, block_id, data):
+    url = _blob_url(blob_path, f"comp=block&blockid={quote(block_id, safe='')}")
+    with span("blob.put_block"):
+        return http_client.put(url, data=data)
+
+
+def _upload_blocks(blob_path, file_path, content_type, content_md5=None):
+    """
+    ファイルをブロックに分けて Put Block で並行に送り、Put Block List で Blob を確定する。
+    同時に読み込んで送信中にするブロックは BLOB_TRANSFER_CONCURRENCY 個までにする。
+    :return: Put Block List（ブロックの送信に失敗した場合はそのブロック）のレスポンス
+    """
+    block_ids = []
+    failed = None
+    with open(file_path, "rb") as f, ThreadPoolExecutor(max_workers=BLOB_TRANSFER_CONCURRENCY) as executor:
+        running = set()
+        while failed is None:
+            while len(running) < BLOB_TRANSFER_CONCURRENCY:
+                data = f.read(BLOB_BLOCK_SIZE)
+                if not data:
+                    break
+                block_id = _block_id(len(block_ids))
+                block_ids.append(block_id)
+                running.add(executor.submit(_put_block, blob_path, block_id, data))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                response = future.result()
+                if response.status_code != 201:
+                    failed = response
+        for future in running:
+            future.cancel()
+    if failed is not None:
+        # 確定していないブロックはサービス側で一定期間後に破棄される
+        return failed
+
+    body = "<?xml version=\"1.0\" encoding=\"utf-8\"?><BlockList>" + "".join(
+        f"<Latest>{escape(block_id)}</Latest>" for block_id in block_ids
+    ) + "</BlockList>"
+    headers = {"Content-Type": "application/xml", "x-ms-blob-content-type": content_type}
+    if content_md5:
+        headers["x-ms-blob-content-md5"] = content_md5
+    increment("blob.upload_blocks", len(block_ids))
+    return http_client.put(_blob_url(blob_path, "comp=blocklist"), headers=headers, data=body.encode("utf-8"))
+
+# Blobのプロパティ（ヘッダー）を取得する関数
+def get_blob_properties(blob_path):
+    """
+    HEAD リクエストで Blob のプロパティを取得する関数
+    :param blob_path: BlobのPath（例: "/test.md/images/myimage.png"）
+    :return: レスポンスヘッダー（Content-MD5, ETag 等）。Blob が存在しない・取得失敗の場合は None
+    """
+    response = http_client.head(_blob_url(blob_path))
+    if response.status_code == 200:
+        return response.headers
+    if response.status_code != 404:
+        logger.error("プロパティ取得失敗: %s %s", blob_path, response.status_code)
+    return None
+
+# ETag を指定して条件付きでファイルをダウンロードする関数
+def download_blob_if_modified(blob_path, etag=None):
+    """
+    If-None-Match を使って Blob をダウンロードする関数
+    :param blob_path: ダウンロードするBlobのPath（例: "/test.md/images/myimage.png"）
+    :param etag: 手元にあるデータの ETag（指定時、変更がなければ 304 が返る）
+    :return: (ステータスコード, ファイルデータ, ETag)。304 や失敗時のファイルデータは None
+    """
+    download_url = _blob_url(blob_path)
+    headers = {"If-None-Match": etag} if etag else {}
+    with span("blob.download", conditional=bool(etag)):
+        response = http_client.get(download_url, headers=headers)
+    increment("blob.download", status=response.status_code)
+    if response.status_code == 200:
+        increment("blob.download_bytes", len(response.content))
+        logger.info("ダウンロード成功: %s", blob_path)
+        return response.status_code, response.content, response.headers.get("ETag")
+    if response.status_code == 304:
+        logger.debug("変更なし: %s", blob_path)
+        return response.status_code, None, etag
+    logger.error("ダウンロード失敗: %s %s", response.status_code, response.text)
+    return response.status_code, None, None
+
 # 指定パスのファイルをAzure Blob Storageからダウンロードする関数
 def download_file_from_blob_storage_via_restapi(blob_path, save_path=None):
     """
     Azure Blob Storageから指定パスのファイルをダウンロードする関数
     :param blob_path: ダウンロードするBlobのPath（例: "/test.md/images/myimage.png"）
-    :param save_path: 保存先のファイルパス（省略時は返却のみ）
-    :return: ファイルデータ（バイナリ）
+    :param save_path: 保存先のファイルパス（static/ 以下に保存する。省略時は返却のみ）
+    :return: save_path 指定時は保存したファイルのパス（メモリには読み込まない）、省略時はファイルデータ（バイナリ）。
+             失敗した場合は None
     """
-    # SASトークン付きURLを作成
-    download_url = f"{BLOB_BASE_URL}{blob_path}?{SAS_TOKEN}"
+    if save_path:
+        static_save_path = os.path.join("static", save_path.lstrip("/"))
+        return static_save_path if download_blob_to_file(blob_path, static_save_path) is not None else None
+
     # GETリクエストでダウンロード
-    response = requests.get(download_url)
+    with span("blob.download", conditional=False):
+        response = http_client.get(_blob_url(blob_path))
+    increment("blob.download", status=response.status_code)
     if response.status_code == 200:
         file_data = response.content
-        # 保存先パスが指定されていればファイルに保存
-        if save_path:
-            static_save_path = os.path.join("static", save_path.lstrip("/"))
-            os.makedirs(os.path.dirname(static_save_path), exist_ok=True)
-            with open(static_save_path, "wb") as f:
-                f.write(file_data)
-        logger.info("ダウンロード成功: %s", download_url)
+        increment("blob.download_bytes", len(file_data))
+        logger.info("ダウンロード成功: %s", blob_path)
         return file_data
     else:
         logger.error("ダウンロード失敗: %s %s", response.status_code, response.text)
         return None
+
+
+def download_blob_to_file(blob_path, file_path, parallel=True):
+    """
+    Blob をファイルにダウンロードする（レスポンスを少しずつ書き込み、ファイル全体をメモリに読み込まない）。
+    BLOB_RANGED_DOWNLOAD_MIN_BYTES 以上の Blob は Range 指定で並行にダウンロードする。
+    書き込み中は一時ファイルに書き、完了してから file_path に置き換える。
+    :param parallel: False の場合は大きな Blob も1本の GET でダウンロードする
+    :return: ダウンロードしたバイト数（失敗した場合は None）
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    part_path = file_path + ".part"
+    try:
+        properties = get_blob_properties(blob_path) if parallel and BLOB_RANGED_DOWNLOAD_MIN_BYTES > 0 else None
+        size = int(properties.get("Content-Length", 0)) if properties is not None else 0
+        with span("blob.download", conditional=False, ranged=size >= BLOB_RANGED_DOWNLOAD_MIN_BYTES > 0):
+            if properties is not None and size >= BLOB_RANGED_DOWNLOAD_MIN_BYTES:
+                written = _download_ranges(blob_path, part_path, size, properties.get("ETag"))
+            else:
+                written = _download_stream(blob_path, part_path)
+        if written is None:
+            return None
+        os.replace(part_path, file_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    increment("blob.download_bytes", written)
+    logger.info("ダウンロード成功: %s -> %s (%d バイト)", blob_path, file_path, written)
+    return written
+
+
+def _write_response(response, f):
+    """レスポンスのボディを BLOB_DOWNLOAD_CHUNK_SIZE ずつファイルに書き込み、書き込んだバイト数を返す。"""
+    written = 0
+    for chunk in response.iter_content(chunk_size=BLOB_DOWNLOAD_CHUNK_SIZE):
+        f.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def _download_stream(blob_path, file_path):
+    """1本の GET でダウンロードしてファイルに書き込む。"""
+    with http_client.get(_blob_url(blob_path), stream=True) as response:
+        increment("blob.download", status=response.status_code)
+        if response.status_code != 200:
+            logger.error("ダウンロード失敗: %s %s %s", blob_path, response.status_code, response.text)
+            return None
+        with open(file_path, "wb") as f:
+            return _write_response(response, f)
+
+
+def _download_range(blob_path, file_path, start, end, etag):
+    """Blob の start〜end バイト目をダウンロードし、ファイルの同じ位置に書き込む。"""
+    headers = {"Range": f"bytes={start}-{end}", "x-ms-range": f"bytes={start}-{end}"}
+    if etag:
+        # ダウンロード中に Blob が更新された場合は 412 で失敗させる（新旧の内容が混ざらないようにする）
+        headers["If-Match"] = etag
+    with http_client.get(_blob_url(blob_path), headers=headers, stream=True) as response:
+        increment("blob.download", status=response.status_code)
+        if response.status_code != 206:
+            logger.error("ダウンロード失敗: %s %s %s", blob_path, start, response.status_code)
+            return None
+        with open(file_path, "r+b") as f:
+            f.seek(start)
+            return _write_response(response, f)
+
+
+def _download_ranges(blob_path, file_path, size, etag):
+    """Range 指定で BLOB_BLOCK_SIZE ずつ並行にダウンロードしてファイルに書き込む。"""
+    # 各ブロックを書き込む位置を確保しておく
+    with open(file_path, "wb") as f:
+        f.truncate(size)
+    ranges = [(start, min(start + BLOB_BLOCK_SIZE, size) - 1) for start in range(0, size, BLOB_BLOCK_SIZE)]
+    with ThreadPoolExecutor(max_workers=BLOB_TRANSFER_CONCURRENCY) as executor:
+        results = list(executor.map(lambda r: _download_range(blob_path, file_path, r[0], r[1], etag), ranges))
+    if any(written is None for written in results):
+        return None
+    increment("blob.download_blocks", len(ranges))
+    return sum(results)
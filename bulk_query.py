@@ -0,0 +1,280 @@
+"""
+一括検索スクリプト
+JSONL / CSV ファイルのクエリを AzureAISearchRetriever で並行に検索し、結果を1件ずつ JSONL に書き出す。
+キャッシュの事前ウォームアップ、再取り込み後の検索品質の確認（期待する id が上位に含まれるか）、
+検索サービスの負荷試験に使う。
+
+入力:
+    JSONL: 1行1件。文字列、または {"id": ..., "query": ..., "expected_ids": [...]} のオブジェクト
+    CSV:   ヘッダー行に query 列（任意で id 列、"|" 区切りの expected_ids 列）
+    id を省略した場合は行番号を id にする。
+
+出力（1行1件の JSON）:
+    {"id", "query", "status", "latency_ms", "results": [{"id", "score", "parent_filename"}], ...}
+    expected_ids を指定したクエリには hit（1件でも含まれるか）と recall を付ける。
+
+使い方:
+    python bulk_query.py queries.jsonl --output results/queries.jsonl --concurrency 8 --rate 20
+    python bulk_query.py queries.csv --output results/queries.jsonl --resume   # 中断後に続きから実行する
+    python bulk_query.py queries.jsonl --output results/load.jsonl --no-cache --repeat 10
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv
+import metrics
+import logging
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
+AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX")
+AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
+QUERY_VECTOR_MODE = os.getenv("QUERY_VECTOR_MODE", "text")
+QA_TOP = int(os.getenv("QA_TOP", "3"))
+# 一括検索の同時実行数
+BULK_QUERY_CONCURRENCY = int(os.getenv("BULK_QUERY_CONCURRENCY", "4"))
+
+
+def _parse_expected(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        return [item.strip() for item in value.split("|") if item.strip()]
+    return [str(item) for item in value]
+
+
+def load_queries(path):
+    """
+    クエリファイル（JSONL / CSV）を読み込む。
+    :return: {"id", "query", "expected_ids"} の辞書のリスト
+    """
+    queries = []
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = ((i, row) for i, row in enumerate(csv.DictReader(f), start=1))
+        else:
+            rows = ((i, json.loads(line)) for i, line in enumerate(f, start=1) if line.strip())
+        for line_no, row in rows:
+            if isinstance(row, str):
+                row = {"query": row}
+            query = (row.get("query") or "").strip()
+            if not query:
+                logger.warning("クエリがない行をスキップします: %s 行目", line_no)
+                continue
+            queries.append({
+                "id": str(row.get("id") or line_no),
+                "query": query,
+                "expected_ids": _parse_expected(row.get("expected_ids")),
+            })
+    return queries
+
+
+def load_completed_ids(path):
+    """出力ファイルから成功したクエリの id を読み込む（--resume 用）。"""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 中断時に途中まで書かれた行
+                continue
+            if record.get("status") == "ok":
+                completed.add(record["id"])
+    return completed
+
+
+class RateLimiter:
+    """
+    1秒あたりの開始数を制限する（複数スレッドから同時に使ってよい）。
+    :param rate: 1秒あたりの最大数（0 以下で制限しない）
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def create_retriever(top=None):
+    """検索アプリと同じ設定で Retriever を作成する。"""
+    from retriever import AzureAISearchRetriever
+    return AzureAISearchRetriever(
+        service_name=AZURE_SEARCH_ENDPOINT,
+        api_key=AZURE_SEARCH_API_KEY,
+        index_name=AZURE_SEARCH_INDEX,
+        qa_content_key="text",
+        qa_top=top or QA_TOP,
+        qa_scoring_profile="",
+        query_vector_mode=QUERY_VECTOR_MODE,
+    )
+
+
+def _result_summary(metadata):
+    """検索結果1件の id・スコア（セマンティックランカーを使う場合はそのスコアも）"""
+    result = {
+        "id": metadata.get("id"),
+        "score": metadata.get("@search.score"),
+        "parent_filename": metadata.get("parent_filename"),
+    }
+    if metadata.get("@search.rerankerScore") is not None:
+        result["reranker_score"] = metadata["@search.rerankerScore"]
+    return result
+
+
+def run_query(retriever, item, limiter):
+    """
+    1件のクエリを検索する。
+    :return: 出力する結果の辞書
+    """
+    limiter.wait()
+    record = {"id": item["id"], "query": item["query"]}
+    start = time.perf_counter()
+    try:
+        documents = retriever.invoke(item["query"])
+    except Exception as e:
+        record.update(status="error", latency_ms=(time.perf_counter() - start) * 1000, error=str(e))
+        return record
+    record.update(
+        status="ok",
+        latency_ms=(time.perf_counter() - start) * 1000,
+        results=[_result_summary(doc.metadata) for doc in documents],
+    )
+    if item["expected_ids"]:
+        found = {result["id"] for result in record["results"]} & set(item["expected_ids"])
+        record["hit"] = bool(found)
+        record["recall"] = len(found) / len(item["expected_ids"])
+    return record
+
+
+def percentile(samples, p):
+    """サンプルの p パーセンタイル（最近傍法）"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def summarize(records, elapsed):
+    """実行結果を集計する。"""
+    ok = [record for record in records if record["status"] == "ok"]
+    latencies = [record["latency_ms"] for record in ok]
+    summary = {
+        "queries": len(records),
+        "ok": len(ok),
+        "errors": len(records) - len(ok),
+        "empty": sum(1 for record in ok if not record["results"]),
+        "elapsed_s": elapsed,
+        "qps": len(records) / elapsed if elapsed else 0.0,
+    }
+    if latencies:
+        summary.update(
+            p50_ms=percentile(latencies, 50),
+            p95_ms=percentile(latencies, 95),
+            p99_ms=percentile(latencies, 99),
+            mean_ms=statistics.mean(latencies),
+        )
+    judged = [record for record in ok if "hit" in record]
+    if judged:
+        summary["hit_rate"] = sum(record["hit"] for record in judged) / len(judged)
+        summary["mean_recall"] = statistics.mean(record["recall"] for record in judged)
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="JSONL / CSV のクエリを一括で検索し、結果を JSONL に書き出す")
+    parser.add_argument("input", help="クエリファイル（.jsonl / .csv）")
+    parser.add_argument("--output", required=True, help="結果を書き出す JSONL ファイル")
+    parser.add_argument("--concurrency", type=int, default=BULK_QUERY_CONCURRENCY, help="同時に実行する検索の数")
+    parser.add_argument("--rate", type=float, default=0.0, help="1秒あたりの最大検索数（0 で制限しない）")
+    parser.add_argument("--top", type=int, help="取得する件数（省略時は QA_TOP）")
+    parser.add_argument("--repeat", type=int, default=1, help="クエリ全体を繰り返す回数（負荷試験用）")
+    parser.add_argument("--resume", action="store_true", help="出力ファイルで成功済みのクエリをスキップして追記する")
+    parser.add_argument("--no-cache", action="store_true", help="検索結果キャッシュを使わない（負荷試験用）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    :return: 検索に失敗したクエリの数
+    """
+    args = parse_args(argv)
+    if args.no_cache:
+        # retriever の import より前に設定する
+        os.environ["SEARCH_CACHE_SIZE"] = "0"
+
+    queries = load_queries(args.input)
+    if args.repeat > 1:
+        queries = [
+            {**item, "id": f"{item['id']}#{round_index + 1}"}
+            for round_index in range(args.repeat) for item in queries
+        ]
+    completed = load_completed_ids(args.output) if args.resume else set()
+    pending = [item for item in queries if item["id"] not in completed]
+    logger.info("一括検索: 全 %d 件（実行済み %d 件をスキップ）", len(queries), len(queries) - len(pending))
+    print(f"全 {len(queries)} 件のうち {len(pending)} 件を検索します")
+
+    retriever = create_retriever(args.top)
+    limiter = RateLimiter(args.rate)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    records = []
+    start = time.perf_counter()
+    # 結果は完了した順に1行ずつ書き出す（中断しても書き出した分は --resume で再実行しない）
+    with open(args.output, "a" if args.resume else "w", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        # 未実行のクエリを溜め込まないよう、実行中の数を同時実行数の2倍までにする
+        remaining = iter(pending)
+        running = set()
+        try:
+            while True:
+                for item in remaining:
+                    running.add(executor.submit(run_query, retriever, item, limiter))
+                    if len(running) >= args.concurrency * 2:
+                        break
+                if not running:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record = future.result()
+                    if record["status"] != "ok":
+                        logger.warning("検索失敗: %s %s", record["id"], record["error"])
+                    records.append(record)
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+        except KeyboardInterrupt:
+            for future in running:
+                future.cancel()
+            print(f"中断しました。{len(records)} 件を書き出しました（--resume で続きから実行できます）")
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(records, elapsed)
+    logger.info("一括検索の結果: %s", summary)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    metrics.flush()
+    return summary["errors"]
+
+
+if __name__ == "__main__":
+    errors = main()
+    sys.exit(1 if errors else 0)
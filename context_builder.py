@@ -0,0 +1,273 @@
+"""
+参考情報（コンテキスト）の組み立て
+検索結果のチャンクから LLM に渡す参考情報を作る。
+- 同じ parent_filename のチャンクで、末尾と先頭が重なっている（分割時の chunk_overlap）ものは1つにつなげる
+- 別のチャンクに含まれているチャンクや、既に含めた行と同じ内容の行は除く
+- 同じ画像（Blob）は1度だけ渡す
+- 関連度の高い順に、設定したトークン数の上限に収まるだけ詰める（最上位のブロックだけで上限を超える場合は上限まで切り詰める）
+削減できたトークン数は結果の stats に記録し、ログとメトリクスにも出力する。
+"""
+import os
+import re
+import logging
+from dotenv import load_dotenv
+from embedding_stage import estimate_tokens
+from markdown_utils import extract_image_links
+from metrics import span, increment
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# 参考情報のトークン数の上限
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# LLM に渡す画像の最大数
+CONTEXT_MAX_IMAGES = int(os.getenv("CONTEXT_MAX_IMAGES", "6"))
+# チャンク同士を重なりとみなす最小・最大の文字数
+CONTEXT_MIN_OVERLAP = int(os.getenv("CONTEXT_MIN_OVERLAP", "10"))
+CONTEXT_MAX_OVERLAP = int(os.getenv("CONTEXT_MAX_OVERLAP", "500"))
+# 重複とみなして除く行の最小文字数（表の区切り行などの短い行は残す）
+CONTEXT_MIN_DEDUP_LINE = int(os.getenv("CONTEXT_MIN_DEDUP_LINE", "20"))
+
+_IMAGE_LINK = re.compile(r"!\[.*?\]\(.*?\)")
+
+
+class ReferenceBlock:
+    """
+    参考情報の1ブロック（1つ以上のチャンクをつなげたもの）
+    :param rank: 含まれるチャンクのうち最も高い検索順位（0 が最上位）
+    """
+
+    def __init__(self, parent_filename, title, text, images, rank, chunk_count=1):
+        self.parent_filename = parent_filename
+        self.title = title
+        self.text = text
+        # 画像ファイル名 -> Blob パス
+        self.images = images
+        self.rank = rank
+        self.chunk_count = chunk_count
+        self.tokens = 0
+
+
+class PackedContext:
+    """
+    組み立てた参考情報
+    :param blocks: 参考情報に含めたブロック（関連度順）
+    :param dropped_blocks: トークン数の上限のため含めなかったブロック
+    :param images: LLM に渡す画像の (ファイル名, Blob パス) のリスト（重複なし）
+    :param stats: 削減したトークン数などの統計
+    """
+
+    def __init__(self, blocks, dropped_blocks, images, stats):
+        self.blocks = blocks
+        self.dropped_blocks = dropped_blocks
+        self.images = images
+        self.stats = stats
+
+    @property
+    def references(self):
+        """LLM に渡す参考情報の文字列"""
+        return "\n\n".join(block.text for block in self.blocks)
+
+
+def find_overlap(left, right, min_overlap=None, max_overlap=None):
+    """
+    left の末尾と right の先頭が重なっている文字数を返す（重なっていなければ 0）。
+    """
+    min_overlap = min_overlap or CONTEXT_MIN_OVERLAP
+    max_overlap = max_overlap or CONTEXT_MAX_OVERLAP
+    for size in range(min(len(left), len(right), max_overlap), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _merge_group(blocks):
+    """同じファイルのブロックのうち、包含・重なりのあるものをつなげる。"""
+    blocks = list(blocks)
+    merged = True
+    while merged:
+        merged = False
+        for i, left in enumerate(blocks):
+            for j, right in enumerate(blocks):
+                if i == j:
+                    continue
+                if right.text in left.text:
+                    text = left.text
+                else:
+                    overlap = find_overlap(left.text, right.text)
+                    if not overlap:
+                        continue
+                    text = left.text + right.text[overlap:]
+                combined = ReferenceBlock(
+                    left.parent_filename,
+                    left.title,
+                    text,
+                    {**left.images, **right.images},
+                    min(left.rank, right.rank),
+                    left.chunk_count + right.chunk_count,
+                )
+                blocks = [b for k, b in enumerate(blocks) if k not in (i, j)] + [combined]
+                merged = True
+                break
+            if merged:
+                break
+    return blocks
+
+
+def _normalize_line(line):
+    return re.sub(r"\s+", " ", line).strip()
+
+
+def _drop_duplicate_lines(text, seen):
+    """
+    既に含めた行と同じ内容の行を除く（画像リンクと短い行は残す）。
+    seen は変更しない（ブロックを参考情報に含めた場合にだけ、呼び出し側で追加する）。
+    :return: (重複を除いたテキスト, このテキストで新たに現れた行の集合)
+    """
+    lines = []
+    new_lines = set()
+    for line in text.split("\n"):
+        normalized = _normalize_line(line)
+        if len(normalized) >= CONTEXT_MIN_DEDUP_LINE and not _IMAGE_LINK.search(line):
+            if normalized in seen or normalized in new_lines:
+                continue
+            new_lines.add(normalized)
+        lines.append(line)
+    return "\n".join(lines).strip(), new_lines
+
+
+def _truncate_to_tokens(text, budget):
+    """
+    テキストを先頭から budget トークンまでに切り詰める。
+    行の区切りで切っても半分以上残る場合は行の区切りで、そうでなければ budget の位置で切る。
+    """
+    # トークン数が budget 以下になる最長の先頭部分を二分探索で求める
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    truncated = text[:low]
+    newline = truncated.rfind("\n")
+    # 先頭の見出しの直後などで切って、上限の大部分を捨てることがないようにする
+    if newline > 0 and newline >= len(truncated) // 2:
+        truncated = truncated[:newline]
+    return truncated.rstrip()
+
+
+@span("context.build")
+def build_context(documents, token_budget=None, max_images=None):
+    """
+    検索結果（関連度順の Document のリスト）から参考情報を組み立てる。
+    :param token_budget: 参考情報のトークン数の上限
+    :param max_images: LLM に渡す画像の最大数
+    :return: PackedContext
+    """
+    token_budget = token_budget or CONTEXT_TOKEN_BUDGET
+    max_images = CONTEXT_MAX_IMAGES if max_images is None else max_images
+
+    # 従来どおりすべてのチャンクをそのままつなげた場合のトークン数（削減量の基準）
+    input_tokens = sum(estimate_tokens(doc.page_content) for doc in documents)
+
+    # ファイルごとにまとめて重なりのあるチャンクをつなげる（グループの順序は最初に現れた順）
+    groups = {}
+    for rank, doc in enumerate(documents):
+        parent = doc.metadata.get("parent_filename") or doc.metadata.get("id") or f"#{rank}"
+        images = dict(zip(doc.metadata.get("image_filenames", []), doc.metadata.get("imagebloburls", [])))
+        block = ReferenceBlock(parent, doc.metadata.get("title", parent), doc.page_content, images, rank)
+        groups.setdefault(parent, []).append(block)
+    blocks = [block for group in groups.values() for block in _merge_group(group)]
+    merged_chunks = len(documents) - len(blocks)
+    blocks.sort(key=lambda block: block.rank)
+
+    # 関連度順に、重複行を除いたうえでトークン数の上限まで詰める
+    seen_lines = set()
+    packed = []
+    dropped = []
+    used_tokens = 0
+    dropped_tokens = 0
+    truncated_tokens = 0
+    for block in blocks:
+        text, new_lines = _drop_duplicate_lines(block.text, seen_lines)
+        if not text:
+            continue
+        tokens = estimate_tokens(text)
+        if used_tokens + tokens > token_budget:
+            if packed:
+                block.tokens = tokens
+                dropped_tokens += tokens
+                dropped.append(block)
+                continue
+            # 最も関連度の高いブロックは除かずに、上限まで切り詰めて含める
+            truncated = _truncate_to_tokens(text, token_budget - used_tokens)
+            if not truncated:
+                block.tokens = tokens
+                dropped_tokens += tokens
+                dropped.append(block)
+                continue
+            _, new_lines = _drop_duplicate_lines(truncated, seen_lines)
+            truncated_tokens = tokens - estimate_tokens(truncated)
+            text = truncated
+            tokens -= truncated_tokens
+            logger.info("最上位の参考情報が上限を超えるため切り詰めました: %s（%d トークン削減）",
+                        block.title, truncated_tokens)
+        # 含めたブロックの行だけを、以降のブロックの重複除去に使う
+        seen_lines |= new_lines
+        block.text = text
+        block.tokens = tokens
+        used_tokens += tokens
+        packed.append(block)
+
+    # 画像は含めたブロックのものだけを、同じ Blob は1度だけ渡す
+    images = []
+    seen_blobs = set()
+    duplicate_images = 0
+    for block in packed:
+        for filename in _image_filenames_in(block):
+            blob_path = block.images[filename]
+            if blob_path in seen_blobs:
+                duplicate_images += 1
+                continue
+            seen_blobs.add(blob_path)
+            if len(images) < max_images:
+                images.append((filename, blob_path))
+
+    stats = {
+        "input_chunks": len(documents),
+        "merged_chunks": merged_chunks,
+        "blocks": len(packed),
+        "dropped_blocks": len(dropped),
+        "input_tokens": input_tokens,
+        "output_tokens": used_tokens,
+        "saved_tokens": max(0, input_tokens - used_tokens),
+        # 上限超過で除いた・切り詰めた分を除く、結合・重複除去で減らした分
+        "deduplicated_tokens": max(0, input_tokens - used_tokens - dropped_tokens - truncated_tokens),
+        "dropped_tokens": dropped_tokens,
+        "truncated_tokens": truncated_tokens,
+        "images": len(images),
+        "duplicate_images": duplicate_images,
+    }
+    increment("context.tokens_saved", stats["deduplicated_tokens"], reason="deduplicated")
+    increment("context.tokens_saved", dropped_tokens + truncated_tokens, reason="budget")
+    increment("context.tokens_used", used_tokens)
+    logger.info(
+        "参考情報: %d チャンク -> %d ブロック（結合 %d / 上限超過 %d）, %d -> %d トークン"
+        "（重複除去 %d / 上限超過 %d 削減）, 画像 %d 件",
+        stats["input_chunks"], stats["blocks"], merged_chunks, stats["dropped_blocks"],
+        input_tokens, used_tokens, stats["deduplicated_tokens"], dropped_tokens + truncated_tokens, stats["images"],
+    )
+    return PackedContext(packed, dropped, images, stats)
+
+
+def _image_filenames_in(block):
+    """ブロック本文に現れる順に、対応する Blob のある画像ファイル名を返す。"""
+    filenames = []
+    for filename in extract_image_links(block.text):
+        if filename in block.images and filename not in filenames:
+            filenames.append(filename)
+    return filenames
@@ -0,0 +1,195 @@
+"""
+埋め込みベクトルの永続キャッシュ
+(埋め込みモデル名, 正規化したチャンクテキストのハッシュ) をキーに SQLite へベクトルを保存し、
+再取り込み時に変更のないチャンクの埋め込み API 呼び出しを省略する。
+合計サイズが上限を超えた場合は最終利用時刻の古いものから削除する。
+"""
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import logging
+from array import array
+from dotenv import load_dotenv
+from metrics import span, increment
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# キャッシュファイルのパス
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "cache/embeddings.sqlite3")
+# キャッシュの最大サイズ（MB）
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "1024"))
+
+
+def normalize_text(text):
+    """
+    キャッシュキー用にテキストを正規化する関数
+    Unicode 正規化（NFC）と前後空白の除去、連続する空白の1文字化を行う。
+    """
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def text_hash(text):
+    """正規化したテキストの SHA-256 ハッシュを返す。"""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite を使った埋め込みベクトルのキャッシュ
+    ベクトルは float32 のバイト列として保存する。
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 保存しているベクトルの合計サイズ（put_many のたびに全件を集計しないよう、差分で更新する）
+        self._total_bytes = None
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def get_many(self, model, texts):
+        """
+        テキストのリストに対応するキャッシュ済みベクトルを返す。
+        :return: texts と同じ順序のリスト（キャッシュにないものは None）
+        """
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with span("embedding_cache.lookup"), self._lock:
+            # SQLite の変数上限を超えないよう分割して問い合わせる
+            unique_hashes = list(dict.fromkeys(hashes))
+            for start in range(0, len(unique_hashes), 500):
+                part = unique_hashes[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *part],
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = array("f", blob).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, h) for h in found],
+                )
+                self._conn.commit()
+
+            results = [found.get(h) for h in hashes]
+            hit_count = sum(1 for r in results if r is not None)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        return results
+
+    def put_many(self, model, texts, vectors):
+        """テキストとベクトルの組をキャッシュに保存し、必要に応じて古いものを削除する。"""
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            if vector is None:
+                continue
+            blob = array("f", vector).tobytes()
+            rows.append((model, text_hash(text), blob, len(blob), now))
+        if not rows:
+            return
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._sum_sizes()
+            # 置き換える行の分を差し引いてから、新しい行の分を加える
+            self._total_bytes -= self._existing_size(model, list({row[1] for row in rows}))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            self._total_bytes += sum(row[3] for row in {row[1]: row for row in rows}.values())
+            self._evict()
+
+    def _sum_sizes(self):
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def _existing_size(self, model, hashes):
+        """キャッシュ済みのベクトルのうち、hashes に含まれるものの合計サイズ"""
+        total = 0
+        for start in range(0, len(hashes), 500):
+            part = hashes[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            total += self._conn.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                [model, *part],
+            ).fetchone()[0]
+        return total
+
+    def _evict(self):
+        """合計サイズが上限を超えていれば、最終利用時刻の古いものから削除する。"""
+        if self._total_bytes <= self.max_bytes:
+            return
+        excess = self._total_bytes - self.max_bytes
+        removed = 0
+        removed_bytes = 0
+        cursor = self._conn.execute("SELECT model, text_hash, size FROM embeddings ORDER BY last_used")
+        targets = []
+        for model, h, size in cursor:
+            if removed_bytes >= excess:
+                break
+            targets.append((model, h))
+            removed_bytes += size
+            removed += 1
+        self._conn.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", targets)
+        self._conn.commit()
+        self._total_bytes -= removed_bytes
+        increment("embedding_cache.evicted", removed)
+        logger.info("埋め込みキャッシュを削減: %d 件 / %d バイト", removed, removed_bytes)
+
+    def stats(self):
+        """ヒット・ミス件数とヒット率を返す。"""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+    def log_stats(self):
+        """ヒット・ミスのレポートをログに出力する。"""
+        stats = self.stats()
+        logger.info(
+            "埋め込みキャッシュ: ヒット %d / ミス %d / ヒット率 %.1f%%",
+            stats["hits"], stats["misses"], stats["hit_rate"] * 100,
+        )
+
+    def close(self):
+        """接続を閉じる。"""
+        with self._lock:
+            self._conn.close()
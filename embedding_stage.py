@@ -0,0 +1,184 @@
+"""
+埋め込み（ベクトル化）ステージ
+チャンクを件数・トークン数の上限つきバッチにまとめ、埋め込み API に送信する（並列数は呼び出し側で指定する）。
+取り込みでは、パイプラインのベクトル化ステージ（BatchStage）が複数ファイルのチャンクをまとめて embed_texts に渡す。
+結果は入力と同じ順序のリストで返すため、呼び出し側でチャンク・ドキュメントに対応付けできる。
+"""
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from dotenv import load_dotenv
+from metrics import span, increment
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# 1バッチあたりの最大チャンク数
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# 1バッチあたりの最大トークン数（概算）
+EMBEDDING_MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", "100000"))
+# 同時に送信するバッチ数
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+# 埋め込みモデル
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-large")
+# 埋め込みベクトルの次元数（text-embedding-3 系は短くできる。未設定の場合はモデルの既定の次元数）
+# インデックスの text_vector の次元数（index_schema.py）と一致させること
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0")) or None
+# モデルごとの既定の次元数
+MODEL_DIMENSIONS = {
+    "text-embedding-3-large": 3072,
+    "text-embedding-3-small": 1536,
+    "text-embedding-ada-002": 1536,
+}
+
+
+def embedding_dimensions(model=None):
+    """取り込み・検索で使うベクトルの次元数を返す。"""
+    return EMBEDDING_DIMENSIONS or MODEL_DIMENSIONS.get(model or EMBEDDING_MODEL, 3072)
+
+
+def create_embeddings(model=None, **kwargs):
+    """
+    設定した次元数の埋め込みクライアント（LangChain の OpenAIEmbeddings）を作成する。
+    次元数を短くできるのは text-embedding-3 系のみ（API 側で切り詰めて正規化したベクトルが返る）。
+    送信は rate_limiter の "embeddings" の上限を全スレッドで共有する。
+    """
+    from langchain_openai import OpenAIEmbeddings
+    from rate_limiter import create_httpx_client, OPENAI_MAX_RETRIES
+    model = model or EMBEDDING_MODEL
+    kwargs.setdefault("max_retries", OPENAI_MAX_RETRIES)
+    kwargs.setdefault("http_client", create_httpx_client("embeddings"))
+    kwargs.setdefault("http_async_client", create_httpx_client("embeddings", asynchronous=True))
+    if EMBEDDING_DIMENSIONS and model.startswith("text-embedding-3"):
+        kwargs.setdefault("dimensions", EMBEDDING_DIMENSIONS)
+    return OpenAIEmbeddings(model=model, **kwargs)
+
+
+def embedding_model_key(embeddings):
+    """キャッシュのキーに使うモデル名（次元数を短くしている場合は "モデル名@次元数"）。"""
+    model = getattr(embeddings, "model", "")
+    dimensions = getattr(embeddings, "dimensions", None)
+    return f"{model}@{dimensions}" if dimensions else model
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """tiktoken のエンコーディングを取得する（使えない場合は None）。"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def estimate_tokens(text):
+    """
+    テキストのトークン数を概算する関数
+    tiktoken が使えればそれを使い、使えない場合は文字数で代用する（日本語はほぼ1文字1トークン）。
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text))
+
+
+def make_batches(texts, batch_size=EMBEDDING_BATCH_SIZE, max_tokens=EMBEDDING_MAX_BATCH_TOKENS):
+    """
+    テキストを件数・トークン数の上限を超えないバッチに分割する関数
+    :param texts: テキストのリスト
+    :return: バッチのリスト。各バッチは (元のインデックス, テキスト) のリスト
+    """
+    batches = []
+    current = []
+    current_tokens = 0
+    total_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        total_tokens += tokens
+        # 上限を超える場合は現在のバッチを確定する（1件で上限超えのものは単独バッチにする）
+        if current and (len(current) >= batch_size or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append((i, text))
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    increment("embedding.tokens", total_tokens)
+    return batches
+
+
+def _embed_batch(embeddings, texts):
+    """1バッチを埋め込み API に送信する。"""
+    with span("embedding.batch"):
+        return embeddings.embed_documents(texts)
+
+
+def embed_texts(embeddings, texts, batch_size=None, max_tokens=None, concurrency=None, cache=None):
+    """
+    テキストのリストをバッチ単位・並行でベクトル化する関数
+    :param embeddings: LangChain の Embeddings（embed_documents を持つオブジェクト）
+    :param texts: ベクトル化するテキストのリスト
+    :param cache: EmbeddingCache（指定時はキャッシュ済みのチャンクを API に送らない）
+    :return: texts と同じ順序のベクトルのリスト
+    """
+    batch_size = batch_size or EMBEDDING_BATCH_SIZE
+    max_tokens = max_tokens or EMBEDDING_MAX_BATCH_TOKENS
+    concurrency = concurrency or EMBEDDING_CONCURRENCY
+
+    vectors = [None] * len(texts)
+    if not texts:
+        return vectors
+
+    # キャッシュにあるものは API に送らない
+    # 次元数が違うベクトルを取り違えないよう、次元数もキャッシュのキーに含める
+    model = embedding_model_key(embeddings)
+    if cache is not None:
+        vectors = cache.get_many(model, texts)
+    pending = [i for i, vector in enumerate(vectors) if vector is None]
+    increment("embedding.texts", len(texts) - len(pending), cached=True)
+    increment("embedding.texts", len(pending), cached=False)
+    if not pending:
+        logger.info("ベクトル化: 全 %d チャンクがキャッシュ済み", len(texts))
+        return vectors
+
+    # バッチ内のインデックスは pending 内の位置なので、元のインデックスに読み替える
+    batches = [
+        [(pending[j], text) for j, text in batch]
+        for batch in make_batches([texts[i] for i in pending], batch_size=batch_size, max_tokens=max_tokens)
+    ]
+    logger.info("ベクトル化開始: %d チャンク / %d バッチ / 並列数 %d", len(pending), len(batches), concurrency)
+
+    start = time.perf_counter()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(_embed_batch, embeddings, [text for _, text in batch]): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                failed += len(batch)
+                logger.exception("ベクトル化失敗（%d チャンク）: %s", len(batch), e)
+                continue
+            # 元のインデックスに結果を書き戻す
+            for (i, _), vector in zip(batch, results):
+                vectors[i] = vector
+            if cache is not None:
+                cache.put_many(model, [text for _, text in batch], results)
+
+    elapsed = time.perf_counter() - start
+    rate = len(pending) / elapsed if elapsed > 0 else 0.0
+    logger.info("ベクトル化完了: %d チャンク / %.2f 秒 / %.1f チャンク/秒", len(pending), elapsed, rate)
+
+    if failed:
+        raise RuntimeError(f"ベクトル化に失敗したチャンクがあります: {failed} 件")
+    return vectors
@@ -0,0 +1,163 @@
+"""
+共通の HTTP クライアント
+Azure AI Search・Blob Storage への呼び出しで1つの requests.Session を共有し、
+ホストごとの Keep-Alive 接続プールを再利用して毎回の TCP/TLS ハンドシェイクを避ける。
+接続プールのサイズ・タイムアウト・リトライは環境変数で設定する。
+Streamlit や取り込みパイプラインの複数スレッドから同時に使ってよい（Cookie は保持しない）。
+非同期処理向けには、イベントループごとに1つの httpx.AsyncClient と同時実行数を制限するセマフォを共有する。
+"""
+import os
+import asyncio
+import threading
+import weakref
+import logging
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+from metrics import span, increment
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# 接続プールを保持するホスト数
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+# ホストごとの最大接続数（同時に使うスレッド数以上にする）
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+# 接続タイムアウト・読み取りタイムアウト（秒）
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+# 接続エラー・一時的なエラーの最大リトライ回数とバックオフ係数
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.5"))
+# 非同期クライアントの同時リクエスト数の上限
+HTTP_ASYNC_CONCURRENCY = int(os.getenv("HTTP_ASYNC_CONCURRENCY", "32"))
+
+_session = None
+_session_lock = threading.Lock()
+# イベントループごとの (AsyncClient, Semaphore)
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _create_session():
+    """接続プールとリトライ設定を持つ Session を作成する。"""
+    # 接続エラーはすべてのメソッドでリトライする。
+    # ステータスコードによるリトライは冪等なメソッドだけに限る（POST は呼び出し側で判断する）
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        connect=HTTP_MAX_RETRIES,
+        read=HTTP_MAX_RETRIES,
+        status=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # スレッド間で共有するため Cookie は保持しない
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def get_session():
+    """プロセス共通の Session を返す（初回呼び出し時に作成する）。"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+                logger.info(
+                    "HTTP セッション作成: プール %d ホスト × %d 接続", HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE
+                )
+    return _session
+
+
+def request(method, url, **kwargs):
+    """共通の Session でリクエストを送信する（timeout 未指定時は既定のタイムアウトを使う）。"""
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    host = urlsplit(url).hostname
+    with span("http.request", method=method, host=host):
+        response = get_session().request(method, url, **kwargs)
+    # urllib3 がステータスコード・接続エラーでリトライした回数を数える
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and retries.history:
+        increment("http.retries", len(retries.history), method=method, host=host)
+    return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def head(url, **kwargs):
+    return request("HEAD", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
+
+
+def _get_async_entry():
+    """実行中のイベントループに対応する AsyncClient とセマフォを返す（初回呼び出し時に作成する）。"""
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get(loop)
+    if entry is None:
+        # httpx は非同期処理を使う場合だけ import する（起動時間を短くするため）
+        import httpx
+        transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_MAXSIZE,
+                max_keepalive_connections=HTTP_POOL_MAXSIZE,
+            ),
+            # 接続エラーのみリトライする
+            retries=HTTP_MAX_RETRIES,
+        )
+        client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        )
+        entry = (client, asyncio.Semaphore(HTTP_ASYNC_CONCURRENCY))
+        _async_clients[loop] = entry
+        logger.info("非同期 HTTP クライアント作成: 同時実行数 %d", HTTP_ASYNC_CONCURRENCY)
+    return entry
+
+
+async def arequest(method, url, **kwargs):
+    """共通の AsyncClient でリクエストを送信する（同時実行数はセマフォで制限する）。"""
+    client, semaphore = _get_async_entry()
+    async with semaphore:
+        with span("http.request", method=method, host=urlsplit(url).hostname):
+            return await client.request(method, url, **kwargs)
+
+
+async def apost(url, **kwargs):
+    return await arequest("POST", url, **kwargs)
+
+
+async def aclose():
+    """実行中のイベントループの AsyncClient を閉じる。"""
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.pop(loop, None)
+    if entry is not None:
+        await entry[0].aclose()
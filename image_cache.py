@@ -0,0 +1,279 @@
+"""
+画像キャッシュ（検索アプリ用）
+Blob Storage の画像をメモリとローカルディスクの2段でキャッシュする。
+どちらもバイト数の上限を超えた場合は最も長く使われていないものから削除する。
+取得から一定時間内の画像はネットワークに問い合わせずに返し、それ以降は ETag（If-None-Match）で再検証する。
+検索結果が返った時点で参照される画像をまとめて並行に先読みし、同じ Blob を同時に2度取得しない。
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from blobstorage import download_blob_if_modified
+from metrics import span, increment
+from logging_config import configure_logging
+
+# ロギング初期化
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# ディスクキャッシュの保存先
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "cache/images")
+# メモリキャッシュ・ディスクキャッシュの最大サイズ（MB）
+IMAGE_CACHE_MEMORY_MB = int(os.getenv("IMAGE_CACHE_MEMORY_MB", "64"))
+IMAGE_CACHE_DISK_MB = int(os.getenv("IMAGE_CACHE_DISK_MB", "512"))
+# 取得後、再検証せずに使う時間（秒）
+IMAGE_CACHE_FRESH_SECONDS = float(os.getenv("IMAGE_CACHE_FRESH_SECONDS", "300"))
+# 先読みの同時実行数
+IMAGE_FETCH_CONCURRENCY = int(os.getenv("IMAGE_FETCH_CONCURRENCY", "8"))
+
+
+class _Entry:
+    """キャッシュしている画像データと ETag・取得時刻"""
+
+    def __init__(self, data, etag, fetched_at):
+        self.data = data
+        self.etag = etag
+        self.fetched_at = fetched_at
+
+
+class ImageCache:
+    """
+    Blob Storage の画像のメモリ・ディスクキャッシュ
+    """
+
+    def __init__(self, cache_dir=IMAGE_CACHE_DIR, memory_bytes=IMAGE_CACHE_MEMORY_MB * 1024 * 1024,
+                 disk_bytes=IMAGE_CACHE_DISK_MB * 1024 * 1024, fresh_seconds=IMAGE_CACHE_FRESH_SECONDS,
+                 workers=IMAGE_FETCH_CONCURRENCY):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.fresh_seconds = fresh_seconds
+        self.hits = 0
+        self.revalidated = 0
+        self.downloads = 0
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # 先読み完了時のコールバックが取得時と同じスレッドで呼ばれることがあるため再入可能なロックにする
+        self._lock = threading.RLock()
+        # 取得中の Blob パス -> Future（同じ Blob を同時に2度取得しない）
+        self._in_flight = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="image-fetch")
+        os.makedirs(cache_dir, exist_ok=True)
+        self._disk_size = sum(
+            os.path.getsize(os.path.join(cache_dir, name))
+            for name in os.listdir(cache_dir)
+            if name.endswith(".bin")
+        )
+
+    # --- メモリキャッシュ ---
+    def _memory_get(self, blob_path):
+        with self._lock:
+            entry = self._memory.get(blob_path)
+            if entry is not None:
+                self._memory.move_to_end(blob_path)
+            return entry
+
+    def _memory_put(self, blob_path, entry):
+        size = len(entry.data)
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(blob_path, None)
+            if old is not None:
+                self._memory_size -= len(old.data)
+            self._memory[blob_path] = entry
+            self._memory_size += size
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted.data)
+
+    # --- ディスクキャッシュ ---
+    def _disk_paths(self, blob_path):
+        name = hashlib.sha1(blob_path.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, name)
+        return base + ".bin", base + ".json"
+
+    def _disk_get(self, blob_path):
+        data_path, meta_path = self._disk_paths(blob_path)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(data_path, "rb") as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        # 最終利用時刻を更新して LRU の順序に反映する
+        os.utime(data_path)
+        return _Entry(data, meta.get("etag"), meta.get("fetched_at", 0))
+
+    def _disk_put(self, blob_path, entry):
+        data_path, meta_path = self._disk_paths(blob_path)
+        try:
+            old_size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+            with open(data_path + ".tmp", "wb") as f:
+                f.write(entry.data)
+            os.replace(data_path + ".tmp", data_path)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"blob_path": blob_path, "etag": entry.etag, "fetched_at": entry.fetched_at}, f)
+        except OSError as e:
+            logger.warning("画像キャッシュの書き込みに失敗しました: %s %s", blob_path, e)
+            return
+        with self._lock:
+            self._disk_size += len(entry.data) - old_size
+            over = self._disk_size > self.disk_bytes
+        if over:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """ディスクキャッシュが上限を超えていれば、最終利用時刻の古いものから削除する。"""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".bin"):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.disk_bytes:
+                break
+            for remove_path in (path, path[:-4] + ".json"):
+                try:
+                    os.remove(remove_path)
+                except OSError:
+                    pass
+            total -= size
+        with self._lock:
+            self._disk_size = total
+
+    def _touch(self, blob_path, entry):
+        """再検証した画像の取得時刻を更新する。"""
+        entry.fetched_at = time.time()
+        self._memory_put(blob_path, entry)
+        _, meta_path = self._disk_paths(blob_path)
+        try:
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"blob_path": blob_path, "etag": entry.etag, "fetched_at": entry.fetched_at}, f)
+        except OSError:
+            pass
+
+    # --- 取得 ---
+    def _fetch(self, blob_path):
+        with span("image.fetch"):
+            return self._fetch_entry(blob_path)
+
+    def _fetch_entry(self, blob_path):
+        entry = self._memory_get(blob_path)
+        if entry is None:
+            entry = self._disk_get(blob_path)
+            if entry is not None:
+                self._memory_put(blob_path, entry)
+        if entry is not None and time.time() - entry.fetched_at < self.fresh_seconds:
+            with self._lock:
+                self.hits += 1
+            increment("image_cache.requests", result="hit")
+            return entry.data
+
+        try:
+            status, data, etag = download_blob_if_modified(blob_path, entry.etag if entry else None)
+        except Exception as e:
+            logger.exception("画像のダウンロードに失敗しました: %s %s", blob_path, e)
+            return entry.data if entry else None
+
+        if status == 304 and entry is not None:
+            with self._lock:
+                self.revalidated += 1
+            increment("image_cache.requests", result="revalidated")
+            self._touch(blob_path, entry)
+            return entry.data
+        if status == 200 and data is not None:
+            with self._lock:
+                self.downloads += 1
+            increment("image_cache.requests", result="download")
+            entry = _Entry(data, etag, time.time())
+            self._memory_put(blob_path, entry)
+            self._disk_put(blob_path, entry)
+            return data
+        # 取得に失敗した場合は古いデータがあればそれを返す
+        return entry.data if entry else None
+
+    def _submit(self, blob_path):
+        with self._lock:
+            future = self._in_flight.get(blob_path)
+            if future is None:
+                future = self._executor.submit(self._fetch, blob_path)
+                self._in_flight[blob_path] = future
+                future.add_done_callback(lambda _: self._done(blob_path))
+            return future
+
+    def _done(self, blob_path):
+        with self._lock:
+            self._in_flight.pop(blob_path, None)
+
+    def prefetch(self, blob_paths):
+        """画像をまとめて並行に先読みする（完了は待たない）。"""
+        for blob_path in dict.fromkeys(blob_paths):
+            if blob_path:
+                self._submit(blob_path)
+
+    def get(self, blob_path):
+        """
+        画像データを返す（先読み中であれば完了を待つ）。
+        :return: 画像データ（取得できない場合は None）
+        """
+        entry = self._memory_get(blob_path)
+        if entry is not None and time.time() - entry.fetched_at < self.fresh_seconds:
+            with self._lock:
+                self.hits += 1
+            increment("image_cache.requests", result="hit")
+            return entry.data
+        # 先読み・取得の完了待ちの時間（呼び出し側のトレースに記録される）
+        with span("image.wait"):
+            return self._submit(blob_path).result()
+
+    def get_with_etag(self, blob_path):
+        """
+        画像データと ETag を返す。
+        :return: (画像データ, ETag)。取得できない場合は (None, None)
+        """
+        data = self.get(blob_path)
+        if data is None:
+            return None, None
+        entry = self._memory_get(blob_path)
+        etag = entry.etag if entry is not None and entry.data is data else None
+        return data, etag
+
+    def stats(self):
+        """キャッシュヒット・再検証・ダウンロードの件数とキャッシュサイズを返す。"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "downloads": self.downloads,
+                "memory_bytes": self._memory_size,
+                "disk_bytes": self._disk_size,
+            }
+
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache():
+    """プロセス共通の ImageCache を返す（Streamlit の再実行をまたいで共有する）。"""
+    global _image_cache
+    if _image_cache is None:
+        with _image_cache_lock:
+            if _image_cache is None:
+                _image_cache = ImageCache()
+    return _image_cache
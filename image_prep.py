@@ -0,0 +1,133 @@
+"""
+画像の前処理（LLM プロンプト用・表示用）
+画像を設定した最大辺に縮小して効率のよい形式で再圧縮し、LLM に渡す data URI と
+Streamlit で表示するバイト列を作る。結果は (Blob パス, ETag) をキーにキャッシュし、
+再実行のたびに PIL で同じ画像を処理しないようにする。
+"""
+import os
+import base64
+import hashlib
+import logging
+from io import BytesIO
+from dotenv import load_dotenv
+from ttl_cache import TTLCache
+from metrics import span, increment
+from logging_config import configure_logging
+
+# ロギング初期化
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# LLM に渡す画像の最大辺（ピクセル）と形式・品質
+IMAGE_PROMPT_MAX_EDGE = int(os.getenv("IMAGE_PROMPT_MAX_EDGE", "1536"))
+IMAGE_PROMPT_FORMAT = os.getenv("IMAGE_PROMPT_FORMAT", "WEBP").upper()
+IMAGE_PROMPT_QUALITY = int(os.getenv("IMAGE_PROMPT_QUALITY", "85"))
+# 表示用画像の最大辺（ピクセル）
+IMAGE_DISPLAY_MAX_EDGE = int(os.getenv("IMAGE_DISPLAY_MAX_EDGE", "2048"))
+# 前処理結果のキャッシュの最大サイズ（MB。表示用のバイト列と data URI の合計）
+IMAGE_PREP_CACHE_MB = int(os.getenv("IMAGE_PREP_CACHE_MB", "64"))
+
+_MIME_TYPES = {"WEBP": "image/webp", "JPEG": "image/jpeg", "PNG": "image/png"}
+
+# (Blob パス, ETag またはデータのハッシュ) -> PreparedImage
+prepared_image_cache = TTLCache(
+    maxsize=None, maxbytes=IMAGE_PREP_CACHE_MB * 1024 * 1024, sizeof=lambda prepared: prepared.nbytes
+)
+
+
+class PreparedImage:
+    """
+    前処理済みの画像
+    :param display_bytes: Streamlit 表示用のバイト列
+    :param data_uri: LLM プロンプト用の data URI（作成できない場合は None）
+    """
+
+    def __init__(self, display_bytes, data_uri):
+        self.display_bytes = display_bytes
+        self.data_uri = data_uri
+
+    @property
+    def nbytes(self):
+        """保持しているデータの大きさ（バイト）"""
+        return len(self.display_bytes) + len(self.data_uri or "")
+
+    def image_template(self):
+        """プロンプトに渡す image_url テンプレートを返す。"""
+        if self.data_uri is None:
+            return None
+        return {"type": "image_url", "image_url": {"url": self.data_uri}}
+
+
+def _resize(image, max_edge):
+    """最大辺が max_edge を超える場合は縦横比を保って縮小した画像を返す。"""
+    if max(image.size) <= max_edge:
+        return image
+    resized = image.copy()
+    resized.thumbnail((max_edge, max_edge))
+    return resized
+
+
+def _encode(image, image_format, quality):
+    """画像を指定の形式で再圧縮したバイト列を返す。"""
+    from PIL import Image
+
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        # JPEG は透過をサポートしないため白背景に合成する
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        rgba = image.convert("RGBA")
+        background.paste(rgba, (0, 0), rgba)
+        image = background
+    elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA")
+    out = BytesIO()
+    if image_format == "PNG":
+        image.save(out, format="PNG", optimize=True)
+    else:
+        image.save(out, format=image_format, quality=quality)
+    return out.getvalue()
+
+
+def _prepare(data):
+    """画像データから PreparedImage を作る。PIL で開けない画像は元のデータをそのまま使う。"""
+    try:
+        from PIL import Image
+        image = Image.open(BytesIO(data))
+        image.load()
+    except Exception:
+        # PIL で扱えない形式は元データをそのまま表示・送信する
+        import filetype
+        kind = filetype.guess(data)
+        mime_type = kind.mime if kind is not None else "application/octet-stream"
+        data_uri = f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+        return PreparedImage(data, data_uri)
+
+    # 表示用: 縮小して PNG に変換する（フォーマットを確定させて st.image で確実に表示できるようにする）
+    display_bytes = _encode(_resize(image, IMAGE_DISPLAY_MAX_EDGE), "PNG", IMAGE_PROMPT_QUALITY)
+
+    # プロンプト用: 最大辺まで縮小して再圧縮する
+    prompt_bytes = _encode(_resize(image, IMAGE_PROMPT_MAX_EDGE), IMAGE_PROMPT_FORMAT, IMAGE_PROMPT_QUALITY)
+    mime_type = _MIME_TYPES.get(IMAGE_PROMPT_FORMAT, "application/octet-stream")
+    data_uri = f"data:{mime_type};base64,{base64.b64encode(prompt_bytes).decode('utf-8')}"
+    logger.debug(
+        "画像を前処理: %s -> %d バイト（元 %d バイト, %dx%d）",
+        IMAGE_PROMPT_FORMAT, len(prompt_bytes), len(data), image.size[0], image.size[1],
+    )
+    return PreparedImage(display_bytes, data_uri)
+
+
+def prepare_image(blob_path, data, etag=None):
+    """
+    画像を前処理した結果を返す（同じ Blob・同じ内容であればキャッシュを返す）。
+    :param blob_path: Blob のパス
+    :param data: 画像データ
+    :param etag: Blob の ETag（不明な場合はデータのハッシュをキーに使う）
+    """
+    key = (blob_path, etag or hashlib.sha1(data).hexdigest())
+    prepared = prepared_image_cache.get(key)
+    increment("image_prep.cache", result="miss" if prepared is None else "hit")
+    if prepared is None:
+        with span("image.prepare"):
+            prepared = _prepare(data)
+        prepared_image_cache.set(key, prepared)
+    return prepared
@@ -0,0 +1,152 @@
+"""
+画像の同期（Blob Storage へのアップロード）
+1回の実行の中では同じ Blob パスの画像を1度しかアップロードせず、
+前回アップロード時と内容（MD5）が同じ画像はアップロードを省略する。
+残りのアップロードはスレッドプールで並行に実行する。
+"""
+import os
+import json
+import base64
+import hashlib
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from blobstorage import upload_image_to_blob_storage_via_restapi, get_blob_properties
+from metrics import increment
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# アップロード済み画像の MD5 を記録するファイルのパス
+IMAGE_SYNC_RECORD_PATH = os.getenv("IMAGE_SYNC_RECORD_PATH", "cache/image_sync.json")
+# 同時にアップロードする画像数
+IMAGE_UPLOAD_CONCURRENCY = int(os.getenv("IMAGE_UPLOAD_CONCURRENCY", "8"))
+# ローカルの記録がない場合に HEAD リクエストで Blob の Content-MD5 を確認するかどうか
+IMAGE_SYNC_CHECK_REMOTE = os.getenv("IMAGE_SYNC_CHECK_REMOTE", "true").lower() == "true"
+
+
+def file_md5(path):
+    """ファイル内容の MD5 を Blob Storage の Content-MD5 と同じ Base64 形式で返す。"""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(block)
+    return base64.b64encode(md5.digest()).decode("ascii")
+
+
+class ImageSyncer:
+    """
+    画像を Blob Storage に同期するクラス
+    同じ Blob パスへの同期要求は実行中・完了済みの結果を共有する。
+    """
+
+    def __init__(self, record_path=IMAGE_SYNC_RECORD_PATH, workers=IMAGE_UPLOAD_CONCURRENCY,
+                 check_remote=IMAGE_SYNC_CHECK_REMOTE):
+        self.record_path = record_path
+        self.check_remote = check_remote
+        self.uploaded = 0
+        self.skipped = 0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="image-sync")
+        self._lock = threading.Lock()
+        # Blob パスごとの同期結果（Future）
+        self._futures = {}
+        # ローカルファイルごとの MD5（同じファイルを何度もハッシュしない）
+        self._md5s = {}
+        # 前回までにアップロードした Blob パスと MD5 の記録
+        self._record = {}
+        if os.path.exists(record_path):
+            try:
+                with open(record_path, "r", encoding="utf-8") as f:
+                    self._record = json.load(f)
+            except Exception as e:
+                logger.exception("画像同期の記録の読み込みに失敗しました: %s", e)
+
+    def _md5(self, image_path):
+        with self._lock:
+            md5 = self._md5s.get(image_path)
+        if md5 is None:
+            md5 = file_md5(image_path)
+            with self._lock:
+                self._md5s[image_path] = md5
+        return md5
+
+    def _sync_one(self, blob_path, image_path):
+        """1件の画像を同期し、Blob に最新の内容があれば True を返す。"""
+        md5 = self._md5(image_path)
+        with self._lock:
+            recorded = self._record.get(blob_path)
+        if recorded == md5:
+            with self._lock:
+                self.skipped += 1
+            increment("image_sync.images", result="skipped_local")
+            return True
+
+        if self.check_remote:
+            properties = get_blob_properties(blob_path)
+            if properties is not None and properties.get("Content-MD5") == md5:
+                with self._lock:
+                    self._record[blob_path] = md5
+                    self.skipped += 1
+                increment("image_sync.images", result="skipped_remote")
+                return True
+
+        response = upload_image_to_blob_storage_via_restapi(
+            blob_path=blob_path,
+            image_path=image_path,
+            content_md5=md5,
+        )
+        if response.status_code != 201:
+            increment("image_sync.images", result="failed")
+            return False
+        with self._lock:
+            self._record[blob_path] = md5
+            self.uploaded += 1
+        increment("image_sync.images", result="uploaded")
+        return True
+
+    def _safe_sync_one(self, blob_path, image_path):
+        try:
+            return self._sync_one(blob_path, image_path)
+        except Exception as e:
+            logger.exception("画像アップロード失敗: %s %s", image_path, e)
+            return False
+
+    def sync(self, images):
+        """
+        画像をまとめて同期する。
+        :param images: (Blob パス, ローカルの画像ファイルパス) のリスト
+        :return: Blob パスごとの成否の辞書
+        """
+        futures = {}
+        with self._lock:
+            for blob_path, image_path in images:
+                if blob_path in futures:
+                    continue
+                future = self._futures.get(blob_path)
+                if future is None:
+                    future = self._executor.submit(self._safe_sync_one, blob_path, image_path)
+                    self._futures[blob_path] = future
+                futures[blob_path] = future
+        return {blob_path: future.result() for blob_path, future in futures.items()}
+
+    def save(self):
+        """アップロード済みの記録を書き出す。"""
+        with self._lock:
+            record = dict(self._record)
+        dirname = os.path.dirname(self.record_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = self.record_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, self.record_path)
+
+    def close(self):
+        """スレッドプールを終了し、記録を保存する。"""
+        self._executor.shutdown(wait=True)
+        self.save()
+        logger.info("画像同期: アップロード %d / スキップ %d", self.uploaded, self.skipped)
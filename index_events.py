@@ -0,0 +1,104 @@
+"""
+インデックス更新イベントの記録
+取り込みスクリプトがインデックスを更新したときに、更新・削除したドキュメント id を
+ローカルの JSON Lines ファイルに追記する。
+検索アプリ側はファイルの状態（サイズ・更新時刻）を世代として監視し、変わったらキャッシュを無効化する。
+取り込みと検索は別プロセスで動くため、プロセス間の通知にファイルを使う。
+"""
+import os
+import json
+import hashlib
+import time
+import threading
+import logging
+from dotenv import load_dotenv
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# 更新イベントを記録するファイルのパス
+INDEX_EVENTS_PATH = os.getenv("INDEX_EVENTS_PATH", "cache/index_events.jsonl")
+
+_write_lock = threading.Lock()
+
+
+def record_index_update(ids, path=INDEX_EVENTS_PATH):
+    """
+    インデックスを更新したことを記録する。
+    :param ids: 更新・削除したドキュメント id のリスト
+    """
+    event = {"time": time.time(), "ids": list(ids)}
+    dirname = os.path.dirname(path)
+    with _write_lock:
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+def current_index_generation(path=INDEX_EVENTS_PATH):
+    """
+    インデックスの世代を返す（更新イベントが記録されるたびに変わる値）。
+    ファイルを読まずに stat だけで判定するため、検索のたびに呼んでもよい。
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return (0, 0)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _file_id(f):
+    """
+    ファイルの識別子（先頭の行のハッシュ）を返す。先頭の行が書き込み途中の場合は None。
+    inode は作り直したファイルでも再利用されることがあるため、最初のイベント（記録時刻を含む）で見分ける。
+    """
+    f.seek(0)
+    first = f.readline()
+    if not first.endswith(b"\n"):
+        return None
+    return hashlib.sha1(first).hexdigest()
+
+
+def index_events_end(path=INDEX_EVENTS_PATH):
+    """
+    ファイル全体を読まずに、現在の末尾の位置を返す（これ以降に記録されたイベントだけを読むために使う）。
+    :return: read_index_events に渡す位置（ファイルの識別子, バイト位置）
+    """
+    try:
+        with open(path, "rb") as f:
+            return _file_id(f), os.fstat(f.fileno()).st_size
+    except FileNotFoundError:
+        return None, 0
+
+
+def read_index_events(position=(None, 0), path=INDEX_EVENTS_PATH):
+    """
+    position 以降に記録された更新イベントを読み込む。
+    ファイルが作り直されていた場合（識別子が変わった・小さくなった場合）は先頭から読み直す。
+    :param position: 前回の読み込みで返された位置（ファイルの識別子, バイト位置）
+    :return: (イベントのリスト, 次回の読み込み開始位置)
+    """
+    file_id, offset = position
+    events = []
+    try:
+        with open(path, "rb") as f:
+            current_id = _file_id(f)
+            if (file_id is not None and current_id != file_id) or offset > os.fstat(f.fileno()).st_size:
+                offset = 0
+            f.seek(offset)
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    # 書き込み途中の行は次回読み込む
+                    break
+                offset = f.tell()
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    logger.warning("更新イベントの解析に失敗しました: %s", line.strip())
+    except FileNotFoundError:
+        return [], (None, 0)
+    return events, (current_id, offset)
@@ -0,0 +1,374 @@
+"""
+インデックス定義の管理
+Azure AI Search のインデックス（フィールド・ベクトル検索の設定）を定義し、作成・移行する。
+ベクトルの保存容量・メモリ・アップロード量・ベクトル検索の遅延を抑えるため、次の設定を環境変数で指定できる。
+- EMBEDDING_DIMENSIONS: ベクトルの次元数（text-embedding-3 系は短くできる。取り込み・検索も同じ次元数で埋め込む）
+- VECTOR_TYPE: ベクトルの型（single: 32bit 浮動小数点 / half: 16bit 浮動小数点）
+- VECTOR_COMPRESSION: ベクトルの圧縮（none / scalar: int8 への量子化 / binary: 1bit への量子化）
+- HNSW_M / HNSW_EF_CONSTRUCTION / HNSW_EF_SEARCH: HNSW のパラメータ
+
+使い方:
+    python index_schema.py show             # 作成するインデックス定義を表示する
+    python index_schema.py create           # インデックスを作成する（既にある場合は何もしない）
+    python index_schema.py migrate          # 既存のインデックスとの差分を表示し、更新できるものは更新する
+    python index_schema.py migrate --recreate   # 更新できない差分がある場合はインデックスを作り直す
+"""
+import os
+import sys
+import json
+import argparse
+import logging
+from dotenv import load_dotenv
+from embedding_stage import EMBEDDING_MODEL, embedding_dimensions
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
+AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX")
+AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
+API_VERSION = "2024-07-01"
+
+# ベクトルの型（single / half）
+VECTOR_TYPE = os.getenv("VECTOR_TYPE", "single").lower()
+# ベクトルの圧縮（none / scalar / binary）
+VECTOR_COMPRESSION = os.getenv("VECTOR_COMPRESSION", "none").lower()
+# 圧縮したベクトルで候補を多めに取り、元のベクトルで並べ直す際の倍率
+VECTOR_OVERSAMPLING = float(os.getenv("VECTOR_OVERSAMPLING", "4"))
+# 元のベクトルを検索結果として返せる形でも保存するか（false で保存容量を減らせる。検索には影響しない）
+VECTOR_STORED = os.getenv("VECTOR_STORED", "false").lower() == "true"
+# アップロードするベクトルの小数点以下の桁数（未設定の場合、half では 5 桁・single では丸めない）
+VECTOR_UPLOAD_DECIMALS = os.getenv("VECTOR_UPLOAD_DECIMALS")
+# HNSW のパラメータ
+HNSW_M = int(os.getenv("HNSW_M", "4"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "400"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "500"))
+HNSW_METRIC = os.getenv("HNSW_METRIC", "cosine")
+# クエリを検索サービス側でベクトル化する（"kind": "text" のベクトルクエリ）ための Azure OpenAI の設定
+AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
+AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
+AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", EMBEDDING_MODEL)
+
+VECTOR_FIELD = "text_vector"
+VECTOR_PROFILE = "text-vector-profile"
+_VECTOR_TYPES = {"single": "Collection(Edm.Single)", "half": "Collection(Edm.Half)"}
+_COMPRESSIONS = {
+    "scalar": {
+        "name": "scalar-quantization",
+        "kind": "scalarQuantization",
+        "scalarQuantizationParameters": {"quantizedDataType": "int8"},
+    },
+    "binary": {
+        "name": "binary-quantization",
+        "kind": "binaryQuantization",
+    },
+}
+
+
+def _headers():
+    return {
+        "Content-Type": "application/json",
+        "api-key": AZURE_SEARCH_API_KEY
+    }
+
+
+def _index_url(index_name=None):
+    return f"{AZURE_SEARCH_ENDPOINT}/indexes/{index_name or AZURE_SEARCH_INDEX}?api-version={API_VERSION}"
+
+
+def _upload_decimals():
+    if VECTOR_UPLOAD_DECIMALS:
+        return int(VECTOR_UPLOAD_DECIMALS)
+    # 16bit 浮動小数点の精度（有効数字 3 桁程度）より細かい桁は送っても保存されない
+    return 5 if VECTOR_TYPE == "half" else None
+
+
+def compact_vector(vector):
+    """
+    アップロードするベクトルをインデックスの型に合わせた桁数に丸める（JSON の大きさを減らす）。
+    """
+    decimals = _upload_decimals()
+    if decimals is None:
+        return vector
+    return [round(value, decimals) for value in vector]
+
+
+def build_index_definition(index_name=None):
+    """
+    インデックス定義（REST API の Create Index の本文）を作る。
+    """
+    if VECTOR_TYPE not in _VECTOR_TYPES:
+        raise ValueError(f"VECTOR_TYPE は {'/'.join(_VECTOR_TYPES)} のいずれかを指定してください: {VECTOR_TYPE}")
+    if VECTOR_COMPRESSION not in ("none", *_COMPRESSIONS):
+        raise ValueError(f"VECTOR_COMPRESSION は none/scalar/binary のいずれかを指定してください: {VECTOR_COMPRESSION}")
+
+    fields = [
+        # id の昇順でページングして一覧を取得するため sortable にする
+        {"name": "id", "type": "Edm.String", "key": True, "filterable": True, "sortable": True, "searchable": False},
+        {"name": "text", "type": "Edm.String", "searchable": True, "analyzer": "ja.microsoft"},
+        {"name": "title", "type": "Edm.String", "searchable": True, "analyzer": "ja.microsoft"},
+        {"name": "parent_filename", "type": "Edm.String", "filterable": True, "searchable": False},
+        {"name": "imagebloburls", "type": "Collection(Edm.String)", "searchable": False},
+        {"name": "image_filenames", "type": "Collection(Edm.String)", "searchable": False},
+        {
+            "name": VECTOR_FIELD,
+            "type": _VECTOR_TYPES[VECTOR_TYPE],
+            "searchable": True,
+            # ベクトルは検索結果として返さない（stored=false の場合は保存もしない）
+            "retrievable": False,
+            "stored": VECTOR_STORED,
+            "dimensions": embedding_dimensions(),
+            "vectorSearchProfile": VECTOR_PROFILE,
+        },
+    ]
+
+    profile = {"name": VECTOR_PROFILE, "algorithm": "hnsw"}
+    vector_search = {
+        "algorithms": [
+            {
+                "name": "hnsw",
+                "kind": "hnsw",
+                "hnswParameters": {
+                    "m": HNSW_M,
+                    "efConstruction": HNSW_EF_CONSTRUCTION,
+                    "efSearch": HNSW_EF_SEARCH,
+                    "metric": HNSW_METRIC,
+                },
+            }
+        ],
+        "profiles": [profile],
+    }
+    if VECTOR_COMPRESSION != "none":
+        compression = dict(_COMPRESSIONS[VECTOR_COMPRESSION])
+        # 圧縮したベクトルで多めに候補を取り、元のベクトルで並べ直して精度の低下を抑える
+        compression["rerankWithOriginalVectors"] = True
+        compression["defaultOversampling"] = VECTOR_OVERSAMPLING
+        vector_search["compressions"] = [compression]
+        profile["compression"] = compression["name"]
+    if AZURE_OPENAI_ENDPOINT:
+        vector_search["vectorizers"] = [
+            {
+                "name": "azure-openai",
+                "kind": "azureOpenAI",
+                "azureOpenAIParameters": {
+                    "resourceUri": AZURE_OPENAI_ENDPOINT,
+                    "deploymentId": AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+                    "apiKey": AZURE_OPENAI_API_KEY,
+                    "modelName": EMBEDDING_MODEL,
+                },
+            }
+        ]
+        profile["vectorizer"] = "azure-openai"
+
+    return {
+        "name": index_name or AZURE_SEARCH_INDEX,
+        "fields": fields,
+        "vectorSearch": vector_search,
+    }
+
+
+def get_index_definition(index_name=None):
+    """
+    既存のインデックス定義を取得する。
+    :return: インデックス定義（存在しない場合は None）
+    """
+    import http_client
+    resp = http_client.get(_index_url(index_name), headers=_headers())
+    if resp.status_code == 404:
+        return None
+    if resp.status_code != 200:
+        raise RuntimeError(f"インデックス定義の取得に失敗しました: {resp.status_code} {resp.text}")
+    return resp.json()
+
+
+def put_index_definition(definition):
+    """インデックスを作成・更新する。"""
+    import http_client
+    resp = http_client.put(_index_url(definition["name"]), headers=_headers(), json=definition)
+    if resp.status_code not in (200, 201, 204):
+        raise RuntimeError(f"インデックスの作成・更新に失敗しました: {resp.status_code} {resp.text}")
+    logger.info("インデックスを作成・更新しました: %s", definition["name"])
+
+
+def delete_index(index_name=None):
+    """インデックスを削除する。"""
+    import http_client
+    resp = http_client.delete(_index_url(index_name), headers=_headers())
+    if resp.status_code not in (204, 404):
+        raise RuntimeError(f"インデックスの削除に失敗しました: {resp.status_code} {resp.text}")
+    logger.info("インデックスを削除しました: %s", index_name or AZURE_SEARCH_INDEX)
+
+
+# フィールドの属性のうち、作成後に変更できないもの
+_FIXED_FIELD_ATTRIBUTES = (
+    "type", "key", "searchable", "filterable", "sortable", "facetable", "analyzer",
+    "stored", "dimensions", "vectorSearchProfile",
+)
+
+
+def _by_name(items):
+    return {item["name"]: item for item in items or []}
+
+
+def diff_index(current, desired):
+    """
+    既存のインデックス定義と作成したい定義の差分を返す。
+    :return: (更新で反映できる差分, 作り直さないと反映できない差分) の説明のリスト
+    """
+    updatable = []
+    breaking = []
+    current_fields = _by_name(current.get("fields"))
+    for name, field in _by_name(desired["fields"]).items():
+        existing = current_fields.get(name)
+        if existing is None:
+            updatable.append(f"フィールド追加: {name}")
+            continue
+        for attribute in _FIXED_FIELD_ATTRIBUTES:
+            if attribute not in field:
+                continue
+            # 既定値で省略されている属性は比較しない
+            if existing.get(attribute) is not None and existing.get(attribute) != field[attribute]:
+                breaking.append(f"フィールド {name}.{attribute}: {existing.get(attribute)} -> {field[attribute]}")
+        if field.get("retrievable") is not None and existing.get("retrievable") != field["retrievable"]:
+            updatable.append(f"フィールド {name}.retrievable: {existing.get('retrievable')} -> {field['retrievable']}")
+    for name in current_fields.keys() - _by_name(desired["fields"]).keys():
+        # 定義にないフィールドは削除できないが、残っていても取り込み・検索には影響しない
+        logger.info("定義にないフィールドがあります（そのまま残します）: %s", name)
+
+    current_search = current.get("vectorSearch") or {}
+    desired_search = desired["vectorSearch"]
+    current_algorithms = _by_name(current_search.get("algorithms"))
+    for name, algorithm in _by_name(desired_search["algorithms"]).items():
+        existing = current_algorithms.get(name)
+        if existing is None:
+            updatable.append(f"アルゴリズム追加: {name}")
+        elif existing.get("hnswParameters") != algorithm["hnswParameters"]:
+            updatable.append(f"HNSW パラメータ {name}: {existing.get('hnswParameters')} -> {algorithm['hnswParameters']}")
+    current_profiles = _by_name(current_search.get("profiles"))
+    in_use = {field.get("vectorSearchProfile") for field in current_fields.values()}
+    for name, profile in _by_name(desired_search["profiles"]).items():
+        existing = current_profiles.get(name)
+        if existing is None:
+            updatable.append(f"プロファイル追加: {name}")
+            continue
+        for attribute in ("algorithm", "compression", "vectorizer"):
+            if existing.get(attribute) == profile.get(attribute):
+                continue
+            message = f"プロファイル {name}.{attribute}: {existing.get(attribute)} -> {profile.get(attribute)}"
+            # 使用中のプロファイルの圧縮は変更できない（ベクトルの作り直しが必要）
+            if attribute == "compression" and name in in_use:
+                breaking.append(message)
+            else:
+                updatable.append(message)
+    current_compressions = _by_name(current_search.get("compressions"))
+    for name, compression in _by_name(desired_search.get("compressions")).items():
+        existing = current_compressions.get(name)
+        if existing is None:
+            updatable.append(f"圧縮の追加: {name}")
+        elif {k: v for k, v in existing.items() if k in compression} != compression:
+            breaking.append(f"圧縮 {name} の設定変更")
+    current_vectorizers = _by_name(current_search.get("vectorizers"))
+    for name, vectorizer in _by_name(desired_search.get("vectorizers")).items():
+        existing = current_vectorizers.get(name)
+        if existing is None or existing.get("azureOpenAIParameters", {}).get("deploymentId") != \
+                vectorizer["azureOpenAIParameters"]["deploymentId"]:
+            updatable.append(f"ベクトライザーの追加・変更: {name}")
+    return updatable, breaking
+
+
+def check_vector_dimensions(index_name=None):
+    """
+    既存のインデックスの text_vector の次元数が、取り込みで作るベクトルの次元数と一致するか確認する。
+    :return: 一致しない場合はその説明（一致する・確認できない場合は None）
+    """
+    try:
+        current = get_index_definition(index_name)
+    except Exception as e:
+        logger.warning("インデックス定義を確認できませんでした: %s", e)
+        return None
+    if current is None:
+        return None
+    field = _by_name(current.get("fields")).get(VECTOR_FIELD)
+    dimensions = embedding_dimensions()
+    if field and field.get("dimensions") and field["dimensions"] != dimensions:
+        return (
+            f"インデックスの {VECTOR_FIELD} の次元数（{field['dimensions']}）と EMBEDDING_DIMENSIONS（{dimensions}）が"
+            "一致しません。python index_schema.py migrate --recreate でインデックスを作り直すか、設定を合わせてください。"
+        )
+    return None
+
+
+def _masked(definition):
+    """API キーを伏せたインデックス定義（表示用）"""
+    text = json.dumps(definition, ensure_ascii=False, indent=2)
+    if AZURE_OPENAI_API_KEY:
+        text = text.replace(AZURE_OPENAI_API_KEY, "***")
+    return text
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Azure AI Search のインデックス定義を作成・移行する")
+    parser.add_argument("--index", default=AZURE_SEARCH_INDEX, help="インデックス名")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("show", help="作成するインデックス定義を表示する")
+    commands.add_parser("create", help="インデックスを作成する（既にある場合は何もしない）")
+    migrate = commands.add_parser("migrate", help="既存のインデックスとの差分を表示し、更新できるものは更新する")
+    migrate.add_argument("--dry-run", action="store_true", help="差分を表示するだけで更新しない")
+    migrate.add_argument(
+        "--recreate", action="store_true",
+        help="更新できない差分（次元数・型・圧縮の変更など）がある場合は、インデックスを削除して作り直す",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    :return: 終了コード
+    """
+    args = parse_args(argv)
+    desired = build_index_definition(args.index)
+
+    if args.command == "show":
+        print(_masked(desired))
+        return 0
+
+    current = get_index_definition(args.index)
+    if current is None:
+        put_index_definition(desired)
+        return 0
+    if args.command == "create":
+        logger.info("インデックスは既にあります: %s（変更は migrate で反映します）", args.index)
+        return 0
+
+    updatable, breaking = diff_index(current, desired)
+    for change in updatable:
+        logger.info("更新: %s", change)
+    for change in breaking:
+        logger.warning("作り直しが必要: %s", change)
+    if not updatable and not breaking:
+        logger.info("インデックス定義に差分はありません: %s", args.index)
+        return 0
+    if args.dry_run:
+        return 0
+    if breaking:
+        if not args.recreate:
+            logger.error("更新できない差分があります。--recreate を指定するとインデックスを作り直します。")
+            return 1
+        from index_events import record_index_update
+        delete_index(args.index)
+        put_index_definition(desired)
+        # 検索アプリの検索結果キャッシュを破棄させる
+        record_index_update([])
+        logger.warning(
+            "インデックスを作り直しました。python upload_to_azure_search.py --full で全ファイルを登録し直してください。"
+        )
+        return 0
+    put_index_definition(desired)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
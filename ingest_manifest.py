@@ -0,0 +1,95 @@
+"""
+取り込みマニフェスト
+Markdown ファイルごとのサイズ・更新時刻・内容ハッシュと、登録済みチャンクの id とハッシュを
+ローカルの JSON ファイルに記録する。
+変更のないファイルはスキップし、変更のあったファイルはチャンク単位の差分だけを送るために使う。
+"""
+import os
+import json
+import hashlib
+import threading
+import logging
+from dotenv import load_dotenv
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# マニフェストファイルのパス
+INGEST_MANIFEST_PATH = os.getenv("INGEST_MANIFEST_PATH", "cache/ingest_manifest.json")
+
+MANIFEST_VERSION = 1
+
+
+def chunk_hash(doc):
+    """
+    チャンクの内容（テキスト・画像の Blob パス・見出しの階層）からハッシュを計算する関数
+    id が同じでも画像のアップロード結果や見出し（タイトル）が変わった場合は変更として扱うため、それらも含める。
+    """
+    payload = json.dumps(
+        [doc["text"], doc["imagebloburls"], doc["image_filenames"], doc.get("heading_path") or []],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class IngestManifest:
+    """
+    取り込み済みファイルとチャンクの記録
+    files の形式: {ファイル名: {"size", "mtime", "sha256", "chunks": {チャンクid: チャンクハッシュ}}}
+    """
+
+    def __init__(self, path=INGEST_MANIFEST_PATH):
+        self.path = path
+        self.files = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.files = data.get("files", {})
+                else:
+                    logger.warning("マニフェストのバージョンが異なるため破棄します: %s", path)
+            except Exception as e:
+                logger.exception("マニフェストの読み込みに失敗しました: %s", e)
+
+    def is_unchanged(self, filename, fingerprint):
+        """記録されている内容ハッシュと一致すれば True を返す。"""
+        entry = self.files.get(filename)
+        return entry is not None and entry.get("sha256") == fingerprint["sha256"]
+
+    def get_chunks(self, filename):
+        """記録されているチャンク {id: ハッシュ} を返す（未登録なら None）。"""
+        entry = self.files.get(filename)
+        return dict(entry["chunks"]) if entry else None
+
+    def update(self, filename, fingerprint, chunks):
+        """ファイルの取り込み結果を記録する。"""
+        with self._lock:
+            self.files[filename] = {**fingerprint, "chunks": chunks}
+
+    def touch(self, filename, fingerprint):
+        """内容は同じで更新時刻だけ変わったファイルの記録を更新する。"""
+        with self._lock:
+            entry = self.files.get(filename)
+            if entry:
+                entry.update(fingerprint)
+
+    def remove(self, filename):
+        """ファイルの記録を削除する。"""
+        with self._lock:
+            self.files.pop(filename, None)
+
+    def save(self):
+        """マニフェストを書き出す（一時ファイル経由で置き換えるため途中で壊れない）。"""
+        with self._lock:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": MANIFEST_VERSION, "files": self.files}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
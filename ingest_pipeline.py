@@ -0,0 +1,228 @@
+"""
+取り込みパイプライン
+ファイル単位の作業を「プロセスプールで実行する解析ステージ」と「スレッドプールで実行する I/O ステージ」
+の列として並行に処理する。ステージ間は上限付きキューでつなぐため、ファイル数が多くてもメモリ使用量は一定に保たれる。
+各ステージで例外が発生した場合はそのファイルだけを失敗として記録し、他のファイルの処理は続ける。
+BatchStage は複数ファイルの作業アイテムをまとめて1回で処理する（埋め込み API のバッチを複数ファイルのチャンクで埋めるため）。
+"""
+import time
+import queue
+import threading
+import contextvars
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from metrics import span, observe
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# ステージの終了を次のステージに伝える目印
+_DONE = object()
+
+
+def _timed_call(func, item):
+    """子プロセスで func を実行し、結果と所要時間（秒）を返す（スパンは親プロセスで記録する）。"""
+    start = time.perf_counter()
+    result = func(item)
+    return result, time.perf_counter() - start
+
+
+class Stage:
+    """
+    I/O ステージの定義
+    :param name: ステージ名（ログ・失敗記録に使う）
+    :param func: 作業アイテムを受け取り、次のステージに渡すアイテムを返す関数（None を返すとそこで終了）
+    :param workers: ワーカースレッド数
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+
+class BatchStage(Stage):
+    """
+    複数の作業アイテムをまとめて処理する I/O ステージの定義
+    キューからアイテムを取り出し、重みの合計が上限に達するか、最初のアイテムから max_wait 秒経つまでまとめる。
+    :param func: 作業アイテムのリストを受け取り、次のステージに渡すアイテムのリストを返す関数
+        （例外の場合はまとめたすべてのアイテムを失敗とする）
+    :param max_items: まとめる重みの上限（件数）
+    :param max_weight: まとめる重みの上限（weight_func の合計）
+    :param weight_func: アイテムの重みを (件数, 重み) で返す関数
+    :param max_wait: 次のアイテムを待つ最大秒数
+    """
+
+    def __init__(self, name, func, workers=1, max_items=64, max_weight=0, weight_func=None, max_wait=0.2):
+        super().__init__(name, func, workers)
+        self.max_items = max(1, max_items)
+        self.max_weight = max_weight
+        self.weight_func = weight_func or (lambda item: (1, 0))
+        self.max_wait = max_wait
+
+
+class IngestPipeline:
+    """
+    解析ステージ（プロセスプール）と I/O ステージ（スレッドプール）を上限付きキューでつないだパイプライン
+    :param parse_func: 入力を受け取り作業アイテムを返す関数（プロセスプールで実行するため pickle 可能であること）
+    :param parse_workers: 解析ステージのプロセス数
+    :param stages: 後続の Stage のリスト
+    :param queue_size: ステージ間キューの上限（解析ステージの同時実行数の上限も兼ねる）
+    :param key_func: 入力・作業アイテムから失敗記録用のキーを取り出す関数
+    """
+
+    def __init__(self, parse_func, parse_workers, stages, queue_size=16, key_func=str):
+        self.parse_func = parse_func
+        self.parse_workers = max(1, parse_workers)
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.key_func = key_func
+        self.failed = {}
+        self.completed = 0
+        self._lock = threading.Lock()
+
+    def _record_failure(self, key, stage_name, error):
+        logger.error("取り込み失敗: %s（%s ステージ）: %s", key, stage_name, error)
+        with self._lock:
+            self.failed[key] = f"{stage_name}: {error}"
+
+    def _parse(self, inputs, out_queue):
+        """入力をプロセスプールで解析し、結果を最初のキューに流す。"""
+        # ステージのスレッドやログ出力のスレッドがロックを持ったまま fork されるとデッドロックしうるため、
+        # ワーカープロセスは fork ではなく spawn で起動する
+        with ProcessPoolExecutor(
+            max_workers=self.parse_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            in_flight = {}
+            for item in inputs:
+                # 処理中のものが上限に達したら、どれかが終わるまで待つ
+                while len(in_flight) >= self.queue_size:
+                    self._drain_parsed(in_flight, out_queue)
+                in_flight[executor.submit(_timed_call, self.parse_func, item)] = item
+            while in_flight:
+                self._drain_parsed(in_flight, out_queue)
+
+    def _drain_parsed(self, in_flight, out_queue):
+        done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+        for future in done:
+            item = in_flight.pop(future)
+            try:
+                result, elapsed = future.result()
+            except Exception as e:
+                self._record_failure(self.key_func(item), "parse", e)
+                continue
+            observe("ingest.stage", elapsed, stage="parse")
+            if result is not None:
+                out_queue.put(result)
+
+    def _worker(self, stage, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                return
+            try:
+                with span("ingest.stage", stage=stage.name):
+                    result = stage.func(item)
+            except Exception as e:
+                self._record_failure(self.key_func(item), stage.name, e)
+                continue
+            if result is None:
+                continue
+            if out_queue is not None:
+                out_queue.put(result)
+            else:
+                with self._lock:
+                    self.completed += 1
+
+    def _collect(self, stage, in_queue):
+        """
+        キューからアイテムをまとめて取り出す。
+        :return: (アイテムのリスト, 終了の目印を受け取ったか)
+        """
+        item = in_queue.get()
+        if item is _DONE:
+            return [], True
+        items = [item]
+        count, weight = stage.weight_func(item)
+        deadline = time.monotonic() + stage.max_wait
+        while count < stage.max_items and not (stage.max_weight and weight >= stage.max_weight):
+            remaining = deadline - time.monotonic()
+            try:
+                item = in_queue.get(timeout=remaining) if remaining > 0 else in_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return items, True
+            items.append(item)
+            item_count, item_weight = stage.weight_func(item)
+            count += item_count
+            weight += item_weight
+        return items, False
+
+    def _batch_worker(self, stage, in_queue, out_queue):
+        done = False
+        while not done:
+            items, done = self._collect(stage, in_queue)
+            if not items:
+                continue
+            try:
+                with span("ingest.stage", stage=stage.name):
+                    results = stage.func(items)
+            except Exception as e:
+                for item in items:
+                    self._record_failure(self.key_func(item), stage.name, e)
+                continue
+            for result in results:
+                if result is None:
+                    continue
+                if out_queue is not None:
+                    out_queue.put(result)
+                else:
+                    with self._lock:
+                        self.completed += 1
+
+    def run(self, inputs):
+        """
+        パイプラインを実行し、すべてのアイテムの処理が終わるまで待つ。
+        :return: 失敗したアイテムのキーとエラー内容の辞書
+        """
+        start = time.perf_counter()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        stage_threads = []
+        for i, stage in enumerate(self.stages):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            # 呼び出し元のトレースをワーカースレッドに引き継ぐ（コンテキストはスレッドごとに複製する）
+            threads = [
+                threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(
+                        self._batch_worker if isinstance(stage, BatchStage) else self._worker,
+                        stage, queues[i], out_queue,
+                    ),
+                    name=f"ingest-{stage.name}-{n}",
+                    daemon=True,
+                )
+                for n in range(stage.workers)
+            ]
+            for thread in threads:
+                thread.start()
+            stage_threads.append(threads)
+
+        try:
+            self._parse(inputs, queues[0])
+        finally:
+            # 前のステージから順に終了を伝え、ワーカーの終了を待つ
+            for stage, q, threads in zip(self.stages, queues, stage_threads):
+                for _ in threads:
+                    q.put(_DONE)
+                for thread in threads:
+                    thread.join()
+
+        elapsed = time.perf_counter() - start
+        logger.info(
+            "取り込み完了: 成功 %d / 失敗 %d / %.2f 秒", self.completed, len(self.failed), elapsed
+        )
+        return self.failed
@@ -0,0 +1,522 @@
+"""
+組み込みローカル検索エンジン
+Azure AI Search の代わりに同じプロセス内で動く検索エンジン。このリポジトリで使う操作だけを実装する。
+- search.index の upload / mergeOrUpload / merge / delete
+- parent_filename eq '...' のフィルタ
+- キーワード（BM25）とベクトル（コサイン類似度）のハイブリッド検索（RRF で統合）、top / k / select
+
+ベクトルは正規化して float16 のメモリマップファイルに保存し、NumPy でまとめて内積を計算する。
+キーワード検索は転置インデックスによる BM25 で行う。日本語は文字 bigram、英数字は単語で分割する。
+
+登録のたびにすべてのドキュメントを書き出すと件数の2乗に比例して遅くなるため、登録したドキュメントは
+追記専用のログ（changes.jsonl）に書き足し、ログが全件数を超えたらスナップショット（documents.json）にまとめる。
+別プロセス（取り込みスクリプト）が更新したインデックスは、検索の前にログの増えた分を読み込んで反映する。
+書き込むプロセスは同時に1つだけとする。
+"""
+import os
+import re
+import json
+import math
+import threading
+import unicodedata
+import logging
+from collections import defaultdict
+import numpy as np
+from dotenv import load_dotenv
+from metrics import span
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# インデックスの保存先ディレクトリ
+LOCAL_SEARCH_DIR = os.getenv("LOCAL_SEARCH_DIR", "cache/local_index")
+
+# BM25 のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+# RRF（Reciprocal Rank Fusion）の定数（Azure AI Search と同じ値）
+RRF_K = 60
+# ベクトルの類似度をまとめて計算する行数
+VECTOR_BLOCK_ROWS = 4096
+# ログをスナップショットにまとめる最小の件数（ログの件数がこれと全件数の大きいほうを超えたらまとめる）
+LOG_COMPACT_MIN_ENTRIES = 1000
+# サポートするフィルタ式
+_FILTER_PATTERN = re.compile(
+    r"^\s*parent_filename\s+eq\s+'((?:[^']|'')*)'(?:\s+and\s+id\s+gt\s+'((?:[^']|'')*)')?\s*$"
+)
+# 英数字は単語、それ以外の文字（日本語など）は連続部分を bigram にする
+_TOKEN_PATTERN = re.compile(r"[0-9a-z]+|[^\W0-9a-z_]+")
+
+
+def tokenize(text):
+    """テキストを BM25 用のトークンに分割する。"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(text):
+        token = match.group(0)
+        if token.isascii() or len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+def parse_filter(filter_expr):
+    """
+    フィルタ式から parent_filename の値と、id の下限（id gt '...'）を取り出す。
+    :return: (parent_filename, id の下限)（指定がないものは None）
+    :raises ValueError: サポートしていないフィルタ式の場合
+    """
+    if not filter_expr:
+        return None, None
+    match = _FILTER_PATTERN.match(filter_expr)
+    if not match:
+        raise ValueError(f"サポートしていないフィルタ式です: {filter_expr}")
+    after_id = match.group(2)
+    return match.group(1).replace("''", "'"), after_id.replace("''", "'") if after_id is not None else None
+
+
+class LocalSearchEngine:
+    """
+    ローカル検索エンジン
+    ディレクトリ構成:
+        documents.json  ドキュメントのフィールド（text_vector 以外）と、ベクトル行番号などのメタ情報
+        changes.jsonl   documents.json 以降に登録・削除したドキュメントの状態（1行1回の index_actions）
+        vectors.f16     正規化したベクトル（float16, 行数 capacity × 次元 dim のメモリマップ）
+    """
+
+    def __init__(self, directory=LOCAL_SEARCH_DIR):
+        self.directory = directory
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self._reset()
+        self._load()
+
+    def _reset(self):
+        """読み込んだ内容をすべて破棄する。"""
+        # id -> フィールド
+        self.docs = {}
+        # id -> ベクトルの行番号、行番号 -> id
+        self.rows = {}
+        self.row_ids = []
+        self.free_rows = []
+        self.dim = None
+        self.capacity = 0
+        self.vectors = None
+        self.valid = np.zeros(0, dtype=bool)
+        # parent_filename -> id の集合
+        self.by_parent = defaultdict(set)
+        # BM25 の転置インデックス: トークン -> {id: 出現回数}
+        self.postings = defaultdict(dict)
+        self.doc_len = {}
+        self.total_len = 0
+        # 読み込んだスナップショットのファイルの状態と、ログの読み込み済みの位置・件数
+        self._snapshot_stat = None
+        self._log_offset = 0
+        self._log_entries = 0
+
+    # --- 永続化 ---
+    @property
+    def _documents_path(self):
+        return os.path.join(self.directory, "documents.json")
+
+    @property
+    def _log_path(self):
+        return os.path.join(self.directory, "changes.jsonl")
+
+    @property
+    def _vectors_path(self):
+        return os.path.join(self.directory, "vectors.f16")
+
+    @staticmethod
+    def _file_state(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _load(self):
+        self._snapshot_stat = self._file_state(self._documents_path)
+        if self._snapshot_stat is not None:
+            self._load_snapshot()
+        self._replay_log()
+        logger.info("ローカル検索インデックスを読み込みました: %d 件", len(self.docs))
+
+    def _load_snapshot(self):
+        with open(self._documents_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.dim = data.get("dim")
+        self.capacity = data.get("capacity", 0)
+        self.free_rows = data.get("free_rows", [])
+        self.row_ids = [None] * self.capacity
+        self.valid = np.zeros(self.capacity, dtype=bool)
+        if self.dim and self.capacity:
+            self.vectors = np.memmap(self._vectors_path, dtype=np.float16, mode="r+",
+                                     shape=(self.capacity, self.dim))
+        for doc_id, row in data.get("rows", {}).items():
+            self.rows[doc_id] = row
+            self.row_ids[row] = doc_id
+            self.valid[row] = True
+        for doc_id, fields in data.get("docs", {}).items():
+            self._add_document(doc_id, fields)
+
+    def _replay_log(self):
+        """ログのうち、まだ読み込んでいない分を反映する。"""
+        try:
+            with open(self._log_path, "r", encoding="utf-8") as f:
+                f.seek(self._log_offset)
+                for line in iter(f.readline, ""):
+                    if not line.endswith("\n"):
+                        # 書き込み途中の行は次回読み込む
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logger.warning("ローカル検索インデックスのログの解析に失敗しました: %s", line[:200])
+                    else:
+                        self._apply_log_entry(entry)
+                        self._log_entries += len(entry["docs"])
+                    self._log_offset = f.tell()
+        except FileNotFoundError:
+            pass
+
+    def _apply_log_entry(self, entry):
+        """ログの1行（1回の index_actions の結果）を反映する。"""
+        dim, capacity = entry.get("dim"), entry.get("capacity", 0)
+        if dim and capacity and (dim != self.dim or capacity != self.capacity or self.vectors is None):
+            # 書き込んだプロセスがベクトル行列を広げた場合は、新しいファイルを開き直す
+            self.vectors = np.memmap(self._vectors_path, dtype=np.float16, mode="r+", shape=(capacity, dim))
+            if capacity > self.capacity:
+                self.row_ids.extend([None] * (capacity - self.capacity))
+                self.valid = np.concatenate([self.valid, np.zeros(capacity - self.capacity, dtype=bool)])
+            self.dim = dim
+            self.capacity = capacity
+        # 行番号は同じ回の中で付け替わることがあるため、削除をすべて終えてから追加する
+        for doc_id in entry["docs"]:
+            self._remove_document(doc_id)
+        for doc_id, state in entry["docs"].items():
+            if state is None:
+                continue
+            row = state.get("row")
+            if row is not None:
+                self.rows[doc_id] = row
+                self.row_ids[row] = doc_id
+                self.valid[row] = True
+            self._add_document(doc_id, state["fields"])
+        self.free_rows = list(entry.get("free_rows", []))
+
+    def _append_log(self, doc_ids):
+        """登録・削除したドキュメントの現在の状態をログに追記し、ログが大きくなったらスナップショットにまとめる。"""
+        if self.vectors is not None:
+            self.vectors.flush()
+        entry = {
+            "dim": self.dim,
+            "capacity": self.capacity,
+            "free_rows": self.free_rows,
+            "docs": {
+                doc_id: {"fields": self.docs[doc_id], "row": self.rows.get(doc_id)} if doc_id in self.docs else None
+                for doc_id in doc_ids
+            },
+        }
+        with open(self._log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            self._log_offset = f.tell()
+        self._log_entries += len(doc_ids)
+        if self._log_entries > max(len(self.docs), LOG_COMPACT_MIN_ENTRIES):
+            self.save()
+
+    def refresh(self):
+        """別プロセスがインデックスを更新していれば反映する（ファイルの状態を確認するだけなので検索のたびに呼んでよい）。"""
+        with self._lock:
+            snapshot = self._file_state(self._documents_path)
+            log = self._file_state(self._log_path)
+            log_size = log[1] if log else 0
+            if snapshot != self._snapshot_stat or log_size < self._log_offset:
+                # スナップショットにまとめられた場合は読み込み直す
+                logger.info("ローカル検索インデックスが更新されたため読み込み直します")
+                self._reset()
+                self._load()
+            elif log_size > self._log_offset:
+                self._replay_log()
+
+    def save(self):
+        """ドキュメントとメタ情報をスナップショットに書き出し、ログを空にする。"""
+        with self._lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+            data = {
+                "dim": self.dim,
+                "capacity": self.capacity,
+                "free_rows": self.free_rows,
+                "rows": self.rows,
+                "docs": self.docs,
+            }
+            tmp_path = self._documents_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self._documents_path)
+            # スナップショットに含めたログは不要になる（途中で止まってもログの再適用で同じ状態になる）
+            open(self._log_path, "w", encoding="utf-8").close()
+            self._snapshot_stat = self._file_state(self._documents_path)
+            self._log_offset = 0
+            self._log_entries = 0
+
+    # --- ベクトル ---
+    def _grow(self, needed):
+        """ベクトル行列の行数を needed 以上に増やす（倍々で確保する）。"""
+        capacity = max(needed, self.capacity * 2, 1024)
+        tmp_path = self._vectors_path + ".tmp"
+        grown = np.memmap(tmp_path, dtype=np.float16, mode="w+", shape=(capacity, self.dim))
+        if self.vectors is not None:
+            grown[:self.capacity] = self.vectors[:self.capacity]
+            grown.flush()
+            del self.vectors
+        grown.flush()
+        del grown
+        os.replace(tmp_path, self._vectors_path)
+        self.vectors = np.memmap(self._vectors_path, dtype=np.float16, mode="r+", shape=(capacity, self.dim))
+        self.row_ids.extend([None] * (capacity - self.capacity))
+        self.valid = np.concatenate([self.valid, np.zeros(capacity - self.capacity, dtype=bool)])
+        self.capacity = capacity
+
+    def _set_vector(self, doc_id, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.dim is None:
+            self.dim = int(vector.shape[0])
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"ベクトルの次元が一致しません: {vector.shape[0]} != {self.dim}")
+        row = self.rows.get(doc_id)
+        if row is None:
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                used = len(self.rows) + len(self.free_rows)
+                if used >= self.capacity:
+                    self._grow(used + 1)
+                row = used
+            self.rows[doc_id] = row
+            self.row_ids[row] = doc_id
+            self.valid[row] = True
+        norm = np.linalg.norm(vector)
+        self.vectors[row] = vector / norm if norm > 0 else vector
+
+    def _remove_vector(self, doc_id):
+        row = self.rows.pop(doc_id, None)
+        if row is not None:
+            self.row_ids[row] = None
+            self.valid[row] = False
+            self.free_rows.append(row)
+
+    # --- ドキュメント ---
+    def _add_document(self, doc_id, fields):
+        self.docs[doc_id] = fields
+        parent = fields.get("parent_filename")
+        if parent is not None:
+            self.by_parent[parent].add(doc_id)
+        tokens = tokenize(fields.get("text", ""))
+        counts = defaultdict(int)
+        for token in tokens:
+            counts[token] += 1
+        for token, count in counts.items():
+            self.postings[token][doc_id] = count
+        self.doc_len[doc_id] = len(tokens)
+        self.total_len += len(tokens)
+
+    def _remove_document(self, doc_id):
+        fields = self.docs.pop(doc_id, None)
+        if fields is None:
+            return False
+        parent = fields.get("parent_filename")
+        if parent is not None:
+            self.by_parent[parent].discard(doc_id)
+            if not self.by_parent[parent]:
+                del self.by_parent[parent]
+        for token in set(tokenize(fields.get("text", ""))):
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[token]
+        self.total_len -= self.doc_len.pop(doc_id, 0)
+        self._remove_vector(doc_id)
+        return True
+
+    def _put_document(self, doc_id, fields):
+        vector = fields.pop("text_vector", None)
+        old_row = self.rows.get(doc_id)
+        self._remove_document(doc_id)
+        if vector is not None:
+            self._set_vector(doc_id, vector)
+        elif old_row is not None:
+            # merge でベクトルを指定しなかった場合は元のベクトルを残す
+            self.rows[doc_id] = old_row
+            self.row_ids[old_row] = doc_id
+            self.valid[old_row] = True
+            self.free_rows.remove(old_row)
+        self._add_document(doc_id, fields)
+
+    @span("local_search.index")
+    def index_actions(self, actions):
+        """
+        search.index と同じ形式のアクションを適用する。
+        :return: 失敗したアイテムの id のリスト
+        """
+        failed = []
+        with self._lock:
+            self.refresh()
+            touched = {}
+            for action in actions:
+                kind = action.get("@search.action", "upload")
+                doc_id = action.get("id")
+                fields = {k: v for k, v in action.items() if k != "@search.action"}
+                touched[doc_id] = True
+                try:
+                    if kind == "delete":
+                        self._remove_document(doc_id)
+                    elif kind == "upload":
+                        self._put_document(doc_id, fields)
+                    elif kind in ("merge", "mergeOrUpload"):
+                        if doc_id not in self.docs and kind == "merge":
+                            raise KeyError(doc_id)
+                        merged = {**self.docs.get(doc_id, {}), **fields}
+                        self._put_document(doc_id, merged)
+                    else:
+                        raise ValueError(f"不明なアクションです: {kind}")
+                except Exception as e:
+                    logger.error("ローカルインデックス登録失敗: %s %s", doc_id, e)
+                    failed.append(doc_id)
+            if touched:
+                self._append_log(list(touched))
+        return failed
+
+    def find_ids(self, parent_filename):
+        """parent_filename が一致するドキュメントの id 一覧を返す。"""
+        with self._lock:
+            self.refresh()
+            return sorted(self.by_parent.get(parent_filename, ()))
+
+    # --- 検索 ---
+    def _candidate_ids(self, parent_filename, after_id=None):
+        if parent_filename is None:
+            return None
+        candidates = self.by_parent.get(parent_filename, set())
+        if after_id is not None:
+            candidates = {doc_id for doc_id in candidates if doc_id > after_id}
+        return candidates
+
+    def _keyword_ranking(self, text, candidates, limit):
+        """BM25 のスコア順に id を返す。"""
+        if not text or text.strip() == "*":
+            ids = list(candidates) if candidates is not None else list(self.docs)
+            return [(doc_id, 1.0) for doc_id in ids[:limit]]
+        n_docs = len(self.docs)
+        if n_docs == 0:
+            return []
+        avgdl = self.total_len / n_docs if n_docs else 0
+        scores = defaultdict(float)
+        for token in set(tokenize(text)):
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                if candidates is not None and doc_id not in candidates:
+                    continue
+                dl = self.doc_len.get(doc_id, 0)
+                denom = tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl) if avgdl else tf + BM25_K1
+                scores[doc_id] += idf * tf * (BM25_K1 + 1) / denom
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def _vector_ranking(self, vector, candidates, k):
+        """コサイン類似度の高い順に id を返す。"""
+        if self.vectors is None or not self.rows:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        used = len(self.rows) + len(self.free_rows)
+        mask = self.valid[:used].copy()
+        if candidates is not None:
+            allowed = np.zeros(used, dtype=bool)
+            rows = [self.rows[doc_id] for doc_id in candidates if doc_id in self.rows]
+            allowed[rows] = True
+            mask &= allowed
+        if not mask.any():
+            return []
+        # float16 のまま行列積を取ると遅いため、ブロックごとに float32 に変換して計算する
+        scores = np.empty(used, dtype=np.float32)
+        for start in range(0, used, VECTOR_BLOCK_ROWS):
+            end = min(start + VECTOR_BLOCK_ROWS, used)
+            scores[start:end] = self.vectors[start:end].astype(np.float32) @ query
+        scores[~mask] = -np.inf
+        k = min(k, int(mask.sum()))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.row_ids[row], float(scores[row])) for row in top]
+
+    @span("local_search.search")
+    def search(self, text=None, vector=None, top=50, k=None, select=None, filter=None, skip=0, orderby=None):
+        """
+        ハイブリッド検索を行う。
+        :param text: キーワード検索のクエリ（"*" はすべてに一致）
+        :param vector: クエリベクトル（None の場合はキーワード検索のみ）
+        :param top: 返す件数
+        :param k: ベクトル検索で取得する件数（既定は top）
+        :param select: 返すフィールド（カンマ区切り）。None の場合はすべて
+        :param filter: フィルタ式（parent_filename eq '...' と、それに続く and id gt '...' のみ）
+        :param orderby: 並び順（"id" のみ）。None の場合はスコア順
+        :return: Azure AI Search の value と同じ形式の辞書のリスト（@search.score 付き）
+        """
+        parent_filename, after_id = parse_filter(filter)
+        if orderby not in (None, "id", "id asc"):
+            raise ValueError(f"サポートしていない並び順です: {orderby}")
+        k = k or top
+        with self._lock:
+            self.refresh()
+            candidates = self._candidate_ids(parent_filename, after_id)
+            limit = top + skip
+            # 並び順を指定した場合は、並べ替える前に件数で切らない
+            keyword_limit = len(self.docs) if orderby else max(limit, k)
+            keyword = self._keyword_ranking(text, candidates, keyword_limit) if text else []
+            vector_hits = self._vector_ranking(vector, candidates, k) if vector is not None else []
+
+            if keyword and vector_hits:
+                # RRF でキーワードとベクトルの順位を統合する
+                fused = defaultdict(float)
+                for ranking in (keyword, vector_hits):
+                    for rank, (doc_id, _) in enumerate(ranking):
+                        fused[doc_id] += 1.0 / (RRF_K + rank + 1)
+                ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+            else:
+                ranked = keyword or vector_hits
+            if orderby:
+                ranked = sorted(ranked)
+
+            fields = [name.strip() for name in select.split(",")] if select else None
+            results = []
+            for doc_id, score in ranked[skip:limit]:
+                doc = self.docs[doc_id]
+                item = {name: doc.get(name) for name in fields} if fields else dict(doc)
+                item["@search.score"] = score
+                results.append(item)
+            return results
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_local_engine():
+    """プロセス共通の LocalSearchEngine を返す。"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = LocalSearchEngine()
+    return _engine
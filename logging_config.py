@@ -2,16 +2,234 @@
 ロギング設定モジュール
 アプリ全体で共通のロガー設定（コンソール出力とファイル出力）を行う。
 複数回呼ばれても重複設定しないようにガードを入れてある。
+
+既定では、ログはキュー（QueueHandler）に入れるだけにして、ファイルへの書き込みとローテーションは
+バックグラウンドのスレッド（QueueListener）で行う。検索・インデックス登録の処理中にファイル I/O で待たされない。
+環境変数で次の設定ができる。
+- LOG_ASYNC: false でキューを使わず、呼び出したスレッドで書き込む（従来の動作）
+- LOG_FORMAT: text（従来の形式）/ json（1行1件の JSON。trace_id と extra に渡した項目も出力する）
+- LOG_MAX_FIELD_CHARS: ログの引数（レスポンス本文など）1つあたりの最大文字数。超えた分は切り詰める
+- LOG_MAX_MESSAGE_CHARS: 引数のないメッセージ（f-string など）の最大文字数
+- LOG_SAMPLE_RATES: 大量に出る DEBUG/INFO ログの間引き（例: "retriever=0.1,azureaisearch=0.5"）。WARNING 以上は間引かない
+- LOG_QUEUE_SIZE: キューの上限。あふれた場合 INFO 以下のログは捨てる（捨てた件数は後で WARNING で出力する）
 """
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import os
+import sys
+import json
+import queue
+import atexit
+import random
+import numbers
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
 
 LOG_DIR = "log"
 LOG_FILE = "app.log"
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
 
+# 各エントリポイントの load_dotenv() より先に import されるため、ここで .env を読み込んでおく
+load_dotenv()
+# キューを使ってバックグラウンドのスレッドで書き込むか
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+# 出力形式（text / json）
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# ログの引数1つあたりの最大文字数（0 で切り詰めない）
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "2000"))
+# 引数のないメッセージの最大文字数（0 で切り詰めない）
+LOG_MAX_MESSAGE_CHARS = int(os.getenv("LOG_MAX_MESSAGE_CHARS", "10000"))
+# ロガーごとの DEBUG/INFO ログを残す割合（"ロガー名=割合" のカンマ区切り）
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+# キューの上限（件数）
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# ログの引数のうち、書き込み時まで文字列化を遅らせても内容が変わらない型
+# （数値は %d / %.2f で書式化できるよう、Decimal や numpy の数値もそのまま渡す）
+_IMMUTABLE_TYPES = (str, bytes, numbers.Number, type(None))
+# LogRecord の標準の属性（これ以外は extra に渡された項目として JSON に出力する）
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "trace_id"}
+
+_listener = None
+
+
+def _truncate(text, limit):
+    if limit and len(text) > limit:
+        return f"{text[:limit]}...（{len(text)} 文字中 {limit} 文字を表示）"
+    return text
+
+
+def parse_sample_rates(spec):
+    """LOG_SAMPLE_RATES の "ロガー名=割合" のカンマ区切りを辞書にする。"""
+    rates = {}
+    for item in spec.split(","):
+        name, sep, rate = item.partition("=")
+        if sep and name.strip():
+            rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """
+    ロガーごとに指定した割合で DEBUG/INFO のログを間引くフィルタ
+    割合はロガー名の完全一致、なければ親のロガー名（"a.b" に対する "a"）で決める。
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._resolved = {}
+
+    def _rate(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate = 1.0
+            parts = name.split(".")
+            for i in range(len(parts), 0, -1):
+                prefix = ".".join(parts[:i])
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class TruncatingFilter(logging.Filter):
+    """
+    大きな引数（レスポンス本文・チャンクの本文など）を切り詰めるフィルタ
+    変更されうる引数（辞書・オブジェクト）はこの時点で文字列にしておき、後から書き込んでも内容が変わらないようにする。
+    """
+
+    def __init__(self, max_field_chars=None, max_message_chars=None):
+        super().__init__()
+        self.max_field_chars = LOG_MAX_FIELD_CHARS if max_field_chars is None else max_field_chars
+        self.max_message_chars = LOG_MAX_MESSAGE_CHARS if max_message_chars is None else max_message_chars
+
+    def _limit(self, value):
+        if not isinstance(value, _IMMUTABLE_TYPES):
+            value = str(value)
+        if isinstance(value, str):
+            value = _truncate(value, self.max_field_chars)
+        return value
+
+    def filter(self, record):
+        args = record.args
+        if args:
+            if isinstance(args, dict):
+                record.args = {key: self._limit(value) for key, value in args.items()}
+            else:
+                record.args = tuple(self._limit(value) for value in args)
+        elif isinstance(record.msg, str):
+            record.msg = _truncate(record.msg, self.max_message_chars)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """ログを1行1件の JSON にするフォーマッタ"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            entry["trace_id"] = trace_id
+        # extra に渡された項目
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack_info"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """
+    ログをキューに入れるだけのハンドラ
+    メッセージの組み立て（%s の展開）は書き込み側のスレッドで行う。
+    キューがあふれた場合、INFO 以下のログは待たずに捨て、WARNING 以上は少しだけ待つ。
+    """
+
+    def __init__(self, log_queue, handlers):
+        super().__init__(log_queue)
+        self.handlers = handlers
+        self._pid = os.getpid()
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # 計測中のトレースの id を記録する（書き込み側のスレッドからは参照できないため）
+        metrics = sys.modules.get("metrics")
+        if metrics is not None and not hasattr(record, "trace_id"):
+            record.trace_id = metrics.current_trace_id()
+        return record
+
+    def emit(self, record):
+        if os.getpid() != self._pid:
+            # fork した子プロセスには書き込み側のスレッドがないため、その場で書き込む
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        try:
+            record = self.prepare(record)
+            if self._dropped:
+                self._report_dropped()
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=1)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _report_dropped(self):
+        with self._lock:
+            dropped, self._dropped = self._dropped, 0
+        if not dropped:
+            return
+        record = logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            "ログのキューがあふれたため %d 件のログを破棄しました", (dropped,), None,
+        )
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self._dropped += dropped
+
+
+class _QueueListener(QueueListener):
+    """終了時、キューがいっぱいでも残りのログを書き込んでから停止するリスナー"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def stop_logging():
+    """バックグラウンドのスレッドに残っているログを書き込んで停止する（終了時に呼ばれる）。"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
 def configure_logging(log_file: str = f"{LOG_DIR}/{LOG_FILE}", level: str | None = None, console: bool = False):
     """
     ロギングを初期化する。すでにハンドラが設定されている場合は再設定を避ける。
@@ -19,6 +237,7 @@ def configure_logging(log_file: str = f"{LOG_DIR}/{LOG_FILE}", level: str | None
     :param log_file: ログファイル名（ワーキングディレクトリに作成される）
     :param level: 環境変数等で指定されたログレベル（例: "DEBUG"）。None の場合は INFO を既定値とする。
     """
+    global _listener
     root_logger = logging.getLogger()
     if root_logger.handlers:
         # すでに設定済みなら何もしない
@@ -37,20 +256,46 @@ def configure_logging(log_file: str = f"{LOG_DIR}/{LOG_FILE}", level: str | None
     root_logger.setLevel(numeric_level)
 
     # フォーマッタ
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
 
+    handlers = []
     # コンソールハンドラ: デフォルトでは無効。console=True の場合に追加する。
     if console:
         ch = logging.StreamHandler()
         ch.setLevel(numeric_level)
         ch.setFormatter(formatter)
-        root_logger.addHandler(ch)
+        handlers.append(ch)
 
     # ローテーティングファイルハンドラ（最大 5MB、バックアップ3世代）
     fh = RotatingFileHandler(log_file, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8")
     fh.setLevel(numeric_level)
     fh.setFormatter(formatter)
-    root_logger.addHandler(fh)
+    handlers.append(fh)
+
+    # 間引きと切り詰めは呼び出したスレッドで行う（キューに入れる前に不要なログを落とす）
+    filters = []
+    rates = parse_sample_rates(LOG_SAMPLE_RATES)
+    if rates:
+        filters.append(SamplingFilter(rates))
+    filters.append(TruncatingFilter())
+
+    if not LOG_ASYNC:
+        for handler in handlers:
+            for log_filter in filters:
+                handler.addFilter(log_filter)
+            root_logger.addHandler(handler)
+        return
+
+    qh = _NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE), handlers)
+    for log_filter in filters:
+        qh.addFilter(log_filter)
+    root_logger.addHandler(qh)
+    _listener = _QueueListener(qh.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
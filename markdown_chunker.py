@@ -0,0 +1,406 @@
+"""
+Markdown の構造を考慮したチャンク分割
+テキストを先頭から1度だけ読み、見出し・表・コードブロック・段落のブロックに分けてから
+chunk_size 文字以内のチャンクに詰める。
+- 見出しの位置でチャンクを区切り、各チャンクに見出しの階層（heading_path）を付ける
+- 表・コードブロックは途中で切らない（chunk_size を超える場合は行単位で分け、表のヘッダー行やコードの囲みを付け直す）
+- 画像リンク（![...](...)）は途中で切らない
+- chunk_size を超える段落を途中で区切る場合は、直前のチャンクの末尾（chunk_overlap 文字以内の行・文）を次のチャンクの先頭に重ねる
+
+使い方:
+    from markdown_chunker import split_markdown
+
+    for chunk in split_markdown(markdown_text):
+        print(chunk.heading, chunk.text)
+"""
+import os
+import re
+from dotenv import load_dotenv
+
+load_dotenv()
+# 1チャンクの最大文字数
+MARKDOWN_CHUNK_SIZE = int(os.getenv("MARKDOWN_CHUNK_SIZE", "500"))
+# 段落の途中で区切る場合に前のチャンクと重ねる最大文字数
+MARKDOWN_CHUNK_OVERLAP = int(os.getenv("MARKDOWN_CHUNK_OVERLAP", "50"))
+# この文字数に満たないチャンクは見出しで区切らず、次の節とまとめる（短い節ばかりのチャンクを作らない）
+# 未設定の場合は chunk_size の半分
+MARKDOWN_MIN_CHUNK_SIZE = int(os.getenv("MARKDOWN_MIN_CHUNK_SIZE", "0")) or None
+
+_HEADING = re.compile(r"^ {0,3}(#{1,6})[ \t]+(.*?)[ \t#]*$")
+_FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+# 見出し・コードブロックの開始になりうる行頭の文字
+_HEADING_START = {"#", " "}
+_FENCE_START = {"`", "~", " "}
+_TABLE_BLOCK = re.compile(r"[ \t]*\|[^\n]*(?:\n[ \t]*\|[^\n]*)*")
+_CODE_BLOCK = re.compile(r" {0,3}(`{3,}|~{3,})[^\n]*\n.*\n {0,3}\1[ \t]*", re.DOTALL)
+_TABLE_SEPARATOR = re.compile(r"^[ \t]*\|?[ \t]*:?-+:?[ \t]*(\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$")
+_IMAGE_LINK = re.compile(r"!\[.*?\]\(.*?\)")
+# 段落を途中で区切る位置の候補（優先度の高い順）
+_BREAKS = ("\n", "。", "．", "！", "？", "! ", "? ", ". ", " ")
+
+
+class MarkdownChunk:
+    """
+    分割したチャンク
+    :param text: チャンクのテキスト
+    :param heading_path: チャンクが属する見出しの階層（例: ["概要", "インストール"]）
+    """
+
+    def __init__(self, text, heading_path):
+        self.text = text
+        self.heading_path = heading_path
+
+    @property
+    def heading(self):
+        """見出しの階層を " > " でつなげた文字列"""
+        return " > ".join(self.heading_path)
+
+    def __repr__(self):
+        return f"MarkdownChunk(heading={self.heading!r}, text={self.text[:30]!r})"
+
+
+class _BlockParser:
+    """
+    行を1行ずつ受け取り、見出し・表・コードブロック・段落のブロックに分ける。
+    できあがったブロックは (種類, テキスト, 見出しの階層) として out に追加する。
+    見出しの階層はタプルで、見出しが変わるまでは同じオブジェクトを使う。
+    """
+
+    def __init__(self):
+        self.headings = []
+        self.path = ()
+        self.kind = None
+        self.block = []
+        self.fence = None
+
+    def feed(self, line, out):
+        first = line[:1]
+        block = self.block
+        if self.fence is not None:
+            block.append(line)
+            if first in _FENCE_START:
+                match = _FENCE.match(line)
+                fence = self.fence
+                if match and match.group(1)[0] == fence[0] and len(match.group(1)) >= len(fence) \
+                        and not line.strip()[len(match.group(1)):].strip():
+                    out.append(("code", "\n".join(block), self.path))
+                    self.kind, self.block, self.fence = None, [], None
+            return
+
+        # 正規表現は、見出し・コードブロックになりうる文字で始まる行だけに使う
+        fence_match = heading_match = None
+        if first in _FENCE_START:
+            fence_match = _FENCE.match(line)
+        if first in _HEADING_START and not fence_match:
+            heading_match = _HEADING.match(line)
+        if fence_match or heading_match or not line or line.isspace():
+            if block:
+                out.append((self.kind, "\n".join(block), self.path))
+            self.kind, self.block = None, []
+            if fence_match:
+                self.kind, self.block, self.fence = "code", [line], fence_match.group(1)
+            elif heading_match:
+                out.append(("heading", line, self.enter_heading(heading_match)))
+            return
+
+        kind = "table" if first == "|" or (first in " \t" and line.lstrip().startswith("|")) else "paragraph"
+        if block and self.kind != kind:
+            out.append((self.kind, "\n".join(block), self.path))
+            self.block = block = []
+        self.kind = kind
+        block.append(line)
+
+    def enter_heading(self, match):
+        """見出しの階層を更新して返す。"""
+        level = len(match.group(1))
+        headings = self.headings
+        while headings and headings[-1][0] >= level:
+            headings.pop()
+        headings.append((level, match.group(2).strip()))
+        self.path = tuple(title for _, title in headings)
+        return self.path
+
+    @property
+    def idle(self):
+        """ブロックの途中でないかどうか"""
+        return not self.block
+
+    def finish(self, out):
+        # 閉じられていないコードブロックもそのまま返す
+        if self.block:
+            out.append((self.kind, "\n".join(self.block), self.path))
+            self.kind, self.block, self.fence = None, [], None
+
+
+def _has_structure(text):
+    """
+    見出し・表・コードブロック・インデントされた行（空白だけの行を含む）がありうるかどうか
+    （正規表現より速い部分文字列の検索で判定し、ありうる場合だけ行単位で解析する）
+    """
+    return "#" in text or "|" in text or "```" in text or "~~~" in text \
+        or "\n " in text or "\n\t" in text or text[0] in " \t"
+
+
+def iter_blocks(lines):
+    """
+    行を先頭から読み、(種類, テキスト, 見出しの階層) のブロックを順に返す。
+    種類は heading / code / table / paragraph のいずれか。
+    """
+    parser = _BlockParser()
+    out = []
+    for line in lines:
+        parser.feed(line.rstrip("\r\n"), out)
+        if out:
+            yield from out
+            out.clear()
+    parser.finish(out)
+    yield from out
+
+
+def iter_text_blocks(text):
+    """
+    iter_blocks と同じブロックをテキストから返す。
+    空行で区切った段落単位で読み、見出しや、表・コードブロックが段落と混ざっている部分だけを行単位で解析する。
+    """
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    parser = _BlockParser()
+    out = []
+    for segment in text.split("\n\n"):
+        if parser.idle:
+            # よくある形（段落・見出しだけ・表だけ・コードブロックだけ）は行単位に分けずにそのまま返す
+            block = segment.strip("\n")
+            if not block:
+                continue
+            if not _has_structure(block):
+                yield "paragraph", block, parser.path
+                continue
+            if block[0] == "#" and "\n" not in block:
+                match = _HEADING.match(block)
+                if match:
+                    yield "heading", block, parser.enter_heading(match)
+                    continue
+            if _TABLE_BLOCK.fullmatch(block):
+                yield "table", block, parser.path
+                continue
+            match = _CODE_BLOCK.fullmatch(block)
+            if match and block.count(match.group(1)) == 2:
+                yield "code", block, parser.path
+                continue
+        for line in segment.split("\n"):
+            parser.feed(line, out)
+        # 段落の区切りの空行
+        parser.feed("", out)
+        if out:
+            yield from out
+            out.clear()
+    parser.finish(out)
+    yield from out
+
+
+def _find_break(text, start, end):
+    """
+    text[start:end] を区切る位置を返す（後半にある改行・文末・空白のうち、優先度の高いものの直後）。
+    画像リンクの途中になる場合は、リンクの前（先頭にある場合は後ろ）で区切る。
+    """
+    cut = end
+    if end < len(text):
+        low = start + (end - start) // 2
+        for sep in _BREAKS:
+            i = text.rfind(sep, low, end)
+            if i != -1:
+                cut = i + len(sep)
+                break
+    link = text.rfind("![", start, cut)
+    if link != -1:
+        match = _IMAGE_LINK.match(text, link)
+        if match and match.end() > cut:
+            cut = link if link > start else match.end()
+    return cut
+
+
+def _split_paragraph(text, limit, overlap):
+    """
+    chunk_size を超える段落を、改行・文末・空白の位置で limit 文字以内に分ける。
+    前のテキストの末尾（overlap 文字以内の、文の区切りから後ろ）を次のテキストの先頭に重ねる。
+    """
+    pieces = []
+    start = 0
+    prev_cut = 0
+    while start < len(text):
+        cut = _find_break(text, start, min(start + limit, len(text)))
+        if cut <= prev_cut:
+            # 重ねた部分の後ろで区切れない（前のテキストと同じ長い画像リンクの前で区切られる）場合は、
+            # 重ねずに前の区切り位置から始める
+            start = prev_cut
+            cut = _find_break(text, start, min(start + limit, len(text)))
+        pieces.append(text[start:cut].strip())
+        prev_cut = cut
+        if cut >= len(text):
+            break
+        # 重ねる部分は、区切り位置の overlap 文字前から最初の文の区切りの後ろから始める
+        next_start = cut
+        low = max(cut - overlap, start + 1)
+        for sep in _BREAKS:
+            i = text.find(sep, low, cut - 1)
+            if i != -1 and i + len(sep) < next_start:
+                next_start = i + len(sep)
+        link = text.rfind("![", start, next_start)
+        if link != -1:
+            match = _IMAGE_LINK.match(text, link)
+            if match and match.end() > next_start:
+                next_start = cut
+        start = next_start
+    return [piece for piece in pieces if piece]
+
+
+def _pack_lines(lines, limit, prefix=(), suffix=()):
+    """
+    行を limit 文字以内のテキストに詰める（表・コードブロック用）。
+    prefix・suffix は各テキストの前後に付ける行。
+    """
+    fixed = sum(len(line) + 1 for line in prefix) + sum(len(line) + 1 for line in suffix)
+    limit = max(1, limit - fixed)
+    groups = []
+    start = 0
+    length = -1
+    for i, line in enumerate(lines):
+        size = len(line) + 1
+        if i > start and length + size > limit:
+            groups.append(lines[start:i])
+            start = i
+            length = -1
+        length += size
+    groups.append(lines[start:])
+    return ["\n".join([*prefix, *group, *suffix]) for group in groups]
+
+
+def _split_block(kind, text, limit, overlap):
+    """chunk_size を超えるブロックを、構造を保ったまま limit 文字以内のテキストに分ける。"""
+    if kind == "paragraph":
+        return _split_paragraph(text, limit, overlap)
+    lines = text.split("\n")
+    if kind == "table":
+        # 区切り行までをヘッダーとして、分けた各テキストの先頭に付け直す
+        header = lines[:2] if len(lines) > 2 and _TABLE_SEPARATOR.match(lines[1]) else []
+        return _pack_lines(lines[len(header):], limit, prefix=header)
+    # コードブロックは、分けた各テキストを囲み直す
+    opening = lines[0]
+    fence = _FENCE.match(opening).group(1)
+    body = lines[1:]
+    if body and _FENCE.match(body[-1]):
+        closing = body.pop()
+    else:
+        closing = fence
+    return _pack_lines(body, limit, prefix=[opening], suffix=[closing])
+
+
+class MarkdownChunker:
+    """
+    Markdown を構造を考慮してチャンクに分割する
+    :param chunk_size: 1チャンクの最大文字数（画像リンク1つがこれを超える場合を除く）
+    :param chunk_overlap: 段落の途中で区切る場合に前のチャンクと重ねる最大文字数
+    :param min_chunk_size: この文字数に満たないチャンクは見出しで区切らない
+    """
+
+    def __init__(self, chunk_size=None, chunk_overlap=None, min_chunk_size=None):
+        self.chunk_size = chunk_size or MARKDOWN_CHUNK_SIZE
+        self.chunk_overlap = MARKDOWN_CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap
+        self.min_chunk_size = min_chunk_size or MARKDOWN_MIN_CHUNK_SIZE or self.chunk_size // 2
+        if self.chunk_overlap >= self.chunk_size:
+            raise ValueError("chunk_overlap は chunk_size より小さくしてください")
+
+    def split_text(self, text):
+        """テキストを分割して MarkdownChunk のリストを返す。"""
+        return list(self._iter_chunks(iter_text_blocks(text)))
+
+    def iter_chunks(self, lines):
+        """
+        行のイテラブル（ファイルオブジェクトなど）を読みながら、MarkdownChunk を順に返す。
+        """
+        return self._iter_chunks(iter_blocks(lines))
+
+    def _iter_chunks(self, blocks):
+        chunk_size = self.chunk_size
+        min_chunk_size = self.min_chunk_size
+        # 大きなブロックを分けるときの最小の大きさ（直前のブロックと同じチャンクに入れる分が少なすぎないように）
+        half = chunk_size // 2
+        # 作成中のチャンクのブロック（テキスト・見出しの階層・見出しかどうか）
+        texts = []
+        paths = []
+        is_heading = []
+        # "\n\n" でつなげたときの文字数
+        length = 0
+
+        def flush():
+            nonlocal texts, paths, is_heading, length
+            # 末尾の見出しはチャンクに残さず、次のチャンクの先頭に移す
+            keep = len(texts)
+            while keep and is_heading[keep - 1]:
+                keep -= 1
+            chunk = _make_chunk(texts[:keep], paths[:keep])
+            texts, paths, is_heading = texts[keep:], paths[keep:], is_heading[keep:]
+            length = sum(len(text) for text in texts) + 2 * (len(texts) - 1) if texts else 0
+            return chunk
+
+        for kind, text, heading_path in blocks:
+            if kind == "code" and not text.strip():
+                continue
+            heading = kind == "heading"
+            size = len(text)
+            # 見出しの位置では、前の節が短い場合はまとめ、十分な長さがあれば区切る
+            # それ以外のブロックは、収まらなければ区切る（ブロックの途中では区切らない）
+            if (heading and length >= min_chunk_size) or \
+                    (not heading and texts and length + 2 + size > chunk_size):
+                chunk = flush()
+                if chunk:
+                    yield chunk
+            if heading and size > chunk_size:
+                # chunk_size を超える見出しは段落と同じように分ける（次のチャンクの先頭には移さない）
+                kind, heading = "paragraph", False
+
+            if heading or size <= half or size <= chunk_size - (length + 2 if texts else 0):
+                pieces = (text,)
+            else:
+                limit = max(chunk_size - (length + 2 if texts else 0), half)
+                pieces = _split_block(kind, text, limit, self.chunk_overlap)
+            for i, piece in enumerate(pieces):
+                if i > 0:
+                    # 分けたブロックの2つ目以降は、それぞれ別のチャンクにする
+                    chunk = flush()
+                    if chunk:
+                        yield chunk
+                length += len(piece) + (2 if texts else 0)
+                texts.append(piece)
+                paths.append(heading_path)
+                is_heading.append(heading)
+
+        chunk = _make_chunk(texts, paths)
+        if chunk:
+            yield chunk
+
+
+def _make_chunk(texts, paths):
+    """ブロックをつなげて MarkdownChunk を作る（空の場合は None）。"""
+    text = "\n\n".join(texts).strip()
+    if not text:
+        return None
+    # チャンク内のすべてのブロックに共通する見出しの階層
+    heading_path = paths[0]
+    for path in paths:
+        if path is heading_path:
+            continue
+        common = 0
+        for a, b in zip(heading_path, path):
+            if a != b:
+                break
+            common += 1
+        heading_path = heading_path[:common]
+    return MarkdownChunk(text, list(heading_path))
+
+
+def split_markdown(markdown_text, chunk_size=None, chunk_overlap=None):
+    """
+    Markdown テキストを構造を考慮して分割し、MarkdownChunk のリストを返す。
+    """
+    return MarkdownChunker(chunk_size, chunk_overlap).split_text(markdown_text)
@@ -27,3 +27,30 @@ def extract_image_links(text: str):
     :return: 画像リンクのリスト。見つからなければ空リストを返す。
     """
     return re.findall(IMAGE_PATTERN, text)
+
+
+def find_image_link(text: str):
+    """
+    テキスト中の最初の完成した画像リンクを探す。
+
+    :param text: 対象テキスト
+    :return: re.Match（見つからなければ None）
+    """
+    return re.search(r'!\[.*?\]\(.*?\)', text)
+
+
+def find_unfinished_image_link(text: str) -> int:
+    """
+    ストリーミング中のテキスト末尾にある、まだ閉じていない画像リンクの開始位置を返す。
+    例: 'A ![alt](im' -> 2, 'A !' -> 2, 'A B' -> 3（未完成のリンクがなければ len(text)）
+
+    :param text: 対象テキスト（完成した画像リンクは含まない前提）
+    :return: 確定して表示してよい部分の長さ
+    """
+    start = text.rfind("![")
+    # 改行をまたぐ画像リンクはないため、改行以降にあるものだけを未完成とみなす
+    if start != -1 and "\n" not in text[start:]:
+        return start
+    if text.endswith("!"):
+        return len(text) - 1
+    return len(text)
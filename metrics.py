@@ -0,0 +1,310 @@
+"""
+計測（メトリクス）モジュール
+処理時間を計るスパン（コンテキストマネージャ・デコレータ）と、バイト数・トークン数・
+キャッシュヒット・リトライ回数などのカウンタをプロセス内に集計する。
+スパンはトレース（1回の取り込み・1回の質問など）ごとに id を付けて記録するため、
+遅いリクエストでどの処理に時間がかかったかを後から確認できる。
+
+出力先は環境変数 METRICS_EXPORT で指定する（カンマ区切り）。
+- jsonl: スパンを1行1件の JSON で METRICS_JSONL_PATH に追記する
+- prometheus: 集計値を Prometheus のテキスト形式で METRICS_PROMETHEUS_PATH に書き出す
+
+使い方:
+    from metrics import span, increment
+
+    with span("search.query", backend="azure"):
+        ...
+    increment("blob.upload_bytes", len(data))
+
+    @span("image.prepare")
+    def prepare(...):
+        ...
+"""
+import os
+import re
+import json
+import time
+import uuid
+import atexit
+import threading
+import contextvars
+import logging
+from collections import deque
+from functools import wraps
+from dotenv import load_dotenv
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# 計測の有効・無効
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# 出力形式（jsonl / prometheus をカンマ区切りで指定。空の場合はメモリ上の集計のみ）
+METRICS_EXPORT = {name.strip() for name in os.getenv("METRICS_EXPORT", "jsonl").lower().split(",") if name.strip()}
+METRICS_JSONL_PATH = os.getenv("METRICS_JSONL_PATH", "log/metrics.jsonl")
+METRICS_PROMETHEUS_PATH = os.getenv("METRICS_PROMETHEUS_PATH", "log/metrics.prom")
+# JSONL に書き出すまでにためておくスパンの件数
+METRICS_FLUSH_EVERY = int(os.getenv("METRICS_FLUSH_EVERY", "100"))
+# 診断表示用に保持する直近のスパンの件数
+METRICS_SPAN_HISTORY = int(os.getenv("METRICS_SPAN_HISTORY", "1000"))
+
+# ヒストグラムのバケット（秒）
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 実行中のトレースの id（スレッド・非同期タスクごと）
+_current_trace = contextvars.ContextVar("metrics_trace_id", default=None)
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape_label(value):
+    """Prometheus のラベル値をエスケープする。"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Histogram:
+    """スパンの所要時間の集計"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(_BUCKETS)
+
+    def add(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+class MetricsRegistry:
+    """
+    スパンとカウンタの集計と出力
+    :param export: 出力形式の集合（"jsonl" / "prometheus"）
+    """
+
+    def __init__(self, export=METRICS_EXPORT, jsonl_path=METRICS_JSONL_PATH,
+                 prometheus_path=METRICS_PROMETHEUS_PATH, history=METRICS_SPAN_HISTORY):
+        self.export = set(export)
+        # 終了時（atexit）にカレントディレクトリが変わっていても同じ場所に書き出す
+        self.jsonl_path = os.path.abspath(jsonl_path)
+        self.prometheus_path = os.path.abspath(prometheus_path)
+        self._lock = threading.Lock()
+        # (名前, ラベル) -> 値
+        self._counters = {}
+        # (名前, ラベル) -> _Histogram
+        self._histograms = {}
+        self._recent = deque(maxlen=history)
+        self._pending = []
+        self.last_trace_id = None
+
+    def increment(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, trace_id=None, **labels):
+        """所要時間（秒）を記録する。"""
+        key = (name, _label_key(labels))
+        record = {
+            "ts": time.time(),
+            "name": name,
+            "labels": dict(key[1]),
+            "duration_ms": seconds * 1000,
+            "trace_id": trace_id,
+        }
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.add(seconds)
+            self._recent.append(record)
+            if "jsonl" in self.export:
+                self._pending.append(record)
+                flush = len(self._pending) >= METRICS_FLUSH_EVERY
+            else:
+                flush = False
+        if flush:
+            self._write_jsonl()
+
+    def recent_spans(self, trace_id=None):
+        """直近のスパンを返す（trace_id を指定した場合はそのトレースのものだけ）。"""
+        with self._lock:
+            spans = list(self._recent)
+        if trace_id is not None:
+            spans = [record for record in spans if record["trace_id"] == trace_id]
+        return spans
+
+    def snapshot(self):
+        """カウンタとスパンの集計値を返す。"""
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            spans = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "total_ms": h.sum * 1000,
+                    "mean_ms": h.sum / h.count * 1000 if h.count else 0.0,
+                    "max_ms": h.max * 1000,
+                }
+                for (name, labels), h in sorted(self._histograms.items())
+            ]
+        return {"counters": counters, "spans": spans}
+
+    def to_prometheus(self):
+        """集計値を Prometheus のテキスト形式で返す。"""
+        def metric_name(name, suffix):
+            return "aisearch_" + re.sub(r"[^a-zA-Z0-9_]", "_", name) + suffix
+
+        def label_text(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in items) + "}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+            seen = set()
+            for (name, labels), value in counters:
+                metric = metric_name(name, "_total")
+                if metric not in seen:
+                    lines.append(f"# TYPE {metric} counter")
+                    seen.add(metric)
+                lines.append(f"{metric}{label_text(labels)} {value}")
+            for (name, labels), h in histograms:
+                metric = metric_name(name, "_seconds")
+                if metric not in seen:
+                    lines.append(f"# TYPE {metric} histogram")
+                    seen.add(metric)
+                for bound, count in zip(_BUCKETS, h.buckets):
+                    lines.append(f"{metric}_bucket{label_text(labels, [('le', bound)])} {count}")
+                lines.append(f"{metric}_bucket{label_text(labels, [('le', '+Inf')])} {h.count}")
+                lines.append(f"{metric}_sum{label_text(labels)} {h.sum}")
+                lines.append(f"{metric}_count{label_text(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def _write_jsonl(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.jsonl_path) or ".", exist_ok=True)
+            with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                for record in pending:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.warning("メトリクスの書き込みに失敗しました: %s %s", self.jsonl_path, e)
+
+    def flush(self):
+        """ためているスパンを JSONL に追記し、Prometheus 形式のファイルを書き出す。"""
+        if "jsonl" in self.export:
+            self._write_jsonl()
+        if "prometheus" in self.export:
+            tmp_path = self.prometheus_path + ".tmp"
+            try:
+                os.makedirs(os.path.dirname(self.prometheus_path) or ".", exist_ok=True)
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(self.to_prometheus())
+                os.replace(tmp_path, self.prometheus_path)
+            except OSError as e:
+                logger.warning("メトリクスの書き込みに失敗しました: %s %s", self.prometheus_path, e)
+
+
+_registry = MetricsRegistry()
+atexit.register(_registry.flush)
+
+
+def get_registry():
+    """プロセス共通の MetricsRegistry を返す。"""
+    return _registry
+
+
+def increment(name, value=1, **labels):
+    """カウンタを加算する。"""
+    if METRICS_ENABLED:
+        _registry.increment(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    """別の場所（子プロセスなど）で計った所要時間を、現在のトレースのスパンとして記録する。"""
+    if METRICS_ENABLED:
+        _registry.observe(name, seconds, trace_id=_current_trace.get(), **labels)
+
+
+def flush():
+    """計測結果をファイルに書き出す。"""
+    if METRICS_ENABLED:
+        _registry.flush()
+
+
+class span:
+    """
+    処理時間を計るスパン
+    with span("name", label=value): の形でも、@span("name") のデコレータとしても使える。
+    例外で抜けた場合は error ラベルに例外クラス名を付けて記録する。
+    """
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if METRICS_ENABLED and self._start is not None:
+            labels = self.labels if exc_type is None else {**self.labels, "error": exc_type.__name__}
+            _registry.observe(self.name, time.perf_counter() - self._start,
+                              trace_id=_current_trace.get(), **labels)
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            # 呼び出しごとに別のスパンを作る（スレッド間で開始時刻を共有しない）
+            with span(self.name, **self.labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class trace(span):
+    """
+    トレースを開始するスパン
+    この中で記録したスパンには同じ trace_id が付く（既にトレース中であればそれを引き継ぐ）。
+    """
+
+    def __enter__(self):
+        self._token = None
+        self.trace_id = _current_trace.get()
+        if self.trace_id is None:
+            self.trace_id = uuid.uuid4().hex[:16]
+            self._token = _current_trace.set(self.trace_id)
+            _registry.last_trace_id = self.trace_id
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        if self._token is not None:
+            _current_trace.reset(self._token)
+        return False
+
+
+def current_trace_id():
+    """実行中のトレースの id を返す（トレース外では None）。"""
+    return _current_trace.get()
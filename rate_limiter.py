@@ -0,0 +1,394 @@
+"""
+エンドポイントごとのレート制限
+埋め込み・チャット（OpenAI）、検索・インデックス登録（Azure AI Search）の呼び出しの前に
+リクエスト数（RPM）とトークン数（TPM）のトークンバケットで待ち合わせ、プロセス内の全スレッドで1つの上限を共有する。
+上限を超えて 429 になってから再送するのではなく、上限の少し手前の一定のペースで送り続ける。
+
+応答のヘッダーに合わせて調整する。
+- 429 / 503: Retry-After（retry-after-ms・x-ratelimit-reset-*）の間、同じエンドポイントへの送信をすべて止め、送信ペースを下げる。
+  成功が続くと少しずつ元のペースに戻す。
+- x-ratelimit-limit-*: サービス側の上限が設定値より小さければそれに合わせる（上限を設定していない場合も使う）
+- x-ratelimit-remaining-*: 残りがバケットより少なければバケットを減らす
+
+上限は環境変数 RATE_LIMIT_<エンドポイント名>_RPM / _TPM で設定する（0 で制限しない）。
+エンドポイント名: embeddings / chat / search.query / search.index（環境変数では "." を "_" にする）
+
+使い方:
+    limiter = get_limiter("search.index")
+    limiter.acquire()
+    resp = http_client.post(...)
+    limiter.observe(resp.status_code, resp.headers)
+
+    # 待ち合わせ・429 / 503 などでの再送をまとめて行う場合
+    resp = send_with_retries("search.query", lambda: http_client.post(...), {429, 503}, max_retries=3)
+
+    # OpenAI（LangChain）のクライアントには、送信前後にこれを行う httpx クライアントを渡す
+    OpenAIEmbeddings(http_client=create_httpx_client("embeddings"), ...)
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+import logging
+from email.utils import parsedate_to_datetime
+from dotenv import load_dotenv
+from metrics import increment, observe
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# レート制限の有効・無効（false で待ち合わせをしない。429 を受けたときの再送は各呼び出し側で行う）
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# 上限に対して実際に使う割合（上限ちょうどではなく少し手前で送る）
+RATE_LIMIT_HEADROOM = float(os.getenv("RATE_LIMIT_HEADROOM", "0.9"))
+# まとめて送ってよい量（何秒分の上限までバーストを許すか）
+RATE_LIMIT_BURST_SECONDS = float(os.getenv("RATE_LIMIT_BURST_SECONDS", "5"))
+# 429 / 503 に Retry-After がない場合の待ち時間の初期値（秒）。続けて受けるたびに倍になる
+RATE_LIMIT_BACKOFF_SECONDS = float(os.getenv("RATE_LIMIT_BACKOFF_SECONDS", "1"))
+# 429 / 503 を受けたときに送信ペースを下げる下限（設定した上限に対する割合）
+RATE_LIMIT_MIN_FACTOR = 0.1
+# 成功1回ごとに送信ペースを戻す量（設定した上限に対する割合）
+RATE_LIMIT_RECOVERY = 0.02
+# 待ち時間の上限（秒）
+RATE_LIMIT_MAX_WAIT_SECONDS = 60.0
+# OpenAI SDK が 429 などで再送する最大回数（再送も1回ずつレート制限で待ち合わせる）
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "6"))
+
+_KINDS = ("requests", "tokens")
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _parse_duration(value):
+    """"6m0s"・"1.5s"・"20ms" 形式（x-ratelimit-reset-*）の時間を秒にする。"""
+    seconds = 0.0
+    number = ""
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char.isdigit() or char == ".":
+            number += char
+        elif value.startswith("ms", i):
+            seconds += float(number or 0) / 1000
+            number = ""
+            i += 1
+        else:
+            seconds += float(number or 0) * {"h": 3600, "m": 60, "s": 1}.get(char, 0)
+            number = ""
+        i += 1
+    return seconds + (float(number) if number else 0.0)
+
+
+def _header_number(headers, name):
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def retry_after_seconds(headers):
+    """
+    応答ヘッダーから再送までの待ち時間（秒）を返す（ヘッダーがない場合は None）。
+    retry-after-ms、Retry-After（秒または日時）、残りが 0 の x-ratelimit-reset-* の順に使う。
+    """
+    milliseconds = _header_number(headers, "retry-after-ms")
+    if milliseconds is not None:
+        return milliseconds / 1000
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    resets = [
+        _parse_duration(headers[f"x-ratelimit-reset-{kind}"])
+        for kind in _KINDS
+        if headers.get(f"x-ratelimit-reset-{kind}") and _header_number(headers, f"x-ratelimit-remaining-{kind}") == 0
+    ]
+    return max(resets) if resets else None
+
+
+class RateLimiter:
+    """
+    1つのエンドポイントのリクエスト数・トークン数のトークンバケット（複数スレッドから同時に使ってよい）
+    送信の前に acquire で必要な分を予約し（足りなければ貯まるまで待つ）、応答を observe に渡す。
+    :param name: エンドポイント名（ログ・メトリクスのラベル）
+    :param rpm: 1分あたりの最大リクエスト数（0 で制限しない）
+    :param tpm: 1分あたりの最大トークン数（0 で制限しない）
+    """
+
+    def __init__(self, name, rpm=0, tpm=0, headroom=None, burst_seconds=None, enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self.limits = {"requests": rpm, "tokens": tpm}
+        self.headroom = RATE_LIMIT_HEADROOM if headroom is None else headroom
+        self.burst_seconds = RATE_LIMIT_BURST_SECONDS if burst_seconds is None else burst_seconds
+        # バケットの残量（None は満杯）
+        self._levels = {"requests": None, "tokens": None}
+        self._updated = time.monotonic()
+        # 429 / 503 を受けて下げた送信ペース（1.0 で上限どおり）
+        self._factor = 1.0
+        self._throttled = 0
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _rate(self, kind):
+        """1秒あたりに貯まる量"""
+        return self.limits[kind] * self.headroom * self._factor / 60
+
+    def _capacity(self, kind):
+        return max(self._rate(kind) * self.burst_seconds, 1.0)
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        for kind in _KINDS:
+            if not self.limits[kind]:
+                continue
+            level = self._levels[kind]
+            capacity = self._capacity(kind)
+            self._levels[kind] = capacity if level is None else min(capacity, level + elapsed * self._rate(kind))
+
+    def _reserve(self, tokens):
+        """必要な分を予約し、送信してよくなるまでの秒数を返す（足りない分は後から貯まる分を先取りする）。"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._blocked_until - now
+            for kind, amount in (("requests", 1), ("tokens", tokens)):
+                if not self.limits[kind] or not amount:
+                    continue
+                self._levels[kind] -= amount
+                if self._levels[kind] < 0:
+                    wait = max(wait, -self._levels[kind] / self._rate(kind))
+            return min(max(wait, 0.0), RATE_LIMIT_MAX_WAIT_SECONDS)
+
+    def acquire(self, tokens=0):
+        """
+        リクエスト1件（とトークン数）を予約し、送信してよくなるまで待つ。
+        :return: 待った秒数
+        """
+        if not self.enabled:
+            return 0.0
+        waited = self._reserve(tokens)
+        if waited:
+            time.sleep(waited)
+        # 待っている間に他のスレッドが 429 を受けた場合は、その待ち時間も守る
+        blocked = self._blocked_until - time.monotonic()
+        while blocked > 0:
+            time.sleep(blocked)
+            waited += blocked
+            blocked = self._blocked_until - time.monotonic()
+        if waited:
+            observe("rate_limit.wait", waited, endpoint=self.name)
+        return waited
+
+    async def aacquire(self, tokens=0):
+        """acquire の非同期版"""
+        if not self.enabled:
+            return 0.0
+        waited = self._reserve(tokens)
+        if waited:
+            await asyncio.sleep(waited)
+        blocked = self._blocked_until - time.monotonic()
+        while blocked > 0:
+            await asyncio.sleep(blocked)
+            waited += blocked
+            blocked = self._blocked_until - time.monotonic()
+        if waited:
+            observe("rate_limit.wait", waited, endpoint=self.name)
+        return waited
+
+    def observe(self, status_code, headers):
+        """
+        応答のステータスコードとヘッダーから上限・残量・送信ペースを調整する。
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._refill(now)
+            for kind in _KINDS:
+                # サービス側の上限（設定より小さい場合・設定がない場合に使う）
+                limit = _header_number(headers, f"x-ratelimit-limit-{kind}")
+                if limit and (not self.limits[kind] or limit < self.limits[kind]):
+                    logger.info("レート制限の上限をサービスの値に合わせます: %s %s %d/分", self.name, kind, limit)
+                    self.limits[kind] = limit
+                    self._levels[kind] = None
+                remaining = _header_number(headers, f"x-ratelimit-remaining-{kind}")
+                if remaining is not None and self.limits[kind] and self._levels[kind] is not None:
+                    self._levels[kind] = min(self._levels[kind], remaining)
+
+            if status_code in (429, 503):
+                delay = retry_after_seconds(headers)
+                if delay is None:
+                    delay = RATE_LIMIT_BACKOFF_SECONDS * (2 ** min(self._throttled, 6))
+                delay = min(delay, RATE_LIMIT_MAX_WAIT_SECONDS)
+                self._throttled += 1
+                self._blocked_until = max(self._blocked_until, now + delay)
+                self._factor = max(RATE_LIMIT_MIN_FACTOR, self._factor / 2)
+                throttled = True
+            else:
+                if status_code < 400:
+                    self._throttled = 0
+                    self._factor = min(1.0, self._factor + RATE_LIMIT_RECOVERY)
+                throttled = False
+        if throttled:
+            increment("rate_limit.throttled", endpoint=self.name, status=status_code)
+            logger.warning(
+                "%s: %s を受けたため %.2f 秒送信を止めます（送信ペース %.0f%%）",
+                self.name, status_code, delay, self._factor * 100,
+            )
+
+
+def get_limiter(name):
+    """
+    エンドポイントのレート制限を返す（プロセス内で1つ。初回呼び出し時に環境変数から上限を読み込む）。
+    """
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(name)
+            if limiter is None:
+                key = name.upper().replace(".", "_")
+                limiter = RateLimiter(
+                    name,
+                    rpm=float(os.getenv(f"RATE_LIMIT_{key}_RPM", "0")),
+                    tpm=float(os.getenv(f"RATE_LIMIT_{key}_TPM", "0")),
+                    enabled=RATE_LIMIT_ENABLED,
+                )
+                _limiters[name] = limiter
+    return limiter
+
+
+def retry_wait_seconds(limiter, attempt, status_code, headers, base_seconds=None):
+    """
+    再送の前に呼び出し側で待つ秒数を返す。
+    レート制限が有効で 429 / 503 の場合は、observe で止めた時間を次の acquire で待つため 0 を返す。
+    それ以外（レート制限が無効な場合・500 などの場合）は Retry-After、なければ指数バックオフ（ジッター付き）とする。
+    """
+    if limiter.enabled and status_code in (429, 503):
+        return 0.0
+    delay = retry_after_seconds(headers)
+    if delay is None:
+        base_seconds = RATE_LIMIT_BACKOFF_SECONDS if base_seconds is None else base_seconds
+        delay = base_seconds * (2 ** attempt) * (0.5 + random.random() / 2)
+    return min(delay, RATE_LIMIT_MAX_WAIT_SECONDS)
+
+
+def send_with_retries(name, send, retryable_status, max_retries, tokens=0, base_seconds=None):
+    """
+    get_limiter(name) で待ち合わせてからリクエストを送信し、retryable_status の応答は待ってから再送する。
+    :param send: リクエストを送信して応答（requests / httpx）を返す関数
+    :param max_retries: 最大再送回数
+    :return: 最後の応答
+    """
+    limiter = get_limiter(name)
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens)
+        response = send()
+        limiter.observe(response.status_code, response.headers)
+        if response.status_code not in retryable_status or attempt == max_retries:
+            return response
+        increment("rate_limit.retries", endpoint=name, status=response.status_code)
+        logger.warning("%s リトライ（%d 回目）: %s", name, attempt + 1, response.status_code)
+        wait = retry_wait_seconds(limiter, attempt, response.status_code, response.headers, base_seconds)
+        if wait:
+            time.sleep(wait)
+    return response
+
+
+async def asend_with_retries(name, send, retryable_status, max_retries, tokens=0, base_seconds=None):
+    """send_with_retries の非同期版（send は応答を返すコルーチン関数）"""
+    limiter = get_limiter(name)
+    for attempt in range(max_retries + 1):
+        await limiter.aacquire(tokens)
+        response = await send()
+        limiter.observe(response.status_code, response.headers)
+        if response.status_code not in retryable_status or attempt == max_retries:
+            return response
+        increment("rate_limit.retries", endpoint=name, status=response.status_code)
+        logger.warning("%s リトライ（%d 回目）: %s", name, attempt + 1, response.status_code)
+        wait = retry_wait_seconds(limiter, attempt, response.status_code, response.headers, base_seconds)
+        if wait:
+            await asyncio.sleep(wait)
+    return response
+
+
+def estimate_request_tokens(payload):
+    """
+    OpenAI のリクエストボディ（埋め込み・チャット）のトークン数を概算する。
+    チャットは max_tokens の分も上限に数えられるため加える。
+    """
+    from embedding_stage import estimate_tokens
+
+    tokens = 0
+    inputs = payload.get("input")
+    if isinstance(inputs, str):
+        tokens += estimate_tokens(inputs)
+    elif isinstance(inputs, list):
+        if inputs and isinstance(inputs[0], int):
+            # トークン列1件
+            tokens += len(inputs)
+        for item in inputs:
+            if isinstance(item, str):
+                tokens += estimate_tokens(item)
+            elif isinstance(item, list):
+                tokens += len(item)
+    for message in payload.get("messages") or []:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += estimate_tokens(content)
+        elif isinstance(content, list):
+            tokens += sum(estimate_tokens(part.get("text", "")) for part in content if isinstance(part, dict))
+    tokens += payload.get("max_completion_tokens") or payload.get("max_tokens") or 0
+    return tokens
+
+
+def _request_tokens(request):
+    try:
+        return estimate_request_tokens(json.loads(request.content or b"{}"))
+    except Exception:
+        # ストリームのボディ・JSON 以外のボディはリクエスト数だけ数える
+        return 0
+
+
+def create_httpx_client(name, asynchronous=False):
+    """
+    送信前に get_limiter(name) で待ち合わせ、応答ヘッダーを渡す httpx のクライアントを作成する。
+    OpenAI SDK（LangChain の OpenAIEmbeddings・ChatOpenAI）の http_client / http_async_client に渡す。
+    SDK 内部の再送も1回ずつ待ち合わせる。
+    """
+    import httpx
+
+    limiter = get_limiter(name)
+    if asynchronous:
+        async def on_request(request):
+            await limiter.aacquire(_request_tokens(request))
+
+        async def on_response(response):
+            limiter.observe(response.status_code, response.headers)
+
+        return httpx.AsyncClient(
+            event_hooks={"request": [on_request], "response": [on_response]}, follow_redirects=True
+        )
+
+    def on_request(request):
+        limiter.acquire(_request_tokens(request))
+
+    def on_response(response):
+        limiter.observe(response.status_code, response.headers)
+
+    return httpx.Client(event_hooks={"request": [on_request], "response": [on_response]}, follow_redirects=True)
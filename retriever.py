@@ -1,16 +1,128 @@
-from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
 from langchain.schema import BaseRetriever, Document
 from typing import List, Optional
-import requests
+import http_client
+import asyncio
 import json
-from langchain_openai import OpenAIEmbeddings
+import os
+import re
+import threading
+import unicodedata
+from dotenv import load_dotenv
+from ttl_cache import TTLCache
+from index_events import current_index_generation
+from search_backend import SEARCH_BACKEND, get_search_backend
+from embedding_stage import EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, create_embeddings
+from metrics import span, increment
+from rate_limiter import send_with_retries, asend_with_retries
 import logging
 from logging_config import configure_logging
 
 configure_logging()
 logger = logging.getLogger(__name__)
 
-embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
+load_dotenv()
+# クエリベクトルキャッシュの最大件数と有効期限（秒）
+QUERY_VECTOR_CACHE_SIZE = int(os.getenv("QUERY_VECTOR_CACHE_SIZE", "1000"))
+QUERY_VECTOR_CACHE_TTL = float(os.getenv("QUERY_VECTOR_CACHE_TTL", "86400"))
+# 検索結果キャッシュの最大件数（0 で無効）と有効期限（秒）
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "500"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+# 検索が 429 / 503（スロットリング）になった場合の最大リトライ回数
+SEARCH_MAX_RETRIES = int(os.getenv("SEARCH_MAX_RETRIES", "3"))
+# リトライするステータスコード（待ち時間は rate_limiter が Retry-After から決める）
+RETRYABLE_SEARCH_STATUS = {429, 503}
+
+# 取得するフィールド
+SELECT_FIELDS = "id,text,title,imagebloburls,parent_filename,image_filenames"
+
+# 埋め込みモデルごとのクライアント（初回利用時に作成する）
+_embeddings = {}
+_embeddings_lock = threading.Lock()
+# (埋め込みモデル, 次元数, 正規化したクエリ) -> クエリベクトル
+query_vector_cache = TTLCache(maxsize=QUERY_VECTOR_CACHE_SIZE, ttl=QUERY_VECTOR_CACHE_TTL)
+# 検索条件 -> 検索結果（Document のリスト）
+search_result_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+# 検索結果キャッシュを作成した時点のインデックスの世代
+_search_cache_generation = None
+_search_cache_lock = threading.Lock()
+
+
+def get_embeddings(model: str):
+    """埋め込みクライアントを返す（import 時ではなく初回利用時に作成する）。"""
+    embeddings = _embeddings.get(model)
+    if embeddings is None:
+        with _embeddings_lock:
+            embeddings = _embeddings.get(model)
+            if embeddings is None:
+                # 取り込み時と同じ次元数のベクトルを返すクライアントを使う
+                embeddings = create_embeddings(model)
+                _embeddings[model] = embeddings
+    return embeddings
+
+
+def _check_index_generation():
+    """
+    取り込みスクリプトがインデックスを更新していれば検索結果キャッシュを破棄する。
+    :return: 現在のインデックスの世代
+    """
+    global _search_cache_generation
+    generation = current_index_generation()
+    if generation != _search_cache_generation:
+        with _search_cache_lock:
+            if generation != _search_cache_generation:
+                if _search_cache_generation is not None:
+                    logger.info("インデックスが更新されたため検索結果キャッシュを破棄します")
+                search_result_cache.clear()
+                _search_cache_generation = generation
+    return generation
+
+
+def invalidate_search_cache():
+    """検索結果キャッシュを破棄する（同じプロセス内でインデックスを更新した場合に呼ぶ）。"""
+    search_result_cache.clear()
+
+
+def get_cache_stats():
+    """検索結果キャッシュとクエリベクトルキャッシュのヒット率などを返す。"""
+    return {
+        "search_result": search_result_cache.stats(),
+        "query_vector": query_vector_cache.stats(),
+    }
+
+
+def _copy_documents(documents: List[Document]) -> List[Document]:
+    """キャッシュの中身を呼び出し側に変更されないよう Document を複製する。"""
+    return [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in documents]
+
+
+def _post_search(url, headers, body):
+    """
+    検索リクエストを送信する。
+    送信前に検索のレート制限で待ち合わせ、スロットリングされた場合は待ってから再送する。
+    """
+    return send_with_retries(
+        "search.query",
+        lambda: http_client.post(url, headers=headers, data=body),
+        RETRYABLE_SEARCH_STATUS,
+        SEARCH_MAX_RETRIES,
+    )
+
+
+async def _apost_search(url, headers, body):
+    """_post_search の非同期版"""
+    return await asend_with_retries(
+        "search.query",
+        lambda: http_client.apost(url, headers=headers, content=body),
+        RETRYABLE_SEARCH_STATUS,
+        SEARCH_MAX_RETRIES,
+    )
+
+
+def normalize_query(query: str) -> str:
+    """キャッシュキー用にクエリを正規化する（全角半角・大文字小文字・空白の違いを吸収する）。"""
+    query = unicodedata.normalize("NFKC", query).casefold()
+    return re.sub(r"\s+", " ", query).strip()
 
 class AzureAISearchRetriever(BaseRetriever):
     """
@@ -23,9 +135,57 @@ class AzureAISearchRetriever(BaseRetriever):
     qa_content_key: str
     qa_top: int
     qa_scoring_profile: str
-    def _get_relevant_documents(
-        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
-    ) -> List[Document]:
+    # "text": 検索サービス側でクエリをベクトル化する / "vector": クライアント側でベクトル化して送る
+    query_vector_mode: str = 'text'
+    embedding_model: str = EMBEDDING_MODEL
+
+    def _get_query_vector(self, query: str) -> List[float]:
+        """クエリベクトルをキャッシュから取得し、なければ埋め込み API で計算する。"""
+        key = (self.embedding_model, EMBEDDING_DIMENSIONS, normalize_query(query))
+        vector = query_vector_cache.get(key)
+        increment("query_vector.cache", result="miss" if vector is None else "hit")
+        if vector is None:
+            with span("embedding.query"):
+                vector = get_embeddings(self.embedding_model).embed_query(query)
+            query_vector_cache.set(key, vector)
+        return vector
+
+    async def _aget_query_vector(self, query: str) -> List[float]:
+        """_get_query_vector の非同期版。"""
+        key = (self.embedding_model, EMBEDDING_DIMENSIONS, normalize_query(query))
+        vector = query_vector_cache.get(key)
+        increment("query_vector.cache", result="miss" if vector is None else "hit")
+        if vector is None:
+            with span("embedding.query"):
+                vector = await get_embeddings(self.embedding_model).aembed_query(query)
+            query_vector_cache.set(key, vector)
+        return vector
+
+    def embed_query(self, query: str) -> List[float]:
+        """クエリベクトルを返す（回答キャッシュの検索などに使う。検索と同じキャッシュを共有する）。"""
+        return self._get_query_vector(query)
+
+    def _result_cache_key(self, query: str):
+        """検索結果キャッシュのキー（検索結果に影響するすべての条件を含める）。"""
+        return (
+            _check_index_generation(),
+            self.service_name,
+            self.index_name,
+            normalize_query(query),
+            self.qa_top,
+            self.qa_scoring_profile,
+            SELECT_FIELDS,
+            self.query_vector_mode,
+            self.embedding_model,
+            EMBEDDING_DIMENSIONS,
+            SEARCH_BACKEND,
+        )
+
+    def _build_request(self, query: str, vector: Optional[List[float]] = None):
+        """
+        検索リクエストの URL・ヘッダー・ボディを組み立てる。
+        vector を指定した場合は "kind": "vector" のベクトルクエリを送る。
+        """
         # ヘッダーの設定
         headers = {
             'Content-Type': 'application/json',
@@ -43,43 +203,107 @@ class AzureAISearchRetriever(BaseRetriever):
                     "fields": "text_vector",
                     "k": self.qa_top,
                     "text": query,
+                } if vector is None else {
+                    "kind": "vector",
+                    "fields": "text_vector",
+                    "k": self.qa_top,
+                    "vector": vector,
                 }
             ],
-            "select": "id,text,title,imagebloburls,parent_filename,image_filenames"  # 取得するフィールドを指定
+            "select": SELECT_FIELDS  # 取得するフィールドを指定
         })
         # リクエスト URL の構築
         url = f'{self.service_name}/indexes/{self.index_name}/docs/search?api-version={self.api_version}'
-        # リクエストの実行
-        response = requests.post(url, headers=headers, data=body)
+        return url, headers, body
+
+    def _items_to_documents(self, items) -> List[Document]:
+        """検索結果の各アイテムを Document オブジェクトに変換する。"""
+        documents = []
+        for item in items:
+            answer = item.get(self.qa_content_key)
+            if answer:
+                metadata = {k: v for k, v in item.items() if k != self.qa_content_key}
+                documents.append(Document(page_content=answer, metadata=metadata))
+        return documents
+
+    def _search_local(self, query: str, vector: List[float]) -> List[Document]:
+        """組み込みのローカル検索エンジンで検索する（クエリベクトルはクライアント側で計算したもの）。"""
+        items = get_search_backend().search(
+            text=query, vector=vector, top=self.qa_top, k=self.qa_top, select=SELECT_FIELDS
+        )
+        return self._items_to_documents(items)
+
+    def _to_documents(self, response) -> List[Document]:
+        """
+        検索レスポンス（requests / httpx）を Document のリストに変換する。
+        :raises RuntimeError: リトライしても検索に失敗した場合・レスポンスを解析できない場合
+        （0件の結果と区別できるよう、空のリストは返さない）
+        """
         # レスポンスの確認
-        if response.status_code == 200:
-            try:
-                # JSONレスポンスの取得
-                data = response.json()
-                # 各結果を Document オブジェクトに変換
-                documents = []
-                for item in data.get("value", []):
-                    answer = item.get(self.qa_content_key)
-                    if answer:
-                        metadata = {k: v for k, v in item.items() if k != self.qa_content_key}
-                        doc = Document(page_content=answer, metadata=metadata)
-                        documents.append(doc)
-                return documents
-            except Exception as e:
-                # JSON解析エラーの場合
-                logger.exception("JSON解析エラー: %s", e)
-                logger.debug("レスポンス内容: %s", response.text)
-        else:
-            # リクエスト失敗の場合
+        if response.status_code != 200:
             logger.error("リクエスト失敗: ステータスコード %s", response.status_code)
             logger.debug("レスポンス内容: %s", response.text)
+            raise RuntimeError(f"検索に失敗しました: ステータスコード {response.status_code}")
+        try:
+            # JSONレスポンスの取得
+            data = response.json()
+            items = data.get("value", [])
+        except Exception as e:
+            logger.exception("JSON解析エラー: %s", e)
+            logger.debug("レスポンス内容: %s", response.text)
+            raise RuntimeError(f"検索結果を解析できませんでした: {e}") from e
+        return self._items_to_documents(items)
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        cache_key = self._result_cache_key(query)
+        cached = search_result_cache.get(cache_key)
+        increment("search.cache", result="miss" if cached is None else "hit")
+        if cached is not None:
+            return _copy_documents(cached)
+        with span("search.query", backend=SEARCH_BACKEND):
+            if SEARCH_BACKEND == "local":
+                # ローカル検索エンジンはクエリをベクトル化できないため常にクライアント側で計算する
+                documents = self._search_local(query, self._get_query_vector(query))
+            else:
+                vector = self._get_query_vector(query) if self.query_vector_mode == "vector" else None
+                url, headers, body = self._build_request(query, vector)
+                # リクエストの実行（レート制限の待ち合わせとスロットリング時の再送を含む）
+                response = _post_search(url, headers, body)
+                documents = self._to_documents(response)
+        # 失敗・0件の結果はキャッシュしない
+        if documents:
+            search_result_cache.set(cache_key, _copy_documents(documents))
+        return documents
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        cache_key = self._result_cache_key(query)
+        cached = search_result_cache.get(cache_key)
+        increment("search.cache", result="miss" if cached is None else "hit")
+        if cached is not None:
+            return _copy_documents(cached)
+        with span("search.query", backend=SEARCH_BACKEND):
+            if SEARCH_BACKEND == "local":
+                # 検索は CPU 処理のためイベントループを止めないよう別スレッドで実行する
+                vector = await self._aget_query_vector(query)
+                documents = await asyncio.to_thread(self._search_local, query, vector)
+            else:
+                vector = await self._aget_query_vector(query) if self.query_vector_mode == "vector" else None
+                url, headers, body = self._build_request(query, vector)
+                # 共通の AsyncClient でリクエストを実行（同時実行数はセマフォで制限される）
+                response = await _apost_search(url, headers, body)
+                documents = self._to_documents(response)
+        # 失敗・0件の結果はキャッシュしない
+        if documents:
+            search_result_cache.set(cache_key, _copy_documents(documents))
+        return documents
 
 
 
 if __name__ == "__main__":
-    import os
-    from dotenv import load_dotenv
-    load_dotenv()
     # Azure AI Searchの設定（必要に応じて値を変更してください）
     AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
     AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX")
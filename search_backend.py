@@ -0,0 +1,298 @@
+"""
+検索バックエンド
+インデックス登録・id 検索・ハイブリッド検索の操作を共通のインターフェースで提供し、
+Azure AI Search と組み込みのローカル検索エンジン（local_search.py）を切り替えられるようにする。
+使用するバックエンドは環境変数 SEARCH_BACKEND（azure / local）で指定する。
+Azure AI Search の REST API の呼び出し（バッチ分割・リトライ・ページング）はこのモジュールで行う。
+"""
+import os
+import json
+import time
+import threading
+import logging
+from abc import ABC, abstractmethod
+import requests
+import http_client
+from dotenv import load_dotenv
+from metrics import span, increment
+from rate_limiter import get_limiter, send_with_retries, retry_wait_seconds
+from logging_config import configure_logging
+
+# ロギングを初期化（既に設定済みなら再設定しない）
+configure_logging()
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# 使用する検索バックエンド（azure / local）
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "azure").lower()
+
+AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
+AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX")
+AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
+AZURE_SEARCH_API_VERSION = "2024-07-01"
+
+# search.index の1リクエストあたりの最大アクション数（サービス上限は 1000）
+INDEX_BATCH_MAX_ACTIONS = int(os.getenv("INDEX_BATCH_MAX_ACTIONS", "1000"))
+# search.index の1リクエストあたりの最大バイト数（サービス上限は 16MB）
+INDEX_BATCH_MAX_BYTES = int(os.getenv("INDEX_BATCH_MAX_BYTES", str(15 * 1024 * 1024)))
+# 失敗したアクションの最大リトライ回数
+INDEX_MAX_RETRIES = int(os.getenv("INDEX_MAX_RETRIES", "5"))
+# リトライ間隔の初期値（秒）。リトライごとに倍になる
+INDEX_RETRY_BASE_SECONDS = float(os.getenv("INDEX_RETRY_BASE_SECONDS", "1"))
+# id 検索の1ページあたりの件数
+SEARCH_PAGE_SIZE = 1000
+# 部分失敗（207）のうちリトライで成功しうるステータスコード
+RETRYABLE_ITEM_STATUS = {409, 422, 503}
+# リクエスト全体をリトライするステータスコード
+RETRYABLE_REQUEST_STATUS = {429, 500, 502, 503, 504}
+
+
+class SearchBackend(ABC):
+    """
+    検索バックエンドのインターフェース
+    """
+    name = ""
+
+    @abstractmethod
+    def index_actions(self, actions):
+        """
+        search.index と同じ形式のアクション（upload / mergeOrUpload / merge / delete）を適用する。
+        :return: 失敗したアイテムの id のリスト
+        """
+
+    @abstractmethod
+    def find_ids(self, parent_filename):
+        """
+        parent_filename が一致するドキュメントの id 一覧を返す。
+        :return: id のリスト（取得に失敗した場合は None）
+        """
+
+    @abstractmethod
+    def search(self, text=None, vector=None, top=50, k=None, select=None, filter=None):
+        """
+        キーワードとベクトルのハイブリッド検索を行う。
+        :return: Azure AI Search の value と同じ形式の辞書のリスト
+        """
+
+
+def split_index_batches(actions, max_actions=None, max_bytes=None):
+    """
+    アクションを件数とシリアライズ後のバイト数の両方の上限を超えないバッチに分割する関数
+    """
+    max_actions = max_actions or INDEX_BATCH_MAX_ACTIONS
+    max_bytes = max_bytes or INDEX_BATCH_MAX_BYTES
+    # {"value": [...]} の外側の分
+    overhead = len('{"value": []}')
+    batches = []
+    current = []
+    current_bytes = overhead
+    for action in actions:
+        # 区切りの ", " の分を加える
+        size = len(json.dumps(action).encode("utf-8")) + 2
+        if current and (len(current) >= max_actions or current_bytes + size > max_bytes):
+            batches.append(current)
+            current = []
+            current_bytes = overhead
+        current.append(action)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+class AzureSearchBackend(SearchBackend):
+    """Azure AI Search の REST API を使うバックエンド"""
+    name = "azure"
+
+    def _headers(self):
+        return {
+            "Content-Type": "application/json",
+            "api-key": AZURE_SEARCH_API_KEY
+        }
+
+    def _docs_url(self, operation):
+        return (
+            f"{AZURE_SEARCH_ENDPOINT}/indexes/{AZURE_SEARCH_INDEX}/docs/{operation}"
+            f"?api-version={AZURE_SEARCH_API_VERSION}"
+        )
+
+    def _post_search(self, search_body):
+        """
+        検索 API を呼び出す。検索のレート制限で待ち合わせ、スロットリングされた場合は待ってから再送する。
+        """
+        return send_with_retries(
+            "search.query",
+            lambda: http_client.post(self._docs_url("search"), headers=self._headers(), json=search_body),
+            RETRYABLE_REQUEST_STATUS,
+            INDEX_MAX_RETRIES,
+            base_seconds=INDEX_RETRY_BASE_SECONDS,
+        )
+
+    def index_actions(self, actions):
+        failed_keys = []
+        for batch in split_index_batches(actions):
+            failed_keys.extend(self._post_index_batch(batch))
+        return failed_keys
+
+    def _post_index_batch(self, batch):
+        """
+        1バッチを search.index に送信する。
+        207（部分失敗）の場合はリトライで成功しうるアイテムだけを、429/503 等の場合はバッチ全体を再送する。
+        :return: 最終的に失敗したアイテムの id のリスト
+        """
+        pending = batch
+        failed_keys = []
+        # インデックス登録の上限は全ワーカーで共有する（スロットリングされると他のワーカーも待つ）
+        limiter = get_limiter("search.index")
+        for attempt in range(INDEX_MAX_RETRIES + 1):
+            last_attempt = attempt == INDEX_MAX_RETRIES
+            if attempt:
+                increment("search.index_retries")
+            limiter.acquire()
+            try:
+                with span("search.index_batch"):
+                    resp = http_client.post(
+                        self._docs_url("search.index"), headers=self._headers(), json={"value": pending}
+                    )
+            except requests.RequestException as e:
+                logger.warning("search.index 送信エラー（%d 回目）: %s", attempt + 1, e)
+                if last_attempt:
+                    break
+                time.sleep(retry_wait_seconds(limiter, attempt, None, {}, INDEX_RETRY_BASE_SECONDS))
+                continue
+            increment("search.index_actions", len(pending), status=resp.status_code)
+            limiter.observe(resp.status_code, resp.headers)
+
+            if resp.status_code == 200:
+                logger.info("Azure Searchレスポンス: %s (%d 件)", resp.status_code, len(pending))
+                return failed_keys
+
+            if resp.status_code == 207:
+                # アイテムごとの結果から、リトライで成功しうる失敗だけを取り出す
+                by_key = {action["id"]: action for action in pending}
+                retry_items = []
+                for item in resp.json().get("value", []):
+                    if item.get("status"):
+                        continue
+                    if item.get("statusCode") in RETRYABLE_ITEM_STATUS and item.get("key") in by_key:
+                        retry_items.append(by_key[item["key"]])
+                    else:
+                        failed_keys.append(item.get("key"))
+                        logger.error(
+                            "インデックス登録失敗: %s %s %s",
+                            item.get("key"), item.get("statusCode"), item.get("errorMessage"),
+                        )
+                logger.info(
+                    "Azure Searchレスポンス: 207 (全 %d 件中 リトライ対象 %d 件)", len(pending), len(retry_items)
+                )
+                if not retry_items:
+                    return failed_keys
+                pending = retry_items
+                if last_attempt:
+                    break
+                time.sleep(retry_wait_seconds(limiter, attempt, resp.status_code, resp.headers, INDEX_RETRY_BASE_SECONDS))
+                continue
+
+            if resp.status_code in RETRYABLE_REQUEST_STATUS and not last_attempt:
+                logger.warning("search.index リトライ（%d 回目）: %s", attempt + 1, resp.status_code)
+                # スロットリング（429 / 503）の待ち時間は、レート制限が有効なら次の limiter.acquire で全ワーカーが待つ
+                wait = retry_wait_seconds(limiter, attempt, resp.status_code, resp.headers, INDEX_RETRY_BASE_SECONDS)
+                if wait:
+                    time.sleep(wait)
+                continue
+
+            logger.error("Azure Searchレスポンス: %s %s", resp.status_code, resp.text)
+            break
+        return failed_keys + [action["id"] for action in pending]
+
+    def find_ids(self, parent_filename):
+        """
+        1ページ（既定 50 件）では取り切れないため、id の昇順に並べ、前のページの最後の id より後（id gt）を
+        繰り返し取得する。skip と違い、ページ間で順序が変わって取りこぼすことがなく、skip の上限（100,000 件）もない。
+        """
+        parent_filter = "parent_filename eq '{}'".format(parent_filename.replace("'", "''"))
+        ids = []
+        while True:
+            search_filter = parent_filter
+            if ids:
+                search_filter += " and id gt '{}'".format(ids[-1].replace("'", "''"))
+            search_body = {
+                "search": "*",
+                "filter": search_filter,
+                "select": "id",
+                "orderby": "id",
+                "top": SEARCH_PAGE_SIZE,
+            }
+            search_resp = self._post_search(search_body)
+            if search_resp.status_code != 200:
+                logger.error("検索API失敗: %s %s", search_resp.status_code, search_resp.text)
+                return None
+            page = [doc["id"] for doc in search_resp.json().get("value", [])]
+            ids.extend(page)
+            if len(page) < SEARCH_PAGE_SIZE:
+                return ids
+
+    def search(self, text=None, vector=None, top=50, k=None, select=None, filter=None):
+        """
+        :raises RuntimeError: リトライしても検索に失敗した場合
+        """
+        body = {"search": text or "*", "top": top}
+        if vector is not None:
+            body["vectorQueries"] = [
+                {"kind": "vector", "fields": "text_vector", "k": k or top, "vector": vector}
+            ]
+        if select:
+            body["select"] = select
+        if filter:
+            body["filter"] = filter
+        resp = self._post_search(body)
+        if resp.status_code != 200:
+            logger.error("検索API失敗: %s %s", resp.status_code, resp.text)
+            raise RuntimeError(f"検索に失敗しました: ステータスコード {resp.status_code}")
+        return resp.json().get("value", [])
+
+
+class LocalSearchBackend(SearchBackend):
+    """組み込みのローカル検索エンジンを使うバックエンド"""
+    name = "local"
+
+    def __init__(self, engine=None):
+        if engine is None:
+            from local_search import get_local_engine
+            engine = get_local_engine()
+        self.engine = engine
+
+    def index_actions(self, actions):
+        return self.engine.index_actions(actions)
+
+    def find_ids(self, parent_filename):
+        return self.engine.find_ids(parent_filename)
+
+    def search(self, text=None, vector=None, top=50, k=None, select=None, filter=None):
+        return self.engine.search(text=text, vector=vector, top=top, k=k, select=select, filter=filter)
+
+
+_BACKENDS = {
+    "azure": AzureSearchBackend,
+    "local": LocalSearchBackend,
+}
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_search_backend(name=None):
+    """
+    検索バックエンドを返す（バックエンドごとにプロセス内で1つ）。
+    :param name: バックエンド名（省略時は環境変数 SEARCH_BACKEND）
+    """
+    name = (name or SEARCH_BACKEND).lower()
+    backend = _backends.get(name)
+    if backend is None:
+        if name not in _BACKENDS:
+            raise ValueError(f"不明な検索バックエンドです: {name}")
+        with _backends_lock:
+            backend = _backends.get(name)
+            if backend is None:
+                backend = _BACKENDS[name]()
+                _backends[name] = backend
+    return backend
@@ -0,0 +1,48 @@
+"""
+markdown_chunker のテスト
+実行方法: python -m unittest discover tests
+"""
+import unittest
+
+from markdown_chunker import split_markdown
+
+
+class SplitMarkdownTest(unittest.TestCase):
+
+    def test_long_image_link_is_not_repeated(self):
+        """長い画像リンクの前で区切った後、重ねた部分だけのチャンクを繰り返し作らない"""
+        link = "![x](" + "p" * 700 + ".png)"
+        text = "a " * 200 + link + " " + "b " * 300
+        chunks = split_markdown(text, chunk_size=500, chunk_overlap=50)
+
+        self.assertEqual(sum(link in chunk.text for chunk in chunks), 1)
+        for chunk in chunks:
+            if link not in chunk.text:
+                self.assertLessEqual(len(chunk.text), 500)
+        # 短いチャンク（重ねた部分だけのもの）を作らない
+        self.assertLessEqual(len(chunks), 4)
+        joined = "".join(chunk.text for chunk in chunks).replace(" ", "")
+        self.assertEqual(joined.count("a"), 200)
+
+    def test_long_heading_is_split(self):
+        """chunk_size を超える見出しも chunk_size 以内に分ける"""
+        title = "h" * 2000
+        text = f"# {title}\n\n" + "本文です。" * 10
+        chunks = split_markdown(text, chunk_size=500, chunk_overlap=50)
+
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk.text), 500)
+        self.assertIn("本文です。", chunks[-1].text)
+        self.assertEqual(chunks[-1].heading_path, [title])
+
+    def test_short_heading_starts_next_chunk(self):
+        """短い見出しは従来どおり次の本文と同じチャンクにする"""
+        text = "前の節の本文です。" * 40 + "\n\n## 次の節\n\n次の節の本文です。"
+        chunks = split_markdown(text, chunk_size=500, chunk_overlap=50)
+
+        self.assertTrue(chunks[-1].text.startswith("## 次の節"))
+        self.assertEqual(chunks[-1].heading_path, ["次の節"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+有効期限（TTL）付き LRU キャッシュ
+件数（または値の合計サイズ）の上限を超えた場合は最も長く使われていないものから削除し、
+有効期限を過ぎたものは取得時に削除する。複数スレッドから同時に使ってよい。
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    TTL 付き LRU キャッシュ
+    :param maxsize: 保持する最大件数（None の場合は件数で制限しない）
+    :param ttl: 有効期限（秒）。0 以下の場合は期限なし
+    :param maxbytes: 値の合計サイズの上限（バイト）。None の場合はサイズで制限しない
+    :param sizeof: 値のサイズ（バイト）を返す関数（maxbytes を指定する場合に使う）
+    """
+
+    def __init__(self, maxsize=1024, ttl=0, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.hits = 0
+        self.misses = 0
+        # キー -> (値, 有効期限, サイズ)
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """キーに対応する値を返す（ない場合・期限切れの場合は default）。"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at, size = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self._bytes -= size
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """値を保存し、上限を超えた分を古いものから削除する。"""
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else None
+        size = self.sizeof(value)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if self.maxbytes is not None and size > self.maxbytes:
+                # 1件で上限を超える値は保存しない
+                return
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            while (self.maxsize is not None and len(self._data) > self.maxsize) or \
+                    (self.maxbytes is not None and self._bytes > self.maxbytes):
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= evicted[2]
+
+    def pop(self, key, default=None):
+        """キーを削除して値を返す。"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            self._bytes -= entry[2]
+            return entry[0]
+
+    def clear(self):
+        """すべての値を削除する。"""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        """件数・値の合計サイズ・ヒット数・ミス数・ヒット率を返す。"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
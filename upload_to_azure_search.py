@@ -1,12 +1,23 @@
 # 画像リンク入りMarkdown分割＆Azure AI Search投入プログラム
 import re
 import os
+import sys
+import time
+import hashlib
+import threading
+import argparse
 import requests
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from blobstorage import upload_image_to_blob_storage_via_restapi
-from azureaisearch import upload_to_azure_search
+from image_sync import ImageSyncer
+from azureaisearch import upload_to_azure_search, assign_document_ids, sync_document_chunks
+from embedding_stage import embed_texts, create_embeddings, estimate_tokens, EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_BATCH_TOKENS
+from index_schema import compact_vector, check_vector_dimensions
+from search_backend import SEARCH_BACKEND
+from embedding_cache import EmbeddingCache
+from ingest_manifest import IngestManifest, chunk_hash
+from ingest_pipeline import IngestPipeline, Stage, BatchStage
+from markdown_chunker import MarkdownChunk, MarkdownChunker, MARKDOWN_CHUNK_SIZE, MARKDOWN_CHUNK_OVERLAP
+import metrics
 import logging
 from logging_config import configure_logging
 
@@ -24,88 +35,272 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 # Markdownファイルのパス
 MARKDOWN_DIR = os.getenv("MARKDOWN_DIR")
 
+# パイプラインの各ステージの並列数
+INGEST_PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", str(os.cpu_count() or 1)))
+INGEST_IMAGE_WORKERS = int(os.getenv("INGEST_IMAGE_WORKERS", "4"))
+INGEST_EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "4"))
+INGEST_INDEX_WORKERS = int(os.getenv("INGEST_INDEX_WORKERS", "2"))
+# ベクトル化ステージで、複数ファイルのチャンクを1バッチにまとめるために次のファイルを待つ最大秒数
+INGEST_EMBED_WAIT_SECONDS = float(os.getenv("INGEST_EMBED_WAIT_SECONDS", "0.2"))
+# ステージ間キューの上限
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "16"))
+# Markdown の分割方法（markdown: 構造を考慮した分割 / recursive: 従来の RecursiveCharacterTextSplitter）
+MARKDOWN_CHUNKER = os.getenv("MARKDOWN_CHUNKER", "markdown").lower()
+
 # 画像リンク抽出用の正規表現
 IMAGE_PATTERN = r'!\[.*?\]\((.*?)\)'
 
 # LangChainのRecursiveCharacterTextSplitterでMarkdownテキストを分割する関数
-def split_markdown_by_recursive_splitter(markdown_text):
+def split_markdown_by_recursive_splitter(markdown_text, chunk_size=MARKDOWN_CHUNK_SIZE, chunk_overlap=MARKDOWN_CHUNK_OVERLAP):
     """
     LangChainのRecursiveCharacterTextSplitterを使ってMarkdownテキストを分割する関数
+    （MARKDOWN_CHUNKER=recursive の場合と、分割のベンチマークの比較対象として使う）
     """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
     # chunk_sizeやchunk_overlapは用途に応じて調整可能
     splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,  # 1チャンクの最大文字数
-        chunk_overlap=50,  # チャンク間の重複文字数
+        chunk_size=chunk_size,  # 1チャンクの最大文字数
+        chunk_overlap=chunk_overlap,  # チャンク間の重複文字数
         separators=["\n\n", "\n", "。", ".", "!", "?", " "]  # Markdownに適した区切り
     )
     # 分割結果をリストで返す
     return splitter.split_text(markdown_text)
 
 
-def main():
+def read_and_split(md_path):
+    """
+    Markdownファイルを読み込み、内容ハッシュを計算して分割する関数
+    （パイプラインの解析ステージとしてプロセスプールで実行する）
+    """
+    stat = os.stat(md_path)
+    # Markdownファイルを読み込む
+    with open(md_path, "rb") as f:
+        raw = f.read()
+    markdown_text = raw.decode("utf-8")
+
+    if MARKDOWN_CHUNKER == "recursive":
+        # LangChainのRecursiveCharacterTextSplitterでMarkdownを分割（見出しの階層は付かない）
+        chunks = [MarkdownChunk(text, []) for text in split_markdown_by_recursive_splitter(markdown_text)]
+    else:
+        # 見出し・表・コードブロック・画像リンクの境界を保って分割
+        chunks = MarkdownChunker().split_text(markdown_text)
+    return {
+        "md_file": os.path.basename(md_path),
+        "fingerprint": {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": hashlib.sha256(raw).hexdigest(),
+        },
+        "chunks": chunks,
+    }
+
+
+def build_documents(mdfilename, chunks, image_syncer):
+    """
+    分割済みのチャンク（MarkdownChunk のリスト）から画像をアップロードしてドキュメントのリストを作る関数
+    （ベクトル化は embed_texts で行うため、ここでは text_vector を設定しない）
+    """
+    logger.info("タイトル: %s", mdfilename)
+
+    # チャンクごとの画像リンクを抽出（重複はまとめて1度だけ同期する）
+    image_links_per_chunk = [re.findall(IMAGE_PATTERN, chunk.text) for chunk in chunks]
+    images = [
+        (f"/{mdfilename}/{image_link}", os.path.join(MARKDOWN_DIR, image_link))
+        for image_links in image_links_per_chunk
+        for image_link in image_links
+    ]
+    # 画像をAzure Blob Storageに同期（内容が同じものはアップロードしない）
+    synced = image_syncer.sync(images)
+
+    docs = []
+    for chunk, image_links in zip(chunks, image_links_per_chunk):
+        imagebloburls = []
+        image_filenames = []
+        for image_link in image_links:
+            blob_path = f"/{mdfilename}/{image_link}"
+            if synced.get(blob_path):
+                imagebloburls.append(blob_path)
+                image_filenames.append(image_link)
+            else:
+                logger.error("画像アップロード失敗: %s", os.path.join(MARKDOWN_DIR, image_link))
+
+        doc = {
+            "text": chunk.text,
+            "imagebloburls": imagebloburls,
+            "parent_filename": mdfilename,
+            "image_filenames": image_filenames,
+            "heading_path": chunk.heading_path
+        }
+        docs.append(doc)
+    return docs
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Markdown を分割して Azure AI Search に登録する")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="マニフェストを無視して全ファイルを再登録する",
+    )
+    parser.add_argument(
+        "--parse-workers", type=int, default=INGEST_PARSE_WORKERS,
+        help="Markdown の読み込み・分割を行うプロセス数",
+    )
+    parser.add_argument(
+        "--image-workers", type=int, default=INGEST_IMAGE_WORKERS,
+        help="画像アップロードを行うスレッド数",
+    )
+    parser.add_argument(
+        "--embed-workers", type=int, default=INGEST_EMBED_WORKERS,
+        help="ベクトル化を行うスレッド数",
+    )
+    parser.add_argument(
+        "--index-workers", type=int, default=INGEST_INDEX_WORKERS,
+        help="インデックス登録を行うスレッド数",
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=INGEST_QUEUE_SIZE,
+        help="ステージ間キューの上限",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Markdown ファイルを並行パイプラインで取り込む。
+    解析（プロセスプール）→ 画像アップロード → ベクトル化 → インデックス登録（スレッドプール）の順に処理する。
+    :return: 取り込みに失敗したファイル名とエラー内容の辞書
+    """
+    args = parse_args(argv)
     # markdownディレクトリ内の全mdファイルを処理
     md_files = [f for f in os.listdir(MARKDOWN_DIR) if f.endswith('.md')]
+    if SEARCH_BACKEND == "azure":
+        # 次元数の異なるベクトルは登録できないため、取り込みを始める前に確認する
+        mismatch = check_vector_dimensions()
+        if mismatch:
+            logger.error(mismatch)
+            return {"index": mismatch}
     # OpenAI埋め込みモデルの初期化（1回だけ）
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-3-large",
-        openai_api_key=OPENAI_API_KEY
-    )
+    # （次元数はインデックスの text_vector に合わせる: EMBEDDING_DIMENSIONS）
+    embeddings = create_embeddings(openai_api_key=OPENAI_API_KEY)
+    manifest = IngestManifest()
+    cache = EmbeddingCache()
+    image_syncer = ImageSyncer()
+
+    def image_stage(item):
+        md_file = item["md_file"]
+        fingerprint = item["fingerprint"]
+        if not args.full and manifest.is_unchanged(md_file, fingerprint):
+            logger.info("変更なしのためスキップ: %s", md_file)
+            manifest.touch(md_file, fingerprint)
+            return None
+
+        docs = assign_document_ids(build_documents(md_file, item["chunks"], image_syncer))
+        chunks = {doc["id"]: chunk_hash(doc) for doc in docs}
+        old_chunks = None if args.full else manifest.get_chunks(md_file)
+        if old_chunks is None:
+            # 初回（またはフル再登録）はインデックス上の既存チャンクと突き合わせて置き換える
+            upsert_docs = docs
+            delete_ids = None
+        else:
+            upsert_docs = [doc for doc in docs if old_chunks.get(doc["id"]) != chunks[doc["id"]]]
+            delete_ids = [id for id in old_chunks if id not in chunks]
+        logger.info(
+            "差分: %s 追加・変更 %d / 削除 %s / 全 %d チャンク",
+            md_file, len(upsert_docs), "-" if delete_ids is None else len(delete_ids), len(docs),
+        )
+        return {**item, "docs": docs, "chunks": chunks, "upsert_docs": upsert_docs, "delete_ids": delete_ids}
+
+    def embed_targets(item):
+        return [doc for doc in item["upsert_docs"] if doc["text"].strip()]
 
+    def embed_weight(item):
+        # まとめるファイルの上限を決める重み: (チャンク数, トークン数)
+        targets = embed_targets(item)
+        return len(targets), sum(estimate_tokens(doc["text"].strip()) for doc in targets)
+
+    embedded = {"chunks": 0}
+    embedded_lock = threading.Lock()
+
+    def embed_stage(items):
+        # 複数ファイルの追加・変更されたチャンクをまとめてベクトル化（キャッシュ済みのものは API に送らない）
+        # 並列度はステージのワーカー数で制御するため、まとめた分のバッチは順に送る
+        targets = [doc for item in items for doc in embed_targets(item)]
+        vectors = embed_texts(embeddings, [doc["text"].strip() for doc in targets], concurrency=1, cache=cache)
+        for doc, vector in zip(targets, vectors):
+            # インデックスのベクトルの型に合わせて桁数を落とし、送信するデータ量を減らす
+            doc["text_vector"] = compact_vector(vector)
+        with embedded_lock:
+            embedded["chunks"] += len(targets)
+        return items
+
+    def index_stage(item):
+        # Azure AI Searchに差分を送信し、成功したものだけマニフェストに記録する
+        if item["delete_ids"] is None:
+            ok = upload_to_azure_search(item["docs"], parent_filename=item["md_file"])
+        else:
+            ok = sync_document_chunks(item["upsert_docs"], item["delete_ids"])
+        if not ok:
+            raise RuntimeError("インデックス更新失敗")
+        manifest.update(item["md_file"], item["fingerprint"], item["chunks"])
+        return item
+
+    # サイズと更新時刻が記録と一致するファイルは読み込まずにスキップする
+    md_paths = []
     for md_file in md_files:
         md_path = os.path.join(MARKDOWN_DIR, md_file)
-        # Markdownファイルを読み込む
-        with open(md_path, "r", encoding="utf-8") as f:
-            markdown_text = f.read()
-
-        mdfilename = os.path.basename(md_path)
-        logger.info("タイトル: %s", mdfilename)
-
-        # LangChainのRecursiveCharacterTextSplitterでMarkdownを分割
-        chunks = split_markdown_by_recursive_splitter(markdown_text)
-
-        docs = []
-        for i, text in enumerate(chunks):
-            image_blobs = []
-            if re.search(IMAGE_PATTERN, text):
-                image_links = re.findall(IMAGE_PATTERN, text)
-                image_blobs = image_links
-            
-            imagebloburls = []
-            image_filenames = []
-            # 画像をAzure Blob StorageにアップロードしてURLを取得
-            for image_link in image_blobs:
-                # 画像ファイル名を取得
-                image_filename = os.path.join(MARKDOWN_DIR, image_link)
-
-                # 画像をAzure Blob Storageにアップロード
-                response = upload_image_to_blob_storage_via_restapi(
-                    blob_path=f"/{mdfilename}/{image_link}",  # アップロード先のBlobパス
-                    image_path=image_filename,  # アップロードする画像ファイルのパス
-                )
-                if response.status_code == 201:
-                    # アップロード成功時、BlobのURLを取得
-                    blob_path = f"/{mdfilename}/{image_link}"
-                    imagebloburls.append(blob_path)
-                    image_filenames.append(image_link)
-                else:
-                    logger.error("画像アップロード失敗: %s", image_filename)
-
-            doc = {
-                "text": text,
-                "imagebloburls": imagebloburls,
-                "parent_filename": mdfilename,
-                "image_filenames": image_filenames
-            }
-            # テキスト埋め込みベクトル化
-            if text.strip():
-                # ベクトル化（LangChainのembed_documentsはリストで渡す必要あり）
-                vector = embeddings.embed_documents([text.strip()])[0]
-                doc["text_vector"] = vector
-            docs.append(doc)
-
-        # Azure AI Searchにアップロード
-        upload_to_azure_search(docs)
+        entry = manifest.files.get(md_file)
+        stat = os.stat(md_path)
+        if not args.full and entry and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+            logger.info("変更なしのためスキップ: %s", md_file)
+            continue
+        md_paths.append(md_path)
+
+    pipeline = IngestPipeline(
+        parse_func=read_and_split,
+        parse_workers=args.parse_workers,
+        stages=[
+            Stage("image", image_stage, args.image_workers),
+            BatchStage(
+                "embed", embed_stage, args.embed_workers,
+                max_items=EMBEDDING_BATCH_SIZE, max_weight=EMBEDDING_MAX_BATCH_TOKENS,
+                weight_func=embed_weight, max_wait=INGEST_EMBED_WAIT_SECONDS,
+            ),
+            Stage("index", index_stage, args.index_workers),
+        ],
+        queue_size=args.queue_size,
+        key_func=lambda item: item["md_file"] if isinstance(item, dict) else os.path.basename(item),
+    )
+    start = time.perf_counter()
+    try:
+        # 各ステージのスパンを1つのトレースにまとめる
+        with metrics.trace("ingest.run"):
+            failed = pipeline.run(md_paths)
+        elapsed = time.perf_counter() - start
+        logger.info(
+            "ベクトル化: 全 %d ファイル / %d チャンク / %.1f チャンク/秒",
+            len(md_paths), embedded["chunks"], embedded["chunks"] / elapsed if elapsed > 0 else 0.0,
+        )
+    finally:
+        cache.log_stats()
+        image_syncer.close()
+        manifest.save()
+
+    # ディレクトリから消えたファイルのチャンクを削除する
+    for md_file in set(manifest.files) - set(md_files):
+        logger.info("削除されたファイルのチャンクを削除: %s", md_file)
+        if sync_document_chunks([], list(manifest.get_chunks(md_file))):
+            manifest.remove(md_file)
+        else:
+            failed[md_file] = "delete: インデックス更新失敗"
+    manifest.save()
+
+    for md_file, error in failed.items():
+        logger.error("取り込みに失敗したファイル: %s (%s)", md_file, error)
+    metrics.flush()
+    return failed
 
 if __name__ == "__main__":
-    main()
+    failed = main()
+    sys.exit(1 if failed else 0)
 